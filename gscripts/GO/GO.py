@@ -3,9 +3,13 @@ from itertools import izip
 from functools import partial
 
 import numpy as np
-from scipy.stats import hypergeom
 import pandas as pd
-import seaborn as sns
+
+from gscripts import lazy_import
+
+# only needed for the p-values and plots, loaded on first use
+stats = lazy_import('scipy.stats')
+sns = lazy_import('seaborn')
 
 
 mm9GOFile = "/nas3/lovci/projects/GO/mm9.ENSG_to_GO.txt.gz"
@@ -17,7 +21,7 @@ def hypergeometric(row, lenAllGenes, lenTheseGenes):
         if (row['inBoth'] <= 3) or (row['expressedGOGenes'] < 5):
             return np.nan
         else:
-            return hypergeom.sf(row['inBoth'], lenAllGenes, row['expressedGOGenes'], lenTheseGenes)
+            return stats.hypergeom.sf(row['inBoth'], lenAllGenes, row['expressedGOGenes'], lenTheseGenes)
 
 
 class GO(object):
@@ -1,5 +1,5 @@
-__all__ = ["GO", "riboseq", "rnaseq", "general", 'which', 'qtools',
-           'mapping', 'annotations', 'expr_db', 'conservation']
+__all__ = ["GO", "riboseq", "rnaseq", "general", 'which', 'lazy_import',
+           'qtools', 'mapping', 'annotations', 'expr_db', 'conservation']
 
 
 # Copyright (c) 2001-2004 Twisted Matrix Laboratories.
@@ -9,6 +9,7 @@ __all__ = ["GO", "riboseq", "rnaseq", "general", 'which', 'qtools',
 Utilities for dealing with processes.
 """
 
+import importlib
 import os
 
 def which(name, flags=os.X_OK):
@@ -52,3 +53,58 @@ def which(name, flags=os.X_OK):
             if os.access(pext, flags):
                 result.append(pext)
     return result
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported the first time one of its
+    attributes is used, see lazy_import
+    """
+
+    def __init__(self, name, submodules=(), on_load=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_submodules'] = submodules
+        self.__dict__['_on_load'] = on_load
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            self.__dict__['_module'] = module
+            if self._on_load is not None:
+                self._on_load(module)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        if self._module is None:
+            return "<lazy module '{}' (not loaded)>".format(self._name)
+        return repr(self._module)
+
+
+def lazy_import(name, submodules=(), on_load=None):
+    """
+    Import a module on first use instead of now, so that heavy dependencies
+    (matplotlib, seaborn, sklearn, statsmodels, scipy) don't slow down every
+    script that imports a module which only needs them for some functions.
+
+    @type name: C{str}
+    @param name: Full name of the module, e.g. 'matplotlib.pyplot'
+
+    @type submodules: C{tuple}
+    @param submodules: Submodules to import along with the module, for
+    packages that don't import them in their __init__
+
+    @param on_load: Function called with the module after it is imported,
+    e.g. to set a plotting style
+
+    @rtype: C{LazyModule}
+    """
+    return LazyModule(name, submodules, on_load)
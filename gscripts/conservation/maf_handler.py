@@ -8,7 +8,8 @@ import bx
 import bx.align.maf
 from Bio import Phylo
 import pyfasta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import numpy as np
 import os, sys
 import socket
 
@@ -19,17 +20,81 @@ else:
     #haven't set up this system yet... download and index .maf files
     raise NotImplementedError
 
+class BlockCache(object):
+    """small LRU of parsed maf blocks, keyed by (chrom, block offset), so overlapping
+    interval queries don't re-read and re-parse blocks from the bz2 index"""
+
+    def __init__(self, max_blocks=2000):
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+
+    def get(self, key):
+        block = self._blocks.pop(key, None)
+        if block is not None:
+            self._blocks[key] = block
+        return block
+
+    def put(self, key, block):
+        self._blocks.pop(key, None)
+        self._blocks[key] = block
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def __len__(self):
+        return len(self._blocks)
+
+
 class MafRangeGetter(object):
 
+    block_cache_size = 2000
+
+    @property
+    def block_cache(self):
+        if not hasattr(self, "_block_cache"):
+            self._block_cache = BlockCache(self.block_cache_size)
+        return self._block_cache
+
+    def fetch_blocks(self, chrom, start, end):
+        """blocks overlapping chrom:start-end on the pivot species, served from the block cache when possible"""
+
+        ref_src = self.species + "." + chrom
+        blocks = []
+        for indexed in self.index.indexes:
+            for val_start, val_end, offset in indexed.indexes.find( ref_src, start, end ):
+                key = (chrom, offset)
+                block = self.block_cache.get(key)
+                if block is None:
+                    block = indexed.get_at_offset( offset )
+                    self.block_cache.put(key, block)
+                blocks.append(block)
+        return blocks
+
     def intervals_from_mask(self, mask ):
-        start = 0
-        last = mask[0]
-        for i in range( 1, len( mask ) ):
-            if mask[i] != last:
-                yield start, i, last
-                start = i
-                last = mask[i]
-        yield start, len(mask), last
+        """runs of identical values in mask as (start, end, value), found with np.diff instead of a per-base walk"""
+
+        mask = np.asarray(mask)
+        if len(mask) == 0:
+            return
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(mask)) + 1, [len(mask)]))
+        for run_start, run_end in zip(boundaries[:-1], boundaries[1:]):
+            yield int(run_start), int(run_end), int(mask[run_start])
+
+    def block_mask(self, blocks, ref_src, start, end):
+        """int32 array over start-end holding, for each base, the index of the highest scoring block
+        covering it (-1 where no block aligns). blocks must be sorted from low to high score"""
+
+        mask = np.empty(end - start, dtype=np.int32)
+        mask.fill(-1)
+        ref_src_size = None
+        for i, block in enumerate( blocks ):
+            ref = block.get_component_by_src_start( ref_src )
+            ref_src_size = ref.src_size
+            assert ref.strand == "+"
+            slice_start = max( start, ref.start )
+            slice_end = min( end, ref.end )
+            if slice_end > slice_start:
+                mask[slice_start - start:slice_end - start] = i
+        return mask, ref_src_size
 
     def tile_interval(self, chrom, start, end, strand):
 
@@ -37,24 +102,12 @@ class MafRangeGetter(object):
         for species other than the pivot species, reference (chromosome) names are masked, as the blocks
         from which a tiled interval may originate may not be on the same reference in an ortholog"""
 
-        base_len = end - start
         ref_src = self.species + "." + chrom
-        blocks = self.index.get( ref_src, start, end )
+        blocks = [block for block in self.fetch_blocks( chrom, start, end ) if block is not None]
         # From low to high score
-        blocks.sort( lambda a, b: cmp( a.score, b.score ) )
-
-        mask = [ -1 ] * base_len
+        blocks.sort( key=lambda block: block.score )
 
-        ref_src_size = None
-        if len(blocks) > 0 and blocks[0] is not None:
-            for i, block in enumerate( blocks ):
-                ref = block.get_component_by_src_start( ref_src )
-                ref_src_size = ref.src_size
-                assert ref.strand == "+"
-                slice_start = max( start, ref.start )
-                slice_end = min( end, ref.end )
-                for j in range( slice_start, slice_end ):
-                    mask[j-start] = i
+        mask, ref_src_size = self.block_mask( blocks, ref_src, start, end )
 
         tiled = []
         for i in range( len( self.sources ) ): tiled.append( [] )
@@ -151,16 +204,22 @@ class ce10MafRangeGetter(MafRangeGetter):
 
 class hg19MafRangeGetter(MafRangeGetter):
 
-    def __init__(self):
+    def __init__(self, maf_dir="hg19_100way/multiz100way/maf",
+                 treeFile="hg19_100way/multiz100way/hg19.100way.nh"):
+        """
+        maf_dir: directory of the chrN.maf.bz2 files
+        treeFile: newick tree of the alignment's species
+        both relative to conservation_basedir, or absolute
+        """
         self.species = "hg19"
         super(MafRangeGetter,self).__init__()
         chrs = map(str, range(1,23)) + ["X", "Y", "M"]
-        maf_files = [os.path.join(conservation_basedir, "hg19_100way/multiz100way/maf/chr" + c + ".maf.bz2")\
+        maf_files = [os.path.join(conservation_basedir, maf_dir, "chr" + c + ".maf.bz2")\
                      for c in chrs]
         self.index = bx.align.maf.MultiIndexed( maf_files, keep_open=True, parse_e_rows=True, use_cache=True )
         self.fasta = pyfasta.Fasta(os.path.join(genome_basedir, "hg19/chromosomes/all.fa"), flatten_inplace=True)
 
-        treeFile = os.path.join(conservation_basedir, "hg19_100way/multiz100way/hg19.100way.nh")
+        treeFile = os.path.join(conservation_basedir, treeFile)
         self.tree = Phylo.read(treeFile, 'newick')
         self.sources = [i.name for i in self.tree.get_terminals()]
         self.tree.root_with_outgroup({"name":"hg19"})
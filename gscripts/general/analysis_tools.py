@@ -1,40 +1,50 @@
 __author__ = 'lovci'
 
 
-import matplotlib
-import pylab
+import cPickle as pickle
+import hashlib
+import os
+
 import numpy as np
 import pandas as pd
 import itertools
-import seaborn
-seaborn.set_style({'axes.axisbelow': True,
-                 'axes.edgecolor': '.15',
-                 'axes.facecolor': 'white',
-                 'axes.grid': False,
-                 'axes.labelcolor': '.15',
-                 'axes.linewidth': 1.25,
-                 'font.family': 'Helvetica',
-                 'grid.color': '.8',
-                 'grid.linestyle': '-',
-                 'image.cmap': 'Greys',
-                 'legend.frameon': False,
-                 'legend.numpoints': 1,
-                 'legend.scatterpoints': 1,
-                 'lines.solid_capstyle': 'round',
-                 'text.color': '.15',
-                 'xtick.color': '.15',
-                 'xtick.direction': 'out',
-                 'xtick.major.size': 0,
-                 'xtick.minor.size': 0,
-                 'ytick.color': '.15',
-                 'ytick.direction': 'out',
-                 'ytick.major.size': 0,
-                 'ytick.minor.size': 0})
-
-seaborn.set_palette('deep')
-
-from sklearn.preprocessing import LabelEncoder
-from sklearn.ensemble import ExtraTreesClassifier, ExtraTreesRegressor
+
+from gscripts import lazy_import
+
+
+def _set_seaborn_style(seaborn):
+    seaborn.set_style({'axes.axisbelow': True,
+                     'axes.edgecolor': '.15',
+                     'axes.facecolor': 'white',
+                     'axes.grid': False,
+                     'axes.labelcolor': '.15',
+                     'axes.linewidth': 1.25,
+                     'font.family': 'Helvetica',
+                     'grid.color': '.8',
+                     'grid.linestyle': '-',
+                     'image.cmap': 'Greys',
+                     'legend.frameon': False,
+                     'legend.numpoints': 1,
+                     'legend.scatterpoints': 1,
+                     'lines.solid_capstyle': 'round',
+                     'text.color': '.15',
+                     'xtick.color': '.15',
+                     'xtick.direction': 'out',
+                     'xtick.major.size': 0,
+                     'xtick.minor.size': 0,
+                     'ytick.color': '.15',
+                     'ytick.direction': 'out',
+                     'ytick.major.size': 0,
+                     'ytick.minor.size': 0})
+
+    seaborn.set_palette('deep')
+
+# pylab, seaborn and sklearn are only imported once they are used, the seaborn
+# style is set then
+pylab = lazy_import('pylab')
+seaborn = lazy_import('seaborn', on_load=_set_seaborn_style)
+preprocessing = lazy_import('sklearn.preprocessing')
+ensemble = lazy_import('sklearn.ensemble')
 
 
 extratrees_default_params = {'n_estimators':50000,
@@ -53,8 +63,24 @@ extratreees_scoring_cutoff_fun = lambda scores: np.mean(scores) + 2*np.std(score
 #boosting_scoring_fun = lambda clf: clf.feature_importances_
 #boosting_scoring_cutoff_fun = lambda scores: np.mean(scores) + 2*np.std(scores)
 
-default_classifier, default_classifier_name = ExtraTreesClassifier, "ExtraTreesClassifier"
-default_regressor, default_regressor_name = ExtraTreesRegressor, "ExtraTreesRegressor"
+# None stands for ExtraTreesClassifier/ExtraTreesRegressor, so sklearn isn't
+# imported until something is fit
+default_classifier, default_classifier_name = None, "ExtraTreesClassifier"
+default_regressor, default_regressor_name = None, "ExtraTreesRegressor"
+
+def _joblib():
+    try:
+        import joblib
+    except ImportError:
+        from sklearn.externals import joblib
+    return joblib
+
+
+def _fit_model(model, model_params, X, y):
+    clf = model(**model_params)
+    clf.fit(X, y)
+    return clf
+
 
 default_classifier_scoring_fun = default_regressor_scoring_fun = extratreees_scoring_fun
 default_classifier_scoring_cutoff_fun = default_regressor_scoring_cutoff_fun = extratreees_scoring_cutoff_fun
@@ -107,14 +133,14 @@ class Comparer(object):
             self.categorical_traits = self.traits
 
         self.classifiers = {}
+        self.label_encoders = {}
         for trait in self.categorical_traits:
-            try:
-                assert len(source_traits.groupby(trait).describe().index.levels[0]) == 2
-            except AssertionError:
-                print "WARNING: trait \"%s\" has >2 categories"
             self.classifiers[trait] = {}
-            traitset = source_traits.groupby(trait).describe().index.levels[0]
-            le = LabelEncoder().fit(traitset)  #categorical encoder
+            #categorical encoder, fit once on the categories of the trait
+            le = preprocessing.LabelEncoder().fit(source_traits[trait].dropna())
+            if len(le.classes_) != 2:
+                print "WARNING: trait \"%s\" has >2 categories" % trait
+            self.label_encoders[trait] = le
             self.y[trait] = le.transform(self.trait_data[trait])  #categorical encoding
 
         self.continuous_traits = continuous_traits
@@ -125,11 +151,65 @@ class Comparer(object):
                 self.regressors[trait] = {}
                 self.y[trait] = self.trait_data[trait]
 
+    def _fit_models(self, traits, models, model_name, model, model_params,
+                    n_jobs, cache_dir):
+        """
+        fit model on every trait and store it in models[trait][model_name]
+
+        n_jobs > 1 fits the traits in parallel processes. The model's own
+        n_jobs (if it has one) is then set so the total number of processes
+        stays at n_jobs; with n_jobs=1 it is left as given. With cache_dir,
+        fitted models are saved keyed by (data, trait, model, params) and
+        loaded instead of refit.
+        """
+        joblib = _joblib()
+        model_params = dict(model_params)
+        n_workers = max(1, min(n_jobs, len(traits)))
+        if n_jobs > 1 and 'n_jobs' in model_params:
+            model_params['n_jobs'] = max(1, n_jobs // n_workers)
+
+        cache_files = dict((trait, None) for trait in traits)
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            X_hash = _data_hash(self.X, 1000)
+            model_id = "%s.%s %r" % (model.__module__, model.__name__,
+                                     sorted(model_params.items()))
+            for trait in traits:
+                key = hashlib.sha1(X_hash)
+                key.update(_data_hash(self.y[[trait]], 1000))
+                key.update(model_id)
+                cache_files[trait] = os.path.join(
+                    cache_dir, "%s_%s.pkl" % (model_name, key.hexdigest()))
+
+        todo = list()
+        for trait in traits:
+            cache_file = cache_files[trait]
+            if cache_file is not None and os.path.exists(cache_file):
+                print "Loading %s for trait %s from %s" % (model_name, trait, cache_file)
+                models[trait][model_name] = joblib.load(cache_file)
+            else:
+                todo.append(trait)
+
+        if len(todo) == 0:
+            return
+        print "Fitting %s for traits %s... please wait." % (model_name, ", ".join(map(str, todo)))
+        fitted = joblib.Parallel(n_jobs=n_workers)(
+            joblib.delayed(_fit_model)(model, model_params, self.X, self.y[trait])
+            for trait in todo)
+        for trait, clf in zip(todo, fitted):
+            models[trait][model_name] = clf
+            if cache_files[trait] is not None:
+                joblib.dump(clf, cache_files[trait])
+        print "Finished..."
+
     def fit_classifiers(self,
                         traits=None,
                         classifier_name=default_classifier_name,
                         classifier=default_classifier,
                         classifier_params=default_classifier_params,
+                        n_jobs=1,
+                        cache_dir=None,
                         ):
         """ fit classifiers to the data
         traits - list of trait(s) to fit a classifier upon,
@@ -137,18 +217,18 @@ class Comparer(object):
         Classifiers on each trait will be stored in: self.classifiers[trait]
 
         classifier_name - a name for this classifier to be stored in self.classifiers[trait][classifier_name]
-        classifier - sklearn classifier object such as ExtraTreesClassifier
+        classifier - sklearn classifier object such as ExtraTreesClassifier (the default, if None)
         classifier_params - dictionary for paramters to classifier
+        n_jobs - number of processes, traits are fit in parallel
+        cache_dir - directory to keep fitted classifiers in, unchanged ones are loaded instead of refit
         """
         if traits is None:
             traits = self.categorical_traits
+        if classifier is None:
+            classifier = ensemble.ExtraTreesClassifier
 
-        for trait in traits:
-            clf = classifier(**classifier_params)
-            print "Fitting a classifier for trait %s... please wait." %trait
-            clf.fit(self.X, self.y[trait])
-            self.classifiers[trait][classifier_name] = clf
-            print "Finished..."
+        self._fit_models(traits, self.classifiers, classifier_name, classifier,
+                         classifier_params, n_jobs, cache_dir)
 
     def score_classifiers(self,
                           traits=None,
@@ -195,17 +275,18 @@ class Comparer(object):
                        regressor_name=default_regressor_name,
                        regressor=default_regressor,
                        regressor_params=default_regressor_params,
+                       n_jobs=1,
+                       cache_dir=None,
                       ):
+        """ fit regressors to the data, see fit_classifiers """
 
         if traits is None:
             traits = self.continuous_traits
+        if regressor is None:
+            regressor = ensemble.ExtraTreesRegressor
 
-        for trait in traits:
-            clf = regressor(**regressor_params)
-            print "Fitting a classifier for trait %s... please wait." %trait
-            clf.fit(self.X, self.y[trait])
-            self.regressors[trait][regressor_name] = clf
-            print "Finished..."
+        self._fit_models(traits, self.regressors, regressor_name, regressor,
+                         regressor_params, n_jobs, cache_dir)
 
     def score_regressors(self,
                           traits=None,
@@ -371,40 +452,235 @@ class Visualizer(Comparer):
         seaborn.despine()
         return xx
 
-import sklearn
-from sklearn import decomposition
-class PCA(sklearn.decomposition.PCA):
+PCA_BACKENDS = ('full', 'incremental', 'randomized')
+
+
+def _is_sparse(X):
+    return hasattr(X, 'tocsr')
+
+
+def _row_chunks(X, batch_size, min_batch_size=0):
+    """Dense float blocks of batch_size rows of X (a DataFrame, an array, a
+    memory-mapped array or a scipy sparse matrix), so only one block is in
+    memory at a time. A last block shorter than min_batch_size is merged into
+    the one before it, like sklearn's gen_batches (IncrementalPCA.partial_fit
+    needs at least n_components rows)
+    """
+    values = X.values if isinstance(X, pd.DataFrame) else X
+    if _is_sparse(values):
+        values = values.tocsr()
+    n_rows = values.shape[0]
+    starts = range(0, n_rows, batch_size)
+    if len(starts) > 1 and n_rows - starts[-1] < min_batch_size:
+        starts.pop()
+    for start, stop in zip(starts, starts[1:] + [n_rows]):
+        chunk = values[start:stop]
+        if _is_sparse(chunk):
+            chunk = chunk.toarray()
+        yield np.asarray(chunk, dtype=float)
+
+
+def _data_hash(X, batch_size):
+    """sha1 of the values and labels of X, computed a block at a time"""
+    data_hash = hashlib.sha1(repr(X.shape))
+    if isinstance(X, pd.DataFrame):
+        data_hash.update(repr(list(X.index)))
+        data_hash.update(repr(list(X.columns)))
+    if _is_sparse(X):
+        X = X.tocsr()
+        for array in (X.data, X.indices, X.indptr):
+            data_hash.update(np.ascontiguousarray(array).view(np.uint8))
+    else:
+        for chunk in _row_chunks(X, batch_size):
+            data_hash.update(np.ascontiguousarray(chunk).view(np.uint8))
+    return data_hash.hexdigest()
+
+
+class PCA(object):
+    """
+    sklearn.decomposition.PCA that keeps the labels of a pandas DataFrame:
+    components_ and explained variance are indexed by "pc_1", "pc_2", ...
+    and the transformed data keeps the sample index. sklearn is only
+    imported when the PCA is fit.
+
+    backend - "full": sklearn's PCA on the whole matrix in memory
+              "incremental": IncrementalPCA fit batch_size rows at a time, so
+              memory-mapped arrays (e.g. a .npy filename) are streamed from
+              disk and sparse matrices are only made dense one block at a time
+              "randomized": randomized SVD. Sparse matrices use TruncatedSVD,
+              which (unlike PCA) doesn't center or whiten the data; it takes
+              n_components, random_state, tol and iterated_power, any other
+              PCA argument (e.g. whiten=True) raises ValueError.
+    batch_size - rows per block for the incremental backend, default
+                 max(1000, 5 * n_components)
+    cache_dir - if given, the fitted decomposition and the transformed data
+                are saved here keyed by a hash of the data and parameters, so
+                re-plotting the same data doesn't refit
+
+    Other keyword arguments are passed to the sklearn estimator, and its
+    other attributes (mean_, n_components_, ...) are available once it is fit.
+    """
+
+    def __init__(self, backend='full', batch_size=None, cache_dir=None,
+                 **pca_args):
+        if backend not in PCA_BACKENDS:
+            raise ValueError("unknown PCA backend {}, use one of {}".format(
+                backend, ", ".join(PCA_BACKENDS)))
+        self.backend = backend
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self._pca_args = pca_args
+        self._estimator = None
+        self._cached_pca_space = None
+        self._cache_file_name = None
+
+    @property
+    def estimator(self):
+        """The underlying sklearn estimator"""
+        if self._estimator is None:
+            self._estimator = self._new_estimator(sparse=False)
+        return self._estimator
 
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
+
+    def _new_estimator(self, sparse):
+        from sklearn import decomposition
+
+        if self.backend == 'incremental':
+            return decomposition.IncrementalPCA(batch_size=self.batch_size,
+                                                **self._pca_args)
+        if self.backend == 'randomized':
+            if sparse:
+                return decomposition.TruncatedSVD(algorithm='randomized',
+                                                  **self._truncated_svd_args())
+            return decomposition.PCA(svd_solver='randomized',
+                                     **self._pca_args)
+        return decomposition.PCA(**self._pca_args)
+
+    def _truncated_svd_args(self):
+        """pca_args translated to TruncatedSVD's, ValueError on the ones it
+        can't do (it has no whitening)"""
+        args = {'n_components': self._pca_args.get('n_components') or 2}
+        unsupported = []
+        for key, value in self._pca_args.items():
+            if key in ('n_components', 'copy') or \
+                    (key == 'whiten' and not value) or \
+                    (key == 'iterated_power' and value == 'auto'):
+                continue
+            if key in ('random_state', 'tol'):
+                args[key] = value
+            elif key == 'iterated_power':
+                args['n_iter'] = value
+            else:
+                unsupported.append(key)
+        if len(unsupported) > 0:
+            raise ValueError("the randomized backend uses TruncatedSVD on sparse "
+                             "matrices, which doesn't take {}".format(
+                                 ", ".join(sorted(unsupported))))
+        return args
+
+    def _min_batch_size(self):
+        return self._pca_args.get('n_components') or 0
+
+    def _batch_size(self):
+        if self.batch_size is not None:
+            return self.batch_size
+        return max(1000, 5 * (self._pca_args.get('n_components') or 0))
+
+    def _cache_file(self, X):
+        if self.cache_dir is None:
+            return None
+        key = hashlib.sha1(_data_hash(X, self._batch_size()))
+        key.update(repr((self.backend, self.batch_size,
+                         sorted(self._pca_args.items()))))
+        return os.path.join(self.cache_dir,
+                            'pca_{}.pickle'.format(key.hexdigest()))
+
+    def _save_cache(self, cache_file):
+        if cache_file is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'estimator': self._estimator,
+                         'pca_space': self._cached_pca_space}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
 
     def relabel_pcs(self, x):
         return "pc_" + str(int(x) + 1)
 
-    def fit(self, X):
-
-        try:
-            assert type(X) == pd.DataFrame
-        except:
-            print "Try again as a pandas data frame"
-            raise
+    def fit(self, X, index=None, columns=None):
+        """
+        X - pandas DataFrame (samples x features), numpy array, scipy sparse
+            matrix or the filename of a .npy array, which is memory-mapped
+        index, columns - sample and feature labels if X isn't a DataFrame
+        """
+        if isinstance(X, basestring):
+            X = np.load(X, mmap_mode='r')
+        if isinstance(X, pd.DataFrame):
+            index, columns = X.index, X.columns
+        else:
+            index = np.arange(X.shape[0]) if index is None else index
+            columns = np.arange(X.shape[1]) if columns is None else columns
 
         self.X = X
-        super(PCA, self).fit(X)
-        self.components_ = pd.DataFrame(self.components_, columns=self.X.columns).rename_axis(self.relabel_pcs, 0)
-        self.explained_variance_ = pd.Series(self.explained_variance_).rename_axis(self.relabel_pcs, 0)
-        self.explained_variance_ratio_ = pd.Series(self.explained_variance_ratio_).rename_axis(self.relabel_pcs, 0)
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+
+        cache_file = self._cache_file(X)
+        self._cached_pca_space = None
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            self._estimator = cached['estimator']
+            self._cached_pca_space = cached['pca_space']
+        else:
+            self._estimator = self._new_estimator(sparse=_is_sparse(X))
+            if self.backend == 'incremental':
+                for chunk in _row_chunks(X, self._batch_size(),
+                                         self._min_batch_size()):
+                    self._estimator.partial_fit(chunk)
+            else:
+                values = X.values if isinstance(X, pd.DataFrame) else X
+                if _is_sparse(values) and self.backend == 'full':
+                    values = values.toarray()
+                self._estimator.fit(values)
+            self._save_cache(cache_file)
+        self._cache_file_name = cache_file
+
+        self.components_ = pd.DataFrame(self.estimator.components_, columns=self.columns).rename_axis(self.relabel_pcs, 0)
+        self.explained_variance_ = pd.Series(self.estimator.explained_variance_).rename_axis(self.relabel_pcs, 0)
+        self.explained_variance_ratio_ = pd.Series(self.estimator.explained_variance_ratio_).rename_axis(self.relabel_pcs, 0)
         return self
 
     def transform(self, X):
-        pca_space = super(PCA, self).transform(X)
-        if type(self.X) == pd.DataFrame:
-            pca_space = pd.DataFrame(pca_space, index=self.X.index).rename_axis(self.relabel_pcs, 1)
+        if isinstance(X, basestring):
+            X = np.load(X, mmap_mode='r')
+        if self.backend == 'incremental':
+            pca_space = np.vstack([self.estimator.transform(chunk) for chunk
+                                   in _row_chunks(X, self._batch_size(),
+                                                  self._min_batch_size())])
+        else:
+            values = X.values if isinstance(X, pd.DataFrame) else X
+            if _is_sparse(values) and self.backend == 'full':
+                values = values.toarray()
+            pca_space = self.estimator.transform(values)
+        return self._label_pca_space(pca_space)
+
+    def _label_pca_space(self, pca_space):
+        if len(self.index) == pca_space.shape[0]:
+            pca_space = pd.DataFrame(pca_space, index=self.index).rename_axis(self.relabel_pcs, 1)
         return pca_space
 
-    def fit_transform(self, X):
-        try:
-            assert type(X) == pd.DataFrame
-        except:
-            print "Try again as a pandas data frame"
-            raise
-        self.fit(X)
-        return self.transform(X)
+    def fit_transform(self, X, index=None, columns=None):
+        self.fit(X, index=index, columns=columns)
+        if self._cached_pca_space is not None:
+            return self._label_pca_space(self._cached_pca_space)
+        pca_space = self.transform(self.X)
+        if self._cache_file_name is not None:
+            self._cached_pca_space = np.asarray(pca_space)
+            self._save_cache(self._cache_file_name)
+        return pca_space
@@ -1,27 +1,30 @@
 from collections import Iterable
+import hashlib
 from itertools import izip
 import math
 from math import sqrt
 import os
 
 
-import brewer2mpl
-import matplotlib as mpl
-from matplotlib.colors import LogNorm
-import matplotlib.gridspec as gridspec
-import matplotlib.patches as patches
-import matplotlib.pyplot as plt
 import numpy as np
 from numpy.linalg import norm
 import pandas as pd
-import prettyplotlib as ppl
-import scipy.cluster.hierarchy as sch
-import scipy.spatial.distance as distance
-from scipy.stats import gaussian_kde
-from sklearn import decomposition as dc
-import statsmodels.api as sm
-import seaborn
-import seaborn as sns
+
+from gscripts import lazy_import
+
+# Plotting and statistics libraries take seconds to import, so they are only
+# loaded when a function that uses them is called
+brewer2mpl = lazy_import('brewer2mpl')
+mpl = lazy_import('matplotlib', ('matplotlib.pyplot',))
+gridspec = lazy_import('matplotlib.gridspec')
+patches = lazy_import('matplotlib.patches')
+plt = lazy_import('matplotlib.pyplot')
+ppl = lazy_import('prettyplotlib')
+sch = lazy_import('scipy.cluster.hierarchy')
+distance = lazy_import('scipy.spatial.distance')
+dc = lazy_import('sklearn.decomposition')
+sm = lazy_import('statsmodels.api')
+seaborn = sns = lazy_import('seaborn')
 """
 seaborn.set_style({'axes.axisbelow': True,
                    'axes.edgecolor': '.15',
@@ -52,6 +55,99 @@ seaborn.set_palette('deep')
 #import pylab
 
 
+def chunked_pdist(data, metric='euclidean', chunk_size=256):
+    """Condensed float32 distance matrix, like scipy.spatial.distance.pdist,
+    computed chunk_size rows at a time so the float64 temporaries stay
+    small.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    n = data.shape[0]
+    y = np.empty(n * (n - 1) // 2, dtype=np.float32)
+    for start in xrange(0, n - 1, chunk_size):
+        stop = min(start + chunk_size, n - 1)
+        chunk = distance.cdist(data[start:stop], data[start + 1:], metric)
+        for i in xrange(start, stop):
+            # condensed index of the pair (i, i + 1)
+            offset = n * i - i * (i + 1) // 2
+            row = chunk[i - start, i - start:]
+            y[offset:offset + row.shape[0]] = row
+    return y
+
+
+def scalable_linkage(data, distance_metric='euclidean',
+                     linkage_method='average', max_leaves=2000,
+                     cache_dir=None, random_state=0):
+    """Hierarchical clustering of the rows of data that stays tractable
+    for tens of thousands of rows
+
+    Up to max_leaves rows are clustered directly from a float32 chunked
+    distance matrix. Bigger matrices are first reduced to max_leaves
+    centroids with mini-batch k-means (on z-scored rows for the correlation
+    metric) and the centroids are clustered instead.
+
+    @param data: 2d array, rows are clustered
+    @param cache_dir: If given, linkages are saved here keyed by a hash of
+    the data and parameters, so re-plotting the same data is instant
+    @return: Z, labels. Z is the linkage matrix of the rows, or of the
+    centroids if the rows were pre-clustered, in which case labels is the
+    centroid of each row (otherwise None). Use expand_leaves to get the
+    order of all rows from the dendrogram leaves.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    params = (data.shape, distance_metric, linkage_method, max_leaves,
+              random_state)
+
+    cache_file = None
+    if cache_dir is not None:
+        data_hash = hashlib.sha1(np.ascontiguousarray(data).view(np.uint8))
+        data_hash.update(repr(params))
+        cache_file = os.path.join(cache_dir,
+                                  'linkage_{}.npz'.format(
+                                      data_hash.hexdigest()))
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            labels = cached['labels'] if cached['labels'].size > 0 else None
+            return cached['Z'], labels
+
+    labels = None
+    leaves = data
+    if max_leaves is not None and data.shape[0] > max_leaves:
+        from sklearn.cluster import MiniBatchKMeans
+
+        points = data
+        if distance_metric == 'correlation':
+            points = data - data.mean(axis=1)[:, np.newaxis]
+            points /= np.linalg.norm(points, axis=1)[:, np.newaxis] + 1e-12
+        kmeans = MiniBatchKMeans(n_clusters=max_leaves,
+                                 random_state=random_state,
+                                 batch_size=max(100, 3 * max_leaves))
+        labels = kmeans.fit_predict(points)
+        # drop centroids of empty clusters and renumber the labels
+        used, labels = np.unique(labels, return_inverse=True)
+        leaves = np.array([data[labels == i].mean(axis=0)
+                           for i in xrange(used.shape[0])])
+
+    Z = sch.linkage(chunked_pdist(leaves, distance_metric), linkage_method)
+
+    if cache_file is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez(cache_file, Z=Z,
+                 labels=labels if labels is not None else np.array([]))
+    return Z, labels
+
+
+def expand_leaves(leaves, labels):
+    """Order of all rows from the dendrogram leaves of scalable_linkage:
+    rows of the same centroid are kept together, in their original order
+    """
+    if labels is None:
+        return list(leaves)
+    rank = np.empty(len(leaves), dtype=int)
+    rank[np.asarray(leaves)] = np.arange(len(leaves))
+    return list(np.argsort(rank[labels], kind='mergesort'))
+
+
 def clusterGram(dataFrame, distance_metric='euclidean',
                 linkage_method='average',
                 outfile=None, clusterRows=True, clusterCols=True,
@@ -60,7 +156,8 @@ def clusterGram(dataFrame, distance_metric='euclidean',
                 row_label_color_fun=lambda x: ppl.colors.almost_black,
                 col_label_color_fun=lambda x: ppl.colors.almost_black,
                 link_color_func=lambda x: ppl.colors.almost_black,
-                cmap=None):
+                cmap=None, scalable=False, max_leaves=2000,
+                linkage_cache=None):
     import scipy
     import pylab
     import matplotlib.gridspec as gridspec
@@ -84,26 +181,46 @@ def clusterGram(dataFrame, distance_metric='euclidean',
 
     set outfile == "None" to inibit saving an eps file (only show it, don't save it)
 
+    scalable=True is for big matrices (e.g. 20k+ genes): rows and columns are
+    clustered with scalable_linkage (pre-clustering to at most max_leaves
+    centroids, linkages cached in the linkage_cache directory), the row
+    dendrogram is drawn without labels and the heatmap body is rasterized.
+
     """
     data = np.array(dataFrame)
     colLabels = dataFrame.columns
     rowLabels = dataFrame.index
     nRow, nCol = data.shape
 
+    event_labels = None
+    sample_labels = None
     if clusterRows:
-        print "getting row distance matrix"
-        y_events = scipy.spatial.distance.pdist(data, distance_metric)
-        print "calculating linkages"
-        Z_events = scipy.cluster.hierarchy.linkage(y_events, linkage_method,
-                                                   metric=distance_metric)
+        if scalable:
+            print "calculating row linkages"
+            Z_events, event_labels = scalable_linkage(
+                data, distance_metric, linkage_method, max_leaves,
+                linkage_cache)
+        else:
+            print "getting row distance matrix"
+            y_events = scipy.spatial.distance.pdist(data, distance_metric)
+            print "calculating linkages"
+            Z_events = scipy.cluster.hierarchy.linkage(y_events,
+                                                       linkage_method,
+                                                       metric=distance_metric)
 
     if clusterCols:
-        print "getting column distance matrix"
-        y_samples = scipy.spatial.distance.pdist(np.transpose(data),
-                                                 distance_metric)
-        print "calculating linkages"
-        Z_samples = scipy.cluster.hierarchy.linkage(y_samples, linkage_method,
-                                                    metric=distance_metric)
+        if scalable:
+            print "calculating column linkages"
+            Z_samples, sample_labels = scalable_linkage(
+                np.transpose(data), distance_metric, linkage_method,
+                max_leaves, linkage_cache)
+        else:
+            print "getting column distance matrix"
+            y_samples = scipy.spatial.distance.pdist(np.transpose(data),
+                                                     distance_metric)
+            print "calculating linkages"
+            Z_samples = scipy.cluster.hierarchy.linkage(
+                y_samples, linkage_method, metric=distance_metric)
     else:
         if doCovar:
             raise ValueError
@@ -121,11 +238,16 @@ def clusterGram(dataFrame, distance_metric='euclidean',
     reordered = data
     event_order = range(nRow)
     if clusterRows:
-        d_events = scipy.cluster.hierarchy.dendrogram(Z_events,
-                                                      orientation='right',
-                                                      link_color_func=link_color_func,
-                                                      labels=rowLabels)
-        event_order = d_events['leaves']
+        if scalable:
+            d_events = scipy.cluster.hierarchy.dendrogram(
+                Z_events, orientation='right',
+                link_color_func=link_color_func, no_labels=True)
+        else:
+            d_events = scipy.cluster.hierarchy.dendrogram(Z_events,
+                                                          orientation='right',
+                                                          link_color_func=link_color_func,
+                                                          labels=rowLabels)
+        event_order = expand_leaves(d_events['leaves'], event_labels)
         reordered = data[event_order, :]
 
     labels = ax1.get_yticklabels()
@@ -138,11 +260,11 @@ def clusterGram(dataFrame, distance_metric='euclidean',
 
     sample_order = range(nCol)
     if clusterCols:
-        d_samples = scipy.cluster.hierarchy.dendrogram(Z_samples,
-                                                       labels=colLabels,
-                                                       leaf_rotation=90,
-                                                       link_color_func=link_color_func)
-        sample_order = d_samples['leaves']
+        d_samples = scipy.cluster.hierarchy.dendrogram(
+            Z_samples, labels=colLabels if sample_labels is None else None,
+            no_labels=sample_labels is not None, leaf_rotation=90,
+            link_color_func=link_color_func)
+        sample_order = expand_leaves(d_samples['leaves'], sample_labels)
         reordered = reordered[:, sample_order]
 
     axmatrix = pylab.subplot(gs[1:, 2:9])
@@ -159,7 +281,7 @@ def clusterGram(dataFrame, distance_metric='euclidean',
             cmap = pylab.cm.RdBu_r
 
     im = axmatrix.matshow(reordered, aspect='auto', origin='lower', cmap=cmap,
-                          norm=norm)
+                          norm=norm, rasterized=scalable)
     axmatrix.set_xticks([])
     axmatrix.set_yticks([])
     axcolor = pylab.subplot(gs[1:6, -1])
@@ -229,7 +351,10 @@ def heatmap(df, title=None, colorbar_label='values',
             ylabel_fontsize=10,
             cluster_cols=True,
             cluster_rows=True,
-            plot_df=None):
+            plot_df=None,
+            scalable=False,
+            max_leaves=2000,
+            linkage_cache=None):
     """
 
     @author Olga Botvinnik olga.botvinnik@gmail.com
@@ -253,6 +378,12 @@ def heatmap(df, title=None, colorbar_label='values',
     @param cluster_cols:
     @param cluster_rows:
     @param plot_df:
+    @param scalable: For big matrices: cluster with scalable_linkage, which
+    pre-clusters to at most max_leaves centroids, and draw the heatmap body
+    as one rasterized image instead of a mesh
+    @param max_leaves: Maximum number of leaves of each dendrogram when
+    scalable is True
+    @param linkage_cache: Directory to cache linkages in when scalable is True
     @return: @rtype: @raise TypeError:
     """
     almost_black = '#262626'
@@ -289,14 +420,26 @@ def heatmap(df, title=None, colorbar_label='values',
         cmap = mpl.cm.RdBu_r if divergent else mpl.cm.Blues_r
         cmap.set_bad('white')
 
-    # calculate pairwise distances for rows
-    row_pairwise_dists = distance.squareform(distance.pdist(df))
-    row_clusters = sch.linkage(row_pairwise_dists, method=row_linkage_method)
+    row_labels = None
+    col_labels = None
+    if scalable:
+        row_clusters, row_labels = scalable_linkage(
+            df.values, linkage_method=row_linkage_method,
+            max_leaves=max_leaves, cache_dir=linkage_cache)
+        col_clusters, col_labels = scalable_linkage(
+            df.values.T, linkage_method=col_linkage_method,
+            max_leaves=max_leaves, cache_dir=linkage_cache)
+    else:
+        # calculate pairwise distances for rows
+        row_pairwise_dists = distance.squareform(distance.pdist(df))
+        row_clusters = sch.linkage(row_pairwise_dists,
+                                   method=row_linkage_method)
 
-    # calculate pairwise distances for columns
-    col_pairwise_dists = distance.squareform(distance.pdist(df.T))
-    # cluster
-    col_clusters = sch.linkage(col_pairwise_dists, method=col_linkage_method)
+        # calculate pairwise distances for columns
+        col_pairwise_dists = distance.squareform(distance.pdist(df.T))
+        # cluster
+        col_clusters = sch.linkage(col_pairwise_dists,
+                                   method=col_linkage_method)
 
     # heatmap with row names
     dendrogram_height_fraction = df.shape[0] * 0.25 / df.shape[0]
@@ -332,6 +475,8 @@ def heatmap(df, title=None, colorbar_label='values',
                                                      color_threshold=np.inf,
                                                      color_list=[
                                                          black])
+        column_dendrogram_distances['leaves'] = expand_leaves(
+            column_dendrogram_distances['leaves'], col_labels)
     else:
         column_dendrogram_distances = {'leaves': range(df.shape[1])}
     clean_axis(column_dendrogram_ax)
@@ -357,6 +502,8 @@ def heatmap(df, title=None, colorbar_label='values',
                            color_threshold=np.inf,
                            orientation='right',
                            color_list=[black])
+        row_dendrogram_distances['leaves'] = expand_leaves(
+            row_dendrogram_distances['leaves'], row_labels)
     else:
         row_dendrogram_distances = {'leaves': range(df.shape[0])}
     clean_axis(row_dendrogram_ax)
@@ -381,9 +528,18 @@ def heatmap(df, title=None, colorbar_label='values',
     rows = plot_df.index.values[row_dendrogram_distances['leaves']]
     columns = plot_df.columns.values[column_dendrogram_distances[
         'leaves']]
-    heatmap_ax_pcolormesh = \
-        heatmap_ax.pcolormesh(plot_df.ix[rows, columns].values,
-                              norm=my_norm, cmap=cmap, vmin=vmin, vmax=vmax)
+    if scalable:
+        heatmap_ax_pcolormesh = \
+            heatmap_ax.imshow(plot_df.ix[rows, columns].values,
+                              norm=my_norm, cmap=cmap, vmin=vmin, vmax=vmax,
+                              aspect='auto', interpolation='nearest',
+                              origin='lower', rasterized=True,
+                              extent=(0, df.shape[1], 0, df.shape[0]))
+    else:
+        heatmap_ax_pcolormesh = \
+            heatmap_ax.pcolormesh(plot_df.ix[rows, columns].values,
+                                  norm=my_norm, cmap=cmap, vmin=vmin,
+                                  vmax=vmax)
     heatmap_ax.set_ylim(0, df.shape[0])
     heatmap_ax.set_xlim(0, df.shape[1])
     clean_axis(heatmap_ax)
@@ -496,6 +652,15 @@ class PCA_viz(PCA):
         @param show_vector_labels: Boolean. Can be helpful if the vector labels
         are gene names.
         @param scale_by_variance: Boolean. Scale vector components by explained variance
+        @param backend: "full", "incremental" or "randomized", see
+        analysis_tools.PCA. Use "incremental" for matrices that don't fit in
+        memory.
+        @param batch_size: Rows per block for the incremental backend
+        @param cache_dir: Directory to cache the fitted PCA in, keyed by a
+        hash of the data, so re-plotting the same data doesn't refit
+        @param df: A pandas dataframe, or anything analysis_tools.PCA.fit
+        takes (numpy array, scipy sparse matrix, .npy filename), with its
+        sample and feature labels given as index and columns
         @return: x, y, marker, distance of each vector in the data.
         """
 
@@ -514,12 +679,14 @@ class PCA_viz(PCA):
                               'point_label_size': None,
                               'scale_by_variance': True}
 
-    _default_pca_args = {'whiten': True, 'n_components': None}
+    _default_pca_args = {'whiten': True, 'n_components': None,
+                         'backend': 'full', 'batch_size': None,
+                         'cache_dir': None}
 
     _default_args = dict(
         _default_plotting_args.items() + _default_pca_args.items())
 
-    def __init__(self, df, **kwargs):
+    def __init__(self, df, index=None, columns=None, **kwargs):
 
         self._validate_params(self._default_args, **kwargs)
 
@@ -532,8 +699,7 @@ class PCA_viz(PCA):
                               k in self._default_pca_args.keys()])
 
         super(PCA_viz, self).__init__(**self.pca_args)  #initialize PCA object
-        assert type(df) == pd.DataFrame
-        self.pca_space = self.fit_transform(df)
+        self.pca_space = self.fit_transform(df, index=index, columns=columns)
 
     def __call__(self, ax=None, **kwargs):
 
@@ -622,7 +788,7 @@ class PCA_viz(PCA):
         # sort features by magnitude/contribution to transformation
         comp_magn = []
         magnitudes = []
-        for (x, y, an_id) in zip(x_loading, y_loading, self.X.columns):
+        for (x, y, an_id) in zip(x_loading, y_loading, self.columns):
 
             x = x * c_scale
             y = y * c_scale
@@ -645,10 +811,10 @@ class PCA_viz(PCA):
             comp_magn.append((x, y, an_id, mg))
             magnitudes.append(mg)
 
-        self.magnitudes = pd.Series(magnitudes, index=self.X.columns)
+        self.magnitudes = pd.Series(magnitudes, index=self.columns)
         self.magnitudes.sort(ascending=False)
 
-        for (x, y, an_id) in zip(x_list, y_list, self.X.index):
+        for (x, y, an_id) in zip(x_list, y_list, self.index):
             try:
                 color = colors_dict[an_id]
             except:
@@ -929,7 +1095,7 @@ def rpkm_and_mapping_stats(rpkm, mapping_stats, img_filename,
 
     rpkm.sort_index(by=sample_with_most_reads, inplace=True)
     pcolormesh = ax0.pcolormesh(rpkm.ix[:, sorted_col].values,
-                                norm=LogNorm(vmin=vmin, vmax=vmax),
+                                norm=mpl.colors.LogNorm(vmin=vmin, vmax=vmax),
                                 cmap=greys)
     # plt.colorbar(pcolormesh)
 
@@ -1463,10 +1629,6 @@ def ma_plot(df, ax):
     ax.set_ylabel("Log 2 Fold Change")
     ax.set_xscale("log")
                                         
-from itertools import izip
-import seaborn as sns
-
-
 def plot_go_enrichment(df, filter_value=None, max_terms=None, **kwargs):
     df = df.copy()
     new_index = []
@@ -0,0 +1,121 @@
+"""
+
+Bulk reads of gffutils databases, straight from the sqlite file
+
+Building a gffutils Feature for every row and decoding its whole attribute string is
+the slow part of walking db.features_of_type().  These helpers issue one query per
+feature type and pull only the attributes that are asked for out of the attribute
+column, as numpy / pandas columns.  Works with both the old (chrom, stop) and the
+current (seqid, end) gffutils schema.
+
+"""
+
+import cPickle as pickle
+import os
+import re
+import sqlite3
+
+import pandas as pd
+
+#attribute columns are either JSON ({"gene_id": ["x"]}, old dbs {"gene_id": "x"}),
+#GTF (gene_id "x";) or GFF3 (gene_id=x;)
+ATTRIBUTE_PATTERN = r'(?:^|[{,;])\s*"?%s"?(?:\s*:\s*\[?\s*|\s+)"([^"]*)"|(?:^|;)\s*%s=([^;,]*)'
+
+
+def db_filename(db):
+    """filename of a gffutils database, given either the filename or a FeatureDB"""
+    if isinstance(db, basestring):
+        return db
+    for attr in ('dbfn', 'db_fn'):
+        if hasattr(db, attr):
+            return getattr(db, attr)
+    raise ValueError("can't find the sqlite file of %r" % (db,))
+
+
+def extract_attribute(attributes, key):
+    """
+
+    first value of attribute key for every row of a Series of raw attribute strings,
+    NaN where the attribute is missing
+
+    """
+
+    key = re.escape(key)
+    values = attributes.str.extract(ATTRIBUTE_PATTERN % (key, key))
+    return values[0].fillna(values[1])
+
+
+def feature_table(db, featuretype, attributes=()):
+    """
+
+    All features of one type as a DataFrame, with one SQL query
+
+    db - gffutils database filename or FeatureDB
+    featuretype - e.g. 'gene', 'transcript', 'exon'
+    attributes - names of the attributes to decode into columns
+
+    returns DataFrame with columns id, chrom, start, end, strand and one per attribute
+
+    """
+
+    con = sqlite3.connect(db_filename(db))
+    try:
+        columns = [row[1] for row in con.execute("PRAGMA table_info(features)")]
+        chrom = 'seqid' if 'seqid' in columns else 'chrom'
+        end = 'end' if 'end' in columns else 'stop'
+        query = ("SELECT id, %s, start, %s, strand, attributes FROM features WHERE featuretype = ?"
+                 % (chrom, end))
+        rows = con.execute(query, (featuretype,)).fetchall()
+    finally:
+        con.close()
+
+    table = pd.DataFrame.from_records(rows, columns=['id', 'chrom', 'start', 'end', 'strand',
+                                                     'attributes'])
+    raw = table.pop('attributes').astype(unicode)
+    for attribute in attributes:
+        table[attribute] = extract_attribute(raw, attribute)
+    return table
+
+
+def _to_dict(table, key, value):
+    table = table.dropna(subset=[key, value])
+    return dict(zip(table[key].values, table[value].values))
+
+
+def annotation_maps(db, cache=True):
+    """
+
+    gene_id -> gene_name, gene_id -> gene_type and transcript_id -> gene_id dicts of a
+    gffutils database
+
+    db - gffutils database filename or FeatureDB
+    cache - memoize the dicts in <db>.maps.pickle, rebuilt whenever the db changes
+
+    returns dict with keys 'gene_name', 'gene_type' and 'transcript_gene'
+
+    """
+
+    filename = db_filename(db)
+    stat = os.stat(filename)
+    key = (stat.st_mtime, stat.st_size)
+    cache_file = filename + ".maps.pickle"
+    if cache and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as cache_handle:
+            cached = pickle.load(cache_handle)
+        if cached['key'] == key:
+            return cached['maps']
+
+    genes = feature_table(filename, 'gene', ['gene_id', 'gene_name', 'gene_type'])
+    transcripts = feature_table(filename, 'transcript', ['transcript_id', 'gene_id'])
+    maps = {'gene_name': _to_dict(genes, 'gene_id', 'gene_name'),
+            'gene_type': _to_dict(genes, 'gene_id', 'gene_type'),
+            'transcript_gene': _to_dict(transcripts, 'transcript_id', 'gene_id')}
+
+    if cache:
+        try:
+            with open(cache_file, 'wb') as cache_handle:
+                pickle.dump({'key': key, 'maps': maps}, cache_handle, pickle.HIGHEST_PROTOCOL)
+        except IOError:
+            #read only annotation directory, just don't memoize
+            pass
+    return maps
@@ -15,32 +15,363 @@ import math
 from scipy.stats import norm
 rv = norm()
 
-def get_all_overlaps(set1, set2):
+class IntervalArrays(object):
+    
+    """
+    
+    BED intervals loaded once into numpy arrays: per chromosome (and strand, if stranded)
+    starts and ends sorted by start, plus the running maximum of the ends.  
+    Used to count overlaps in process instead of running bedtools intersect.
+    
+    """
+    
+    def __init__(self, bedtool, stranded=False):
+        
+        """
+        
+        bedtool - pybedtool, bed filename or iterable of intervals (with chrom, start, end, strand)
+        stranded - only count overlaps on the same strand, like intersect(s=True)
+        
+        """
+        
+        if isinstance(bedtool, basestring):
+            bedtool = pybedtools.BedTool(bedtool)
+        self.stranded = stranded
+        
+        by_key = {}
+        self.n = 0
+        for interval in bedtool:
+            key = (interval.chrom, interval.strand) if stranded else interval.chrom
+            if key not in by_key:
+                by_key[key] = ([], [])
+            by_key[key][0].append(interval.start)
+            by_key[key][1].append(interval.end)
+            self.n += 1
+        
+        self.arrays = {}
+        for key, (starts, ends) in by_key.items():
+            starts = np.array(starts, dtype=np.int64)
+            ends = np.array(ends, dtype=np.int64)
+            order = np.argsort(starts, kind="mergesort")
+            starts, ends = starts[order], ends[order]
+            self.arrays[key] = (starts, ends, np.maximum.accumulate(ends))
+    
+    @classmethod
+    def load(cls, bedtool, stranded=False):
+        
+        """ returns bedtool as IntervalArrays, without reloading it if it already is one """
+        
+        if isinstance(bedtool, cls) and bedtool.stranded == stranded:
+            return bedtool
+        return cls(bedtool, stranded)
+    
+    def __len__(self):
+        return self.n
+    
+    def count_overlapping(self, other):
+        
+        """
+        
+        number of intervals in self that overlap at least one interval in other,
+        the same as len(self.intersect(other, u=True))
+        
+        """
+        
+        count = 0
+        for key, (starts, ends, max_ends) in self.arrays.items():
+            if key not in other.arrays:
+                continue
+            other_starts, other_ends, other_max_ends = other.arrays[key]
+            count += np.count_nonzero(_any_overlap(starts, ends, other_starts, other_max_ends))
+        return int(count)
+    
+    def overlaps(self, chroms, starts, ends):
+        
+        """ boolean array, True for the given (unstranded) intervals that overlap one of ours """
+        
+        result = np.zeros(len(starts), dtype=bool)
+        for chrom in np.unique(chroms):
+            if chrom not in self.arrays:
+                continue
+            on_chrom = chroms == chrom
+            other_starts, other_ends, other_max_ends = self.arrays[chrom]
+            result[on_chrom] = _any_overlap(starts[on_chrom], ends[on_chrom], other_starts, other_max_ends)
+        return result
+
+
+def _any_overlap(starts, ends, other_starts, other_max_ends):
+    
+    """
+    
+    True for each interval (starts, ends) that overlaps an interval of a set sorted by start,
+    given as its starts and running maximum of its ends: of the intervals that start before 
+    our end, the one that ends last has to reach past our start
+    
+    """
+    
+    n_before = np.searchsorted(other_starts, ends, side="left")
+    return (n_before > 0) & (other_max_ends[np.maximum(n_before - 1, 0)] > starts)
+
+
+def get_all_overlaps(set1, set2, engine="numpy", stranded=False):
     
     """
     
     given dicts set1 {name : pybedtool, name : pybedtool...}
                 set2 {name : pybedtool, name : pybedtool...}
     
+    engine - "numpy" loads every set once as IntervalArrays and counts overlaps in process,
+             "bedtools" runs bedtools intersect for every pair, both ways
+    stranded - only count overlaps on the same strand
+    
     returns overlapping counts of all pairwise combinations (in two data frames)
     set1_by_set2, set2_by_set1
      
     """
+    
+    if engine == "numpy":
+        arrays1 = dict((name, IntervalArrays.load(element, stranded)) for name, element in set1.items())
+        arrays2 = dict((name, IntervalArrays.load(element, stranded)) for name, element in set2.items())
+        count = lambda a, b: a.count_overlapping(b)
+    elif engine == "bedtools":
+        arrays1, arrays2 = set1, set2
+        count = lambda a, b: len(a.intersect(b, u=True, s=stranded, stream=True))
+    else:
+        raise ValueError("unknown engine %s, use numpy or bedtools" % (engine))
+    
     set1_by_set2 = {}
     set2_by_set1 = {}
-    for set1Name, set1Element in set1.items():
+    for set1Name, set1Element in arrays1.items():
         
         set1_lst  = []
         set2_lst = []
-        for set2Name, set2Element in set2.items():
-            set1_lst.append(len(set1Element.intersect(set2Element, u=True, stream=True)))
-            set2_lst.append(len(set2Element.intersect(set1Element, u=True, stream=True)))
+        for set2Name in set2.keys():
+            set2Element = arrays2[set2Name]
+            set1_lst.append(count(set1Element, set2Element))
+            set2_lst.append(count(set2Element, set1Element))
         set1_by_set2[set1Name] = Series(set1_lst, index = set2.keys())
         set2_by_set1[set1Name] = Series(set2_lst, index = set2.keys())
     
     return DataFrame(set1_by_set2), DataFrame(set2_by_set1)
 
 
+# positions are below this, so (replicate, chromosome, position) fits in one int64 sort key
+_POSITION_RANGE = np.int64(2 ** 32)
+
+
+class ShuffleNullModel(object):
+    
+    """
+    
+    Null model for the overlap counts of get_all_overlaps, drawing all shuffles at once as numpy
+    arrays instead of one bedtools shuffle (and file) per replicate.  
+    
+    Like shuffleBedTool, each interval is assigned to the first set of include regions it overlaps
+    (e.g. proximal, then distal introns) and is placed at a random position inside that set of 
+    regions, keeping its length.  Intervals that overlap none of them are left out.  Positions are
+    drawn uniformly over the total length of the regions, an interval that would run past the end 
+    of its region is moved back inside it.  Overlaps are counted without strand.
+    
+    """
+    
+    def __init__(self, include_regions, seed=None):
+        
+        """
+        
+        include_regions - list of include beds (pybedtools or filenames) in order of priority,
+                          none of them can be empty (ValueError)
+        seed - random seed
+        
+        """
+        
+        self.rng = np.random.RandomState(seed)
+        self.regions = [IntervalArrays.load(regions) for regions in include_regions]
+        self.chroms = sorted(set(chrom for regions in self.regions for chrom in regions.arrays))
+        self.chrom_codes = dict((chrom, code) for code, chrom in enumerate(self.chroms))
+        
+        self.region_classes = []
+        for i, regions in enumerate(self.regions):
+            chroms, starts, ends = self._table(regions)
+            if (ends - starts).sum() <= 0:
+                raise ValueError("include regions %d are empty, intervals assigned to them can't be shuffled" % (i))
+            codes = np.array([self.chrom_codes[chrom] for chrom in chroms], dtype=np.int64)
+            self.region_classes.append((codes, starts, ends, np.cumsum(ends - starts)))
+    
+    def _table(self, bedtool):
+        
+        """ chromosome names, starts and ends of all intervals, in a fixed order """
+        
+        items = sorted(IntervalArrays.load(bedtool).arrays.items())
+        if len(items) == 0:
+            return np.array([], dtype=object), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        chroms = np.concatenate([np.repeat(np.array([chrom], dtype=object), len(arrays[0]))
+                                 for chrom, arrays in items])
+        starts = np.concatenate([arrays[0] for chrom, arrays in items])
+        ends = np.concatenate([arrays[1] for chrom, arrays in items])
+        return chroms, starts, ends
+    
+    def fixed(self, bedtool):
+        
+        """ intervals as (chromosome codes, starts, ends) arrays of shape (1, n), the same for every replicate """
+        
+        chroms, starts, ends = self._table(bedtool)
+        codes = np.array([self.chrom_codes.get(chrom, -1) for chrom in chroms], dtype=np.int64)
+        return codes[np.newaxis], starts[np.newaxis], ends[np.newaxis]
+    
+    def shuffle(self, bedtool, n_shuffles):
+        
+        """
+        
+        draws n_shuffles shuffles of the intervals in bedtool
+        
+        returns (chromosome codes, starts, ends), arrays of shape (n_shuffles, n kept intervals),
+        chromosome codes index self.chroms
+        
+        """
+        
+        chroms, starts, ends = self._table(bedtool)
+        lengths = ends - starts
+        unassigned = np.ones(len(starts), dtype=bool)
+        
+        shuffled = ([], [], [])
+        for regions, (codes, region_starts, region_ends, cumulative) in zip(self.regions, self.region_classes):
+            in_class = unassigned & regions.overlaps(chroms, starts, ends)
+            unassigned &= ~in_class
+            class_lengths = lengths[in_class]
+            
+            #uniform position over the concatenated regions
+            position = (self.rng.random_sample((n_shuffles, len(class_lengths))) * cumulative[-1]).astype(np.int64)
+            region = np.searchsorted(cumulative, position, side="right")
+            new_starts = region_ends[region] - (cumulative[region] - position)
+            #keep the interval inside its region if it fits
+            new_starts = np.maximum(np.minimum(new_starts, region_ends[region] - class_lengths), region_starts[region])
+            
+            shuffled[0].append(codes[region])
+            shuffled[1].append(new_starts)
+            shuffled[2].append(new_starts + class_lengths)
+        
+        return tuple(np.hstack(arrays) if len(arrays) > 0 else np.zeros((n_shuffles, 0), dtype=np.int64)
+                     for arrays in shuffled)
+    
+    def count_overlaps(self, query, target, chunk_size=50):
+        
+        """
+        
+        query, target - (chromosome codes, starts, ends) from shuffle or fixed, 
+                        at least one of them from shuffle
+        chunk_size - number of replicates to count at a time
+        
+        returns the number of query intervals that overlap a target interval of the same replicate, 
+        for every replicate
+        
+        """
+        
+        n_replicates = max(query[0].shape[0], target[0].shape[0])
+        n_codes = len(self.chroms)
+        target_fixed = target[0].shape[0] == 1
+        
+        def replicates(intervals, start, stop):
+            if intervals[0].shape[0] == 1:
+                return [np.repeat(x, stop - start, axis=0) for x in intervals]
+            return [x[start:stop] for x in intervals]
+        
+        def sorted_target(codes, starts, ends, reps):
+            keep = codes >= 0
+            base = ((reps * n_codes + codes) * _POSITION_RANGE)[keep]
+            starts = base + starts[keep]
+            ends = base + ends[keep]
+            order = np.argsort(starts, kind="mergesort")
+            return starts[order], np.maximum.accumulate(ends[order])
+        
+        if target_fixed:
+            target_starts, target_max_ends = sorted_target(target[0], target[1], target[2], 0)
+        
+        counts = np.zeros(n_replicates, dtype=np.int64)
+        for start in xrange(0, n_replicates, chunk_size):
+            stop = min(start + chunk_size, n_replicates)
+            codes, starts, ends = replicates(query, start, stop)
+            reps = np.repeat(np.arange(stop - start)[:, np.newaxis], codes.shape[1], axis=1)
+            #a fixed target is the same in every replicate, otherwise keys include the replicate
+            key_reps = 0 if target_fixed else reps
+            if not target_fixed:
+                target_codes, target_starts, target_ends = replicates(target, start, stop)
+                target_reps = np.repeat(np.arange(stop - start)[:, np.newaxis], target_codes.shape[1], axis=1)
+                target_starts, target_max_ends = sorted_target(target_codes, target_starts, target_ends, target_reps)
+            
+            keep = codes >= 0
+            base = ((key_reps * n_codes + codes) * _POSITION_RANGE)[keep]
+            hits = _any_overlap(base + starts[keep], base + ends[keep], target_starts, target_max_ends)
+            counts[start:stop] += np.bincount(reps[keep][hits], minlength=stop - start)
+        return counts
+    
+    def overlap_null(self, dict_1, dict_2, n_shuffles=1000):
+        
+        """
+        
+        overlap counts of get_all_overlaps(dict_1, dict_2) with one or both sides shuffled, for every replicate
+        
+        returns a dict with the keys of intersect_shuffled_lists (dict_1 is "ultra", dict_2 "clip"),
+        each an array of shape (n_shuffles, len(dict_2), len(dict_1)), with rows and columns in 
+        sorted order of the names in dict_2 and dict_1
+        
+        """
+        
+        names_1 = sorted(dict_1.keys())
+        names_2 = sorted(dict_2.keys())
+        
+        fixed_1 = dict((name, self.fixed(element)) for name, element in dict_1.items())
+        fixed_2 = dict((name, self.fixed(element)) for name, element in dict_2.items())
+        shuffled_1 = dict((name, self.shuffle(element, n_shuffles)) for name, element in dict_1.items())
+        shuffled_2 = dict((name, self.shuffle(element, n_shuffles)) for name, element in dict_2.items())
+        
+        comparisons = {"shuffledUltra_by_clip" : (shuffled_1, fixed_2, False),
+                       "clip_by_shuffledUltra" : (fixed_2, shuffled_1, True),
+                       "ultra_by_shuffledClip" : (fixed_1, shuffled_2, False),
+                       "shuffledClip_by_ultra" : (shuffled_2, fixed_1, True),
+                       "shuffledUltra_by_shuffledClip" : (shuffled_1, shuffled_2, False),
+                       "shuffledClip_by_shuffledUltra" : (shuffled_2, shuffled_1, True)}
+        
+        null_counts = {}
+        for key, (queries, targets, query_is_2) in comparisons.items():
+            counts = np.zeros((n_shuffles, len(dict_2), len(dict_1)), dtype=np.int64)
+            for i, name_2 in enumerate(names_2):
+                for j, name_1 in enumerate(names_1):
+                    if query_is_2:
+                        counts[:, i, j] = self.count_overlaps(queries[name_2], targets[name_1])
+                    else:
+                        counts[:, i, j] = self.count_overlaps(queries[name_1], targets[name_2])
+            null_counts[key] = counts
+        return null_counts
+
+
+def null_z_scores(null_counts, ultra_by_clip, clip_by_ultra):
+    
+    """
+    
+    z-scores and empirical p-values of the observed overlaps (from get_all_overlaps(dict_1, dict_2)) 
+    against ShuffleNullModel.overlap_null(dict_1, dict_2)
+    
+    z = (observed - mean of shuffles) / standard deviation of shuffles
+    p = (1 + number of shuffles with at least as many overlaps) / (1 + number of shuffles)
+    
+    returns two dicts of data frames keyed like null_counts
+    
+    """
+    
+    z_scores = {}
+    p_values = {}
+    for key, counts in null_counts.items():
+        observed = clip_by_ultra if key.startswith("clip") or key.startswith("shuffledClip") else ultra_by_clip
+        observed = observed.loc[sorted(observed.index), sorted(observed.columns)]
+        values = observed.values.astype(float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (values - counts.mean(axis=0)) / counts.std(axis=0)
+        p = (1.0 + (counts >= values).sum(axis=0)) / (1.0 + counts.shape[0])
+        z_scores[key] = DataFrame(z, index=observed.index, columns=observed.columns)
+        p_values[key] = DataFrame(p, index=observed.index, columns=observed.columns)
+    return z_scores, p_values
+
+
 def z_score(x, u, s):
     """
     
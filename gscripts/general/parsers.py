@@ -7,11 +7,11 @@ all useful information
 Currently this isn't standard
 
 """
+import cPickle as pickle
 import glob
 import os
 
 import pandas as pd
-import pybedtools
 
 
 def get_names(files, num_seps, sep):
@@ -25,7 +25,98 @@ def get_names(files, num_seps, sep):
     return {sep.join(os.path.basename(file_name).split(sep)[0: num_seps]): file_name for file_name in files}
 
 
-def rnaseq_metrics(analysis_dir, num_seps=1, sep="."):
+class MetricsStore(object):
+
+    """ Cache of parsed QC files keyed by (path, mtime, size), so only new or changed files get re-parsed
+
+        store_file -- str pickle file the parsed results are kept in between sessions, None to keep them in memory only
+        table_file -- str optional .h5/.hdf or .parquet file the consolidated metrics table is written to
+    """
+
+    def __init__(self, store_file=None, table_file=None):
+        self.store_file = store_file
+        self.table_file = table_file
+        self.records = {}
+        self.changed = False
+        if store_file is not None and os.path.exists(store_file):
+            with open(store_file) as file_handle:
+                self.records = pickle.load(file_handle)
+
+    def parse(self, file_name, parser):
+        """ Parse file_name with parser, or return the cached result if the file hasn't changed """
+        stat = os.stat(file_name)
+        key = (parser.__name__, os.path.abspath(file_name))
+        signature = (stat.st_mtime, stat.st_size)
+        cached = self.records.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        result = parser(file_name)
+        self.records[key] = (signature, result)
+        self.changed = True
+        return result
+
+    def save(self):
+        """ Write the parsed results back to store_file, only if something new was parsed """
+        if self.store_file is not None and self.changed:
+            with open(self.store_file, 'w') as file_handle:
+                pickle.dump(self.records, file_handle, protocol=pickle.HIGHEST_PROTOCOL)
+            self.changed = False
+
+    def save_table(self, df):
+        """ Write the consolidated metrics table to table_file, as HDF or Parquet depending on the extension """
+        if self.table_file is None:
+            return
+        if self.table_file.endswith(".parquet"):
+            df.to_parquet(self.table_file)
+        else:
+            df.to_hdf(self.table_file, "metrics", mode="w")
+
+
+def _parse_all(names, parser, store=None):
+    """ parse every file in names (name -> file) into a samples x metrics dataframe """
+    if store is None:
+        parsed = {name: parser(file_name) for name, file_name in names.items()}
+    else:
+        parsed = {name: store.parse(file_name, parser) for name, file_name in names.items()}
+    return pd.DataFrame(parsed).transpose()
+
+
+def count_bed_lines(bed_file):
+    """ Number of intervals in a bed file, counted from newlines instead of parsing each interval """
+    count = 0
+    last = "\n"
+    with open(bed_file, 'rb') as file_handle:
+        header = 0
+        for line in file_handle:
+            if line.startswith("track") or line.startswith("browser") or line.startswith("#"):
+                header += 1
+            else:
+                break
+        file_handle.seek(0)
+        while True:
+            chunk = file_handle.read(1 << 20)
+            if not chunk:
+                break
+            count += chunk.count("\n")
+            last = chunk[-1]
+    if last != "\n":
+        count += 1
+    return count - header
+
+
+def count_peaks(peaks_file):
+    return {"Num Peaks": count_bed_lines(peaks_file)}
+
+
+def combine_metrics(dfs):
+    """ Outer join all sample x metric dataframes on sample name in one pass """
+    dfs = [df for df in dfs if len(df) > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(dfs, axis=1, join="outer").sort_index()
+
+
+def rnaseq_metrics(analysis_dir, num_seps=1, sep=".", store=None):
     """
 
     Generates RNA-seq metrics
@@ -33,6 +124,7 @@ def rnaseq_metrics(analysis_dir, num_seps=1, sep="."):
     analysis dir, directory to pull information from
     num_seps number of seperators to join back to get the name of the item
     sep: sperator to split / join on to get full name
+    store: MetricsStore, only files that changed since they were last parsed are read again
 
     """
     
@@ -50,14 +142,12 @@ def rnaseq_metrics(analysis_dir, num_seps=1, sep="."):
     rmrep_names = get_names(rmrep_files, num_seps, sep)
     star_names = get_names(star_files, num_seps, sep) 
     
-    nrf_df = pd.DataFrame({name: parse_nrf_file(nrf_file) for name, nrf_file in nrf_names.items()}).transpose()
-    cutadapt_df = pd.DataFrame({name: parse_cutadapt_file(cutadapt_file) for name, cutadapt_file in cutadapt_names.items()}).transpose()
-    rmrep_df = pd.DataFrame({name: parse_rmrep_file(rmrep_file) for name, rmrep_file in rmrep_names.items()}).transpose()
-    star_df = pd.DataFrame({name: parse_star_file(star_file) for name, star_file in star_names.items()}).transpose()
-    
-    combined_df = pd.merge(cutadapt_df, star_df, left_index=True, right_index=True, how="outer")
-    combined_df = pd.merge(combined_df, rmrep_df, left_index=True, right_index=True, how="outer")
-    combined_df = pd.merge(combined_df, nrf_df, left_index=True, right_index=True, how="outer")
+    nrf_df = _parse_all(nrf_names, parse_nrf_file, store)
+    cutadapt_df = _parse_all(cutadapt_names, parse_cutadapt_file, store)
+    rmrep_df = _parse_all(rmrep_names, parse_rmrep_file, store)
+    star_df = _parse_all(star_names, parse_star_file, store)
+
+    combined_df = combine_metrics([cutadapt_df, star_df, rmrep_df, nrf_df])
 
     #Rename columns to be useful
     combined_df = combined_df.rename(columns={"Processed bases": "Input Bases",
@@ -83,18 +173,22 @@ def rnaseq_metrics(analysis_dir, num_seps=1, sep="."):
                                     "Started job on",
                                     "Started mapping on"], axis=1)
 
+    if store is not None:
+        store.save()
     return combined_df 
 
 
 def clipseq_metrics(analysis_dir, iclip=False, single_end=False, num_seps=None, sep=".",
-                    percent_usable=.01, number_usable=500000, frip=.05):
+                    percent_usable=.01, number_usable=500000, frip=.05, store=None):
 
     """
     
     Reports all clip-seq metrics in a given analysis directory (this is fragile for now, outputs must follow gabes naming clipseq pipeline /
     naming convetions
 
-    
+    store: MetricsStore, only files that changed since they were last parsed are read again, and the
+    combined table is written to its table_file
+
     """
     if num_seps is None:
         num_seps = 2 if iclip else 1
@@ -124,25 +218,22 @@ def clipseq_metrics(analysis_dir, iclip=False, single_end=False, num_seps=None,
     rmRep_mapping_names = get_names(rmRep_mapping_files, num_seps, sep)
 
 
-    cutadapt_round2_df = pd.DataFrame({name: parse_cutadapt_file(cutadapt_file) for name, cutadapt_file in cutadapt_round2_names.items()}).transpose()
+    cutadapt_round2_df = _parse_all(cutadapt_round2_names, parse_cutadapt_file, store)
     cutadapt_round2_df.columns = ["{} Round 2".format(col) for col in cutadapt_round2_df.columns]
 
-    rmRep_mapping_df = pd.DataFrame({name: parse_star_file(star_file) for name, star_file in rmRep_mapping_names.items()}).transpose()
+    rmRep_mapping_df = _parse_all(rmRep_mapping_names, parse_star_file, store)
     rmRep_mapping_df.columns = ["{} rmRep".format(col) for col in rmRep_mapping_df.columns]
 
     if single_end:
-        rm_duped_df = pd.DataFrame({name: parse_se_umi(rm_duped_file) for name, rm_duped_file in rm_duped_names.items()}).transpose()
+        rm_duped_df = _parse_all(rm_duped_names, parse_se_umi, store)
     else:
-        rm_duped_df = pd.DataFrame({name: parse_rm_duped_metrics_file(rm_duped_file) for name, rm_duped_file in rm_duped_names.items()}).transpose()
-    spot_df = pd.DataFrame({name: parse_peak_metrics(spot_file) for name, spot_file in spot_names.items()}).transpose()
-    peaks_df = pd.DataFrame({name: {"Num Peaks": len(pybedtools.BedTool(peaks_file))} for name, peaks_file in peaks_names.items()}).transpose()
-    combined_df = rnaseq_metrics(analysis_dir, num_seps, sep)
+        rm_duped_df = _parse_all(rm_duped_names, parse_rm_duped_metrics_file, store)
+    spot_df = _parse_all(spot_names, parse_peak_metrics, store)
+    peaks_df = _parse_all(peaks_names, count_peaks, store)
+    combined_df = rnaseq_metrics(analysis_dir, num_seps, sep, store=store)
 
-    combined_df = pd.merge(combined_df, cutadapt_round2_df, left_index=True, right_index=True, how="outer")
-    combined_df = pd.merge(combined_df, rm_duped_df, left_index=True, right_index=True, how="outer")
-    combined_df = pd.merge(combined_df, spot_df, left_index=True, right_index=True, how="outer")
-    combined_df = pd.merge(combined_df, peaks_df, left_index=True, right_index=True, how="outer")
-    combined_df = pd.merge(combined_df, rmRep_mapping_df, left_index=True, right_index=True, how="outer")
+    combined_df = combine_metrics([combined_df, cutadapt_round2_df, rm_duped_df, spot_df, peaks_df,
+                                   rmRep_mapping_df])
 
     combined_df['Uniquely Mapped Reads'] = combined_df['Uniquely Mapped Reads'].astype(float)
     try:
@@ -153,6 +244,9 @@ def clipseq_metrics(analysis_dir, iclip=False, single_end=False, num_seps=None,
     except ZeroDivisionError:
         pass
 
+    if store is not None:
+        store.save()
+        store.save_table(combined_df)
     return combined_df
 
 def parse_rmrep_file(rmrep_file):
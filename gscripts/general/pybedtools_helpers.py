@@ -3,8 +3,6 @@ List of functions to help help with pybedtools or improve on its features, event
 
 """
 
-from collections import defaultdict
-
 import numpy as np
 import pybedtools
 
@@ -134,6 +132,79 @@ def get_single_gene_name(interval):
     return interval
 
 
+# positions are below this, so (name, position) fits in one int64 sort key
+POSITION_RANGE = np.int64(2 ** 32)
+
+
+def closest_by_name(names, chroms, starts, strands, feature_names,
+                    feature_chroms, feature_starts, feature_strands):
+    """
+
+    Vectorized closest feature with the same name, distance is measured between starts
+
+    names, chroms, starts, strands - arrays describing the intervals
+    feature_* - arrays describing the features
+
+    Returns (closest, distances): for every interval the index of the closest feature
+    with its name (-1 if there is none) and the signed distance to it, interval start minus feature
+    start on the + strand and the reverse on the - strand.  Ties go to the feature listed first.
+
+    Raises ValueError if features of a name are on another chromosome or strand than an interval
+    with that name
+
+    """
+
+    names = np.asarray(names, dtype=object)
+    starts = np.asarray(starts, dtype=np.int64)
+    strands = np.asarray(strands, dtype=object)
+    feature_starts = np.asarray(feature_starts, dtype=np.int64)
+    feature_chroms = np.asarray(feature_chroms, dtype=object)
+    feature_strands = np.asarray(feature_strands, dtype=object)
+    if len(feature_starts) == 0:
+        return np.repeat(-1, len(names)), np.zeros(len(names), dtype=np.int64)
+
+    unique_names, feature_codes = np.unique(np.asarray(feature_names, dtype=object), return_inverse=True)
+    codes = np.minimum(np.searchsorted(unique_names, names), len(unique_names) - 1)
+    known = unique_names[codes] == names
+
+    #every feature of a name has to be on the chromosome and strand of the intervals with that name
+    first = np.zeros(len(unique_names), dtype=np.int64)
+    first[feature_codes[::-1]] = np.arange(len(feature_codes))[::-1]
+    mixed = np.zeros(len(unique_names), dtype=bool)
+    np.logical_or.at(mixed, feature_codes, (feature_chroms != feature_chroms[first][feature_codes]) |
+                                           (feature_strands != feature_strands[first][feature_codes]))
+    mismatched = known & (mixed[codes] | (feature_chroms[first][codes] != np.asarray(chroms, dtype=object)) |
+                          (feature_strands[first][codes] != strands))
+    if mismatched.any():
+        i = np.flatnonzero(mismatched)[0]
+        raise ValueError("Strands not identical\nfeatures named %s don't match interval %d" % (names[i], i))
+
+    #features sorted by name, then start, then order in the list
+    keys = feature_codes * POSITION_RANGE + feature_starts
+    order = np.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    last = len(keys) - 1
+
+    query = codes * POSITION_RANGE + starts
+    right = np.searchsorted(keys, query, side="right")
+    #first listed feature at the closest start at or before the interval start
+    left = np.searchsorted(keys, keys[np.maximum(right - 1, 0)], side="left")
+    has_left = known & (right > 0) & (keys[left] // POSITION_RANGE == codes)
+    has_right = known & (right <= last) & (keys[np.minimum(right, last)] // POSITION_RANGE == codes)
+    right = np.minimum(right, last)
+
+    left_distance = np.where(has_left, query - keys[left], np.inf)
+    right_distance = np.where(has_right, keys[right] - query, np.inf)
+    left_first = (left_distance < right_distance) | \
+                 ((left_distance == right_distance) & (order[left] < order[right]))
+    closest = np.where(has_left | has_right, np.where(left_first, order[left], order[right]), -1)
+
+    distances = starts - feature_starts[np.maximum(closest, 0)]
+    distances = np.where(strands == "-", -distances, distances)
+    distances[closest < 0] = 0
+    return closest, distances
+
+
 def closest_by_feature(bedtool, closest_feature):
     """
     
@@ -147,41 +218,19 @@ def closest_by_feature(bedtool, closest_feature):
     Assumes both the bedtools object and the feature are 1bp long so we get the distance from both from their start sites
     """
 
-    #feature_dict = {feature.name : feature for feature in closest_feature}
-    feature_dict = defaultdict(list)
-    for feature in closest_feature:
-        feature_dict[feature.name].append(feature)
-
-    not_included = []
-    distances = []
-    for interval in bedtool:
-        if interval.name not in feature_dict:
-            not_included.append(interval.name)
-            continue
-
-        best_distance = (np.inf, None)
-        for feature in feature_dict[interval.name]:
-
-            #should throw in stronger error checking here, this is due to slightly different gene annotation approaches being used.  
-            if feature.strand != interval.strand or feature.chrom != interval.chrom:
-                #continue
-                print interval.strand, feature.strand
-                raise ValueError(
-                    "Strands not identical\nfeature : %sinterval: %s" % (
-                    str(feature), str(interval)))
-
-            if feature.strand == "+":
-                distance = interval.start - feature.start
-            else:
-                distance = feature.start - interval.start
+    intervals = list(bedtool)
+    features = list(closest_feature)
+    closest, distances = closest_by_name([interval.name for interval in intervals],
+                                         [interval.chrom for interval in intervals],
+                                         [interval.start for interval in intervals],
+                                         [interval.strand for interval in intervals],
+                                         [feature.name for feature in features],
+                                         [feature.chrom for feature in features],
+                                         [feature.start for feature in features],
+                                         [feature.strand for feature in features])
 
-            if abs(distance) < abs(best_distance[0]):
-                best_distance = (distance, feature)
-            #avoids problem of skipping sections
-        if best_distance[1] is not None:
-            distances.append("\t".join(
-                [str(interval).strip(), str(best_distance[1]).strip(),
-                 str(best_distance[0])]))
+    distances = ["\t".join([str(interval).strip(), str(features[feature]).strip(), str(distance)])
+                 for interval, feature, distance in zip(intervals, closest, distances) if feature >= 0]
 
     return pybedtools.BedTool(distances).saveas()
 
@@ -242,5 +291,121 @@ def convert_to_mRNA_position(interval, gene_model):
     interval.chrom = "none"
     return interval
 
+class TranscriptIndex(object):
+    """
+
+    gene model (as used by convert_to_mRNA_position) as arrays: the regions of every transcript
+    sorted by start with the mRNA position each one starts at, so batches of genomic positions are
+    mapped to mRNA positions with one searchsorted instead of a scan per interval
+
+    Regions of a transcript are assumed not to overlap, a position on the shared edge of two
+    regions goes to the one listed first, like convert_to_mRNA_position.
+
+    """
+
+    def __init__(self, gene_model):
+        """
+
+        gene_model - dict of lists of pybedtools intervals, transcript name : regions in mRNA order
+
+        """
+
+        self.names = sorted(gene_model.keys())
+        self.codes = dict((name, code) for code, name in enumerate(self.names))
+        self.strands = np.array([gene_model[name][0].strand for name in self.names], dtype=object)
+
+        codes, starts, stops, offsets, ranks = [], [], [], [], []
+        for code, name in enumerate(self.names):
+            region_starts = np.array([int(region.start) for region in gene_model[name]], dtype=np.int64)
+            region_stops = np.array([int(region.stop) for region in gene_model[name]], dtype=np.int64)
+            lengths = region_stops - region_starts
+            codes.append(np.repeat(code, len(region_starts)))
+            starts.append(region_starts)
+            stops.append(region_stops)
+            offsets.append(np.cumsum(lengths) - lengths)
+            ranks.append(np.arange(len(region_starts)))
+
+        keys = np.concatenate(codes) * POSITION_RANGE + np.concatenate(starts) if codes else np.array([], dtype=np.int64)
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.region_codes = np.concatenate(codes)[order] if codes else keys
+        self.starts = np.concatenate(starts)[order] if codes else keys
+        self.stops = np.concatenate(stops)[order] if codes else keys
+        self.offsets = np.concatenate(offsets)[order] if codes else keys
+        self.ranks = np.concatenate(ranks)[order] if codes else keys
+
+    def _contains(self, region, codes, positions):
+        valid = (region >= 0) & (region < len(self.keys))
+        region = np.clip(region, 0, max(len(self.keys) - 1, 0))
+        if len(self.keys) == 0:
+            return valid
+        return valid & (self.region_codes[region] == codes) & (self.starts[region] <= positions) & \
+            (positions <= self.stops[region])
+
+    def to_mRNA(self, names, starts, ends, strands):
+        """
+
+        Maps genomic intervals on transcripts to mRNA positions, see convert_to_mRNA_position
+
+        names - transcript of each interval (the chrom field for convert_to_mRNA_position)
+        starts, ends, strands - arrays describing the intervals
+
+        Returns (mRNA starts, mRNA ends, found), found is False for intervals whose transcript isn't
+        known, is on the other strand or doesn't contain the start
+
+        """
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        strands = np.asarray(strands, dtype=object)
+        codes = np.array([self.codes.get(name, -1) for name in names], dtype=np.int64)
+        found = codes >= 0
+        if len(self.names) > 0:
+            found &= self.strands[np.maximum(codes, 0)] == strands
+
+        region = np.searchsorted(self.keys, codes * POSITION_RANGE + starts, side="right") - 1
+        in_region = self._contains(region, codes, starts)
+        in_previous = self._contains(region - 1, codes, starts)
+        if len(self.keys) > 0:
+            #the region listed first wins if the start is on the edge of two
+            in_previous &= ~in_region | (self.ranks[np.maximum(region - 1, 0)] <
+                                         self.ranks[np.clip(region, 0, len(self.keys) - 1)])
+        region = np.clip(np.where(in_previous, region - 1, region), 0, max(len(self.keys) - 1, 0))
+        found &= in_region | in_previous
+        if len(self.keys) == 0:
+            return np.ones_like(starts), np.ones_like(ends), found
+
+        offsets = self.offsets[region]
+        plus = strands == "+"
+        mRNA_starts = np.where(plus, offsets + (starts - self.starts[region]), offsets + (self.stops[region] - ends))
+        mRNA_ends = np.where(plus, offsets + (ends - self.starts[region]), offsets + (self.stops[region] - starts))
+
+        outside = (mRNA_starts <= 0) | (mRNA_ends <= 0)
+        mRNA_starts[outside] = 1
+        mRNA_ends[outside] = 1
+        return mRNA_starts, mRNA_ends, found
+
+    def convert(self, bedtool):
+        """
+
+        bedtool mapped to mRNA positions, same as bedtool.each(convert_to_mRNA_position, gene_model),
+        intervals that can't be mapped get "none" as their chrom
+
+        """
+
+        intervals = list(bedtool)
+        mRNA_starts, mRNA_ends, found = self.to_mRNA([interval.chrom for interval in intervals],
+                                                     [interval.start for interval in intervals],
+                                                     [interval.end for interval in intervals],
+                                                     [interval.strand for interval in intervals])
+        for interval, start, end, is_found in zip(intervals, mRNA_starts, mRNA_ends, found):
+            if is_found:
+                interval.start = int(start)
+                interval.end = int(end)
+            else:
+                interval.chrom = "none"
+        return pybedtools.BedTool(intervals).saveas()
+
+
 def to_bed(x):
     return x.chrom, x.start, x.stop, x.attributes['gene_id'], "0", x.strand
@@ -6,13 +6,20 @@ Created on May 1, 2013
 Helps get region information from oolite
 '''
 
-from collections import defaultdict
+from collections import defaultdict, Mapping
+import hashlib
 import os
+import shutil
+import tempfile
 
+import numpy as np
+import pandas as pd
 import pybedtools 
 
+from gscripts.general.gffutils_helpers import annotation_maps
 
-from gscripts.general.pybedtools_helpers import get_single_gene_name, rename_to_gene_from_dict, get_five_prime_end, get_three_prime_end
+
+from gscripts.general.pybedtools_helpers import get_single_gene_name
 
 def trim_names(interval):
 
@@ -22,7 +29,217 @@ def trim_names(interval):
     return interval
 
 
-def get_regions():
+AS_STRUCTURE = "/nas3/yeolab/Genome/ensembl/AS_STRUCTURE/hg19data4/"
+
+#source files of the region sets, relative to the AS_STRUCTURE directory
+REGION_FILES = {"UTR3" : "UTR3_hg19_frea_sorted.withscore",
+                "UTR5" : "UTR5_hg19_frea_sorted.withscore",
+                "CDS" : "exon_hg19_frea_sorted.withscore",
+                "transcription_stop" : "polya_hg19_frea_sorted.withscore"}
+
+REGION_NAMES = ["UTR3", "UTR5", "CDS", "stop_codons", "five_prime_sites", "three_prime_sites", 
+                "start_codons", "transcription_stop", "transcription_start", "transcriptome"]
+
+_registries = {}
+
+def read_regions(filename):
+    
+    """
+    
+    reads a bed file into a DataFrame (columns numbered like bed fields), 
+    names are trimmed to gene names like trim_names
+    
+    """
+    
+    regions = pd.read_csv(filename, sep="\t", header=None, comment="#", dtype={0 : str, 3 : str})
+    regions[3] = regions[3].str.split(":").str[0]
+    return regions
+
+def terminal_sites(regions, plus_site, minus_site):
+    
+    """
+    
+    collapses the intervals of every name to a single position
+    
+    plus_site, minus_site - "min_start" or "max_end", the position taken over all intervals of 
+    a name on the + and - strand.  Chrom, score and strand come from the first interval of the name
+    
+    """
+    
+    grouped = regions.groupby(3, sort=False)
+    sites = {"min_start" : grouped[1].min(), "max_end" : grouped[2].max()}
+    first = regions.drop_duplicates(3)
+    names = first[3].values
+    position = np.where((first[5] == "+").values, 
+                        sites[plus_site].reindex(names).values, 
+                        sites[minus_site].reindex(names).values)
+    return pd.DataFrame({0 : first[0].values, 1 : position, 2 : position, 3 : names,
+                         4 : first[4].values, 5 : first[5].values}, columns=range(6))
+
+def exon_ends(regions, five_prime=True):
+    
+    """
+    
+    vectorized get_five_prime_end / get_three_prime_end over a DataFrame of intervals
+    
+    """
+    
+    plus = (regions[5] == "+").values
+    if five_prime:
+        position = np.where(plus, regions[1].values, regions[2].values)
+    else:
+        position = np.where(plus, regions[2].values, regions[1].values)
+    ends = regions.copy()
+    ends[1] = position
+    ends[2] = position
+    return ends
+
+def build_regions(path=AS_STRUCTURE):
+    
+    """
+    
+    derives every region set of get_regions from the AS_STRUCTURE files, 
+    returns a dict of DataFrames
+    
+    """
+    
+    regions = dict((name, read_regions(os.path.join(path, filename))) 
+                   for name, filename in REGION_FILES.items())
+    
+    #need to know if this is CDS or total exon...
+    regions['five_prime_sites'] = exon_ends(regions['CDS'], five_prime=True)
+    regions['three_prime_sites'] = exon_ends(regions['CDS'], five_prime=False)
+    
+    #stop codon is the first UTR3 location in a gene, start codon the last UTR5 location
+    regions['stop_codons'] = terminal_sites(regions['UTR3'], "min_start", "max_end")
+    regions['start_codons'] = terminal_sites(regions['UTR5'], "max_end", "min_start")
+    regions['transcription_start'] = terminal_sites(regions['UTR5'], "min_start", "max_end")
+    
+    parts = [regions['UTR3'], regions['UTR5'], regions['CDS']]
+    n_fields = min(len(part.columns) for part in parts)
+    regions['transcriptome'] = pd.concat([part[range(n_fields)] for part in parts], ignore_index=True)
+    return regions
+
+def annotation_version(path=AS_STRUCTURE):
+    
+    """
+    
+    identifies a version of the AS_STRUCTURE annotation by its directory and the 
+    size and modification time of the region files
+    
+    """
+    
+    signature = [os.path.abspath(path)]
+    for name in sorted(REGION_FILES):
+        stat = os.stat(os.path.join(path, REGION_FILES[name]))
+        signature.append("%s:%d:%d" % (name, stat.st_size, stat.st_mtime))
+    digest = hashlib.sha1("|".join(signature)).hexdigest()[:12]
+    return "%s-%s" % (os.path.basename(os.path.normpath(path)), digest)
+
+def write_region(regions, prefix):
+    
+    """
+    
+    writes a region set sorted by position as prefix.bed.gz (bgzipped, with a tabix index) 
+    and its chrom / start / end / name / strand columns as prefix.npz
+    
+    """
+    
+    import pysam
+    
+    chroms = regions[0].values.astype(str)
+    order = np.lexsort((regions[2].values, regions[1].values, chroms))
+    regions = regions.iloc[order]
+    regions.to_csv(prefix + ".bed", sep="\t", header=False, index=False)
+    pysam.tabix_index(prefix + ".bed", preset="bed", force=True)
+    np.savez(prefix + ".npz", 
+             chroms=chroms[order], 
+             starts=regions[1].values.astype(np.int64), 
+             ends=regions[2].values.astype(np.int64),
+             names=regions[3].values.astype(str), 
+             strands=regions[5].values.astype(str))
+    
+class RegionRegistry(Mapping):
+    
+    """
+    
+    Region sets of one AS_STRUCTURE annotation, built once per annotation version into 
+    cache_dir/<version>/ and loaded lazily by name
+    
+    registry['UTR3'] - pybedtool of the bgzipped file (tabix indexed, so tabix_intervals works)
+    registry.arrays('UTR3') - dict of numpy arrays: chroms, starts, ends, names, strands
+    
+    """
+    
+    def __init__(self, path=AS_STRUCTURE, cache_dir=None):
+        
+        """
+        
+        path - AS_STRUCTURE directory with the files in REGION_FILES
+        cache_dir - where built region sets are kept, default ~/.gscripts/regions
+        
+        """
+        
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".gscripts", "regions")
+        self.path = path
+        self.version = annotation_version(path)
+        self.directory = os.path.join(cache_dir, self.version)
+        self._bedtools = {}
+        self._arrays = {}
+        if not os.path.exists(self.directory):
+            self.build()
+
+    def build(self):
+        
+        """
+        
+        writes every region set, the version directory only appears once all of them are done 
+        so concurrent or interrupted builds never leave a partial cache behind
+        
+        """
+        
+        parent = os.path.dirname(self.directory)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp_dir = tempfile.mkdtemp(prefix=self.version + ".", dir=parent)
+        try:
+            for name, regions in build_regions(self.path).items():
+                write_region(regions, os.path.join(tmp_dir, name))
+            os.rename(tmp_dir, self.directory)
+        except OSError:
+            #another process finished the same version first
+            if not os.path.exists(self.directory):
+                raise
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def filename(self, name):
+        if name not in REGION_NAMES:
+            raise KeyError(name)
+        return os.path.join(self.directory, name + ".bed.gz")
+
+    def __getitem__(self, name):
+        if name not in self._bedtools:
+            self._bedtools[name] = pybedtools.BedTool(self.filename(name))
+        return self._bedtools[name]
+
+    def __iter__(self):
+        return iter(REGION_NAMES)
+
+    def __len__(self):
+        return len(REGION_NAMES)
+
+    def arrays(self, name):
+        if name not in self._arrays:
+            if name not in REGION_NAMES:
+                raise KeyError(name)
+            with np.load(os.path.join(self.directory, name + ".npz")) as data:
+                self._arrays[name] = dict((key, data[key]) for key in data.files)
+        return self._arrays[name]
+
+def get_regions(path=AS_STRUCTURE, cache_dir=None):
     """
     
     Gets important hg19 regions from as structre and returns them as a dict of pybedtools
@@ -39,111 +256,16 @@ def get_regions():
     regions['transcription_stop']
     regions['transcription_start']
     regions['transcriptome'] --combined utr3 utr5 and cds
-    This can be factored more, but I'll leave it as is for now
     
-    """
-    path = "/nas3/yeolab/Genome/ensembl/AS_STRUCTURE/hg19data4/"
-    #don't know if exons are coding exons or CDS
-    UTR3 = pybedtools.BedTool(os.path.join(path, "UTR3_hg19_frea_sorted.withscore")).each(trim_names).saveas()
-
-    #also want just the first and last UTR3 element for each transcript...
-    
-    UTR5 = pybedtools.BedTool(os.path.join(path, "UTR5_hg19_frea_sorted.withscore")).each(trim_names).saveas()
- 
-    #also want just the first and last UTR5 element for each transcript...
-    
-    #need start codon - get by looking at last UTR5 region in a gene
-    #I've got my dict stragegy, but I'm not even sure if its right...
-    #need stop codon  - get by looking at first UTR3 location in gene
-    
-    CDS = pybedtools.BedTool(os.path.join(path, "exon_hg19_frea_sorted.withscore")).each(trim_names).saveas()
-    transcription_stop = pybedtools.BedTool(os.path.join(path, "polya_hg19_frea_sorted.withscore")).each(trim_names).saveas()
+    The regions are built the first time an annotation version is seen (see RegionRegistry), 
+    later calls return the same lazily loaded RegionRegistry
     
-    #transcription_start = pybedtools.BedTool(os.path.join(path, "promoter_hg19_frea_sorted.withscore")
-
+    """
     
-    #need to know if this is CDS or total exon...
-    five_prime_sites = CDS.each(get_five_prime_end).saveas()
-    three_prime_sites = CDS.each(get_three_prime_end).saveas()
-    
-    stop_codons = {}
-    for interval in UTR3:
-        if interval.strand == "+":
-            if interval.name not in stop_codons:
-                stop_codons[interval.name] = {"interval" : interval, "stop_codon" : interval.start}
-            stop_codons[interval.name]['stop_codon'] = min(stop_codons[interval.name]['stop_codon'], 
-                                                                       interval.start)
-        else: #strand == -
-            if interval.name not in stop_codons:
-                stop_codons[interval.name] = {"interval" : interval, "stop_codon" : interval.end}
-            stop_codons[interval.name]['stop_codon'] = max(stop_codons[interval.name]['stop_codon'], 
-                                                           interval.end)
-            
-    stop_codons = pybedtools.BedTool([[interval['interval'].chrom, 
-                                       interval['stop_codon'], 
-                                       interval['stop_codon'],  
-                                       interval['interval'].name, 
-                                       interval['interval'].score, 
-                                       interval['interval'].strand] 
-                                      for interval in stop_codons.values()]).saveas()
-    
-    start_codons = {}
-    for interval in UTR5:
-        if interval.strand == "+":
-            if interval.name not in start_codons:
-                start_codons[interval.name] = {"interval" : interval, "start_codon" : interval.end}
-            start_codons[interval.name]['start_codon'] = max(start_codons[interval.name]['start_codon'], 
-                                                             interval.end)
-        else: #strand == -
-            if interval.name not in start_codons:
-                start_codons[interval.name] = {"interval" : interval, "start_codon" : interval.start}
-            start_codons[interval.name]['start_codon'] = min(start_codons[interval.name]['start_codon'], 
-                                                             interval.start)
-            
-    start_codons = pybedtools.BedTool([[interval['interval'].chrom, 
-                                        interval['start_codon'], 
-                                        interval['start_codon'],  
-                                        interval['interval'].name, 
-                                        interval['interval'].score, 
-                                        interval['interval'].strand] 
-                                       for interval in start_codons.values()]).saveas()
-                                       
-    transcription_start = {}
-    for interval in UTR5:
-        if interval.strand == "+":
-            if interval.name not in transcription_start:
-                transcription_start[interval.name] = {"interval" : interval, 
-                                                      "start_codon" : interval.start}
-            transcription_start[interval.name]['start_codon'] = min(transcription_start[interval.name]['start_codon'], 
-                                                                    interval.start)
-        else: #strand == -
-            if interval.name not in transcription_start:
-                transcription_start[interval.name] = {"interval" : interval, "start_codon" : interval.end}
-            transcription_start[interval.name]['start_codon'] = max(transcription_start[interval.name]['start_codon'], 
-                                                                    interval.end)
-            
-    transcription_start = pybedtools.BedTool([[interval['interval'].chrom, 
-                                               interval['start_codon'], 
-                                               interval['start_codon'],  
-                                               interval['interval'].name, 
-                                               interval['interval'].score, 
-                                               interval['interval'].strand] 
-                                              for interval in transcription_start.values()]).saveas()
-    
-    
-    regions = {}
-    regions['UTR3'] = UTR3
-    regions['UTR5'] = UTR5
-    regions['CDS'] = CDS
-    regions['stop_codons'] = stop_codons
-    regions['five_prime_sites'] = five_prime_sites
-    regions['three_prime_sites'] = three_prime_sites
-    regions['stop_codons'] = stop_codons
-    regions['start_codons'] = start_codons
-    regions['transcription_stop'] = transcription_stop
-    regions['transcription_start'] = transcription_start
-    regions['transcriptome'] = UTR3.cat(UTR5, postmerge=False).cat(CDS, postmerge=False)
-    return regions
+    key = (os.path.abspath(path), cache_dir, annotation_version(path))
+    if key not in _registries:
+        _registries[key] = RegionRegistry(path, cache_dir)
+    return _registries[key]
 
 def get_single_gene_name(interval):
 
@@ -154,6 +276,35 @@ def get_single_gene_name(interval):
     interval.name = interval.name.split(";")[0]
     return interval
         
+def merge_by_name(regions):
+    
+    """
+    
+    merges overlapping and book-ended intervals of the same name, chrom and strand
+    (bedtools merge -s -n within each name) 
+    
+    regions - DataFrame with chrom, start, end, name and strand columns
+    returns DataFrame with chrom, start, end, name, count and strand columns
+    
+    """
+    
+    regions = regions.iloc[np.lexsort((regions['start'].values, regions['chrom'].values, 
+                                       regions['strand'].values, regions['name'].values))]
+    keys = ['name', 'strand', 'chrom']
+    same_group = (regions[keys].values[1:] == regions[keys].values[:-1]).all(axis=1)
+    
+    #running max of the ends inside each group, an interval starting past it opens a new block
+    reach = regions.groupby(keys, sort=False)['end'].cummax().values
+    new_block = np.ones(len(regions), dtype=bool)
+    new_block[1:] = ~same_group | (regions['start'].values[1:] > reach[:-1])
+    block = np.cumsum(new_block)
+    
+    grouped = regions.groupby(block, sort=False)
+    merged = grouped.agg({'chrom' : 'first', 'start' : 'min', 'end' : 'max', 
+                          'name' : 'first', 'strand' : 'first'})
+    merged['count'] = grouped.size()
+    return merged[['chrom', 'start', 'end', 'name', 'count', 'strand']].reset_index(drop=True)
+        
 def generate_region_dict(gff, region_name, transcript_gene_dict):
         """
 
@@ -165,50 +316,32 @@ def generate_region_dict(gff, region_name, transcript_gene_dict):
         Region name - name of region to pull out, merge and look at
         transcript_gene_dict -dict {transcript_id : gene_id} (used because gff regions are defined on transcripts and I want genes)
         
+        Regions are read in a single pass and merged in memory, no temp files
+        
         """
 
-        def swap_name_and_chrom(interval):
-            interval.name, interval.chrom = interval.chrom, interval.name
-            return interval
-        
-        merged_region = gff.filter(lambda x:x[2] == region_name).each(rename_to_gene_from_dict, transcript_gene_dict).each(swap_name_and_chrom).merge(s=True, n=True, nms=True).each(swap_name_and_chrom).each(get_single_gene_name)
+        regions = pd.DataFrame.from_records([(interval.chrom, interval.start, interval.end, 
+                                              transcript_gene_dict[interval.attrs['Parent']], 
+                                              interval.strand) 
+                                             for interval in gff if interval[2] == region_name],
+                                            columns=['chrom', 'start', 'end', 'name', 'strand'])
 
         region_dict = defaultdict(list)
+        if len(regions) == 0:
+            return region_dict
         
-        for interval in merged_region:
-            region_dict[interval.name].append((interval))
+        for row in merge_by_name(regions).itertuples(index=False):
+            region_dict[row[3]].append(pybedtools.create_interval_from_list(map(str, row)))
             
         for gene in region_dict.keys():
-            region_dict[gene] = sorted(region_dict[gene], key=lambda x: x.start)
             if region_dict[gene][0].strand == "-":
                 region_dict[gene].reverse()
                 
         return region_dict
 
-import gffutils
-
 #I'll eventually want to factor this into a class, probably
 def gene_id_to_name(db):
-    db = gffutils.FeatureDB(db)
-    genes = db.features_of_type('gene')
-    gene_name_dict = {}
-    for gene in genes:
-        gene_id = gene.attributes['gene_id'][0] if type(gene.attributes['gene_id']) == list else gene.attributes['gene_id']
-        try:
-            gene_name_dict[gene_id] = gene.attributes['gene_name'][0]
-        except KeyError:
-            pass
-    return gene_name_dict
+    return annotation_maps(db)['gene_name']
 
 def gene_id_to_type(db):
-    db = gffutils.FeatureDB(db)
-    genes = db.features_of_type('gene')
-    gene_type_dict = {}
-    for gene in genes:
-        gene_id = gene.attributes['gene_id'][0] if type(gene.attributes['gene_id']) == list else gene.attributes['gene_id']
-        try:
-            gene_type_dict[gene_id] = gene.attributes['gene_type'][0]
-        except KeyError:
-            pass
-    return gene_type_dict
-
+    return annotation_maps(db)['gene_type']
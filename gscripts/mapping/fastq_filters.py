@@ -1,13 +1,12 @@
 __author__ = 'olga'
 
-from glob import iglob, glob
 from gscripts.qtools._Submitter import Submitter
 import sys
 import os
 import argparse
 from glob import glob
 import sys
-from gscripts.qtools._Submitter import Submitter
+from gscripts.qtools._Submitter import Submitter, file_size_costs
 
 
 class CommandLine(object):
@@ -40,6 +39,11 @@ class CommandLine(object):
                             action='store', default='./',
                             help='Directory where the bam files are. Default '
                                  'is the current directory.')
+        parser.add_argument('--packed-tasks', required=False, type=int,
+                            action='store', default=None,
+                            help='Pack the fastq files into this many array '
+                                 'tasks, balanced by file size, instead of '
+                                 'one task per file')
 
         if inOpts is None:
             self.args = vars(self.parser.parse_args())
@@ -72,14 +76,16 @@ class Usage(Exception):
 
 
 class FastqFilters(object):
-    def __init__(self, job_name, out_sh, submit=False, directory='./'):
+    def __init__(self, job_name, out_sh, submit=False, directory='./',
+                 packed_tasks=None):
         try:
             os.mkdir('{}/filtered/'.format(directory.rstrip('/')))
         except OSError:
             pass
 
         commands = []
-        for filename in iglob('{}/*.fastq.gz'.format(directory.rstrip('/'))):
+        filenames = glob('{}/*.fastq.gz'.format(directory.rstrip('/')))
+        for filename in filenames:
             #TODO: the -l argument "20" should be a % of read length
             commands.append('echo {0}; zcat {0} | fastx_artifacts_filter | '
                             'fastq_quality_trimmer -l 20 -t 30 | '
@@ -90,7 +96,10 @@ class FastqFilters(object):
                         commands=commands,
                         job_name=job_name, nodes=1, ppn=2, queue='home',
                         array=True,
-                        max_running=20, walltime='1:00:00')
+                        max_running=20, walltime='1:00:00',
+                        pack=packed_tasks is not None,
+                        costs=file_size_costs(filenames) if packed_tasks is not None else None,
+                        packed_tasks=packed_tasks)
 
         sub.write_sh(submit=submit)
 
@@ -104,6 +113,7 @@ if __name__ == '__main__':
     submit = not cl.args['do_not_submit']
     directory = cl.args['directory'].rstrip('/')
 
-    FastqFilters(job_name, out_sh, submit, directory)
+    FastqFilters(job_name, out_sh, submit, directory,
+                 packed_tasks=cl.args['packed_tasks'])
 
 
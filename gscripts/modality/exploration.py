@@ -1,3 +1,5 @@
+import warnings
+
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
@@ -7,11 +9,63 @@ import brewer2mpl
 from itertools import cycle
 
 from sklearn.decomposition import PCA
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial.distance import cdist
 from sklearn.cluster import AffinityPropagation, KMeans, DBSCAN, \
     spectral_clustering
 
 
+def bin_counts(psi, bins, chunk_size=10000):
+    """
+    Count the psi scores of every event (row) in each bin, like np.histogram
+    on each row but for all rows at once. NaNs and scores outside the bins
+    are not counted.
+
+    psi is an events x cells array or DataFrame. Returns an events x bins
+    array of the smallest unsigned int type that can hold the number of
+    cells (uint8 for up to 255 cells).
+    """
+    psi = np.asarray(psi)
+    nrow, ncell = psi.shape
+    nbins = len(bins) - 1
+    counts = np.zeros((nrow, nbins), dtype=np.min_scalar_type(ncell))
+    for start in xrange(0, nrow, chunk_size):
+        chunk = psi[start:start + chunk_size]
+        # same edges as np.histogram, the last bin includes its right edge
+        which = np.searchsorted(bins, chunk, side='right') - 1
+        which[chunk == bins[-1]] = nbins - 1
+        valid = (which >= 0) & (which < nbins) & ~np.isnan(chunk)
+        rows = np.nonzero(valid)[0]
+        counts[start:start + chunk.shape[0]] = np.bincount(
+            rows * nbins + which[valid],
+            minlength=chunk.shape[0] * nbins).reshape(-1, nbins)
+    return counts
+
+
+def binned_density(counts, bins):
+    """float32 densities from bin_counts, the same as np.histogram(...,
+    normed=True) on each event"""
+    widths = np.diff(bins).astype(np.float32)
+    totals = counts.sum(axis=1).astype(np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / totals[:, np.newaxis] / widths
+
+
+def pairwise_distances(X, metric='euclidean', chunk_size=1000, out=None):
+    """
+    Square float32 distance matrix between the rows of X, computed
+    chunk_size rows at a time. out can be an array to fill, e.g. a
+    np.lib.format.open_memmap for too many rows to keep in memory.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    nrow = X.shape[0]
+    if out is None:
+        out = np.empty((nrow, nrow), dtype=np.float32)
+    for start in xrange(0, nrow, chunk_size):
+        out[start:start + chunk_size] = cdist(X[start:start + chunk_size], X,
+                                              metric=metric)
+    return out
+
+
 class Data(object):
     def __init__(self, psi, n_components, step=0.1):
         self.psi = psi
@@ -22,13 +76,10 @@ class Data(object):
         self.reduce()
 
     def binify(self):
+        """self.counts: events x bins counts, self.binned: their densities"""
         self.bins = np.arange(0, 1 + self.step, self.step)
-        ncol = int(1 / self.step)
-        nrow = self.psi.shape[0]
-        self.binned = np.zeros((nrow, ncol))
-        for i, (name, row) in enumerate(self.psi.iterrows()):
-            self.binned[i, :] = np.histogram(row, bins=self.bins, normed=True)[
-                0]
+        self.counts = bin_counts(self.psi.values, self.bins)
+        self.binned = binned_density(self.counts, self.bins)
 
     def reduce(self):
         self.pca_psi = PCA(n_components=self.n_components).fit(
@@ -52,8 +103,18 @@ class Data(object):
         ax.set_title(title)
         sns.despine()
 
-    def calculate_distances(self, metric='euclidean'):
-        self.pdist = squareform(pdist(self.binned, metric=metric))
+    def calculate_distances(self, metric='euclidean', chunk_size=1000,
+                            filename=None):
+        """Distances between the binned events. Give a .npy filename to
+        keep the matrix on disk (memory-mapped) instead of in memory."""
+        out = None
+        if filename is not None:
+            nrow = self.binned.shape[0]
+            out = np.lib.format.open_memmap(filename, mode='w+',
+                                            dtype=np.float32,
+                                            shape=(nrow, nrow))
+        self.pdist = pairwise_distances(self.binned, metric=metric,
+                                        chunk_size=chunk_size, out=out)
 
 
 def switchy_score(array):
@@ -71,9 +132,19 @@ def switchy_score(array):
     return variance * mean_value
 
 
+def switchy_scores(x, axis=0):
+    """switchy_score of every column (axis=0) or row (axis=1) of x at once"""
+    x = np.asarray(x, dtype=float) * np.pi
+    with warnings.catch_warnings():
+        # all-NaN columns get a NaN score, like switchy_score
+        warnings.simplefilter('ignore', RuntimeWarning)
+        variance = 1 - np.nanstd(np.sin(x), axis=axis)
+        mean_value = -np.nanmean(np.cos(x), axis=axis)
+    return variance * mean_value
+
+
 def get_switchy_score_order(x):
-    switchy_scores = np.apply_along_axis(switchy_score, axis=0, arr=x)
-    return np.argsort(switchy_scores)
+    return np.argsort(switchy_scores(x, axis=0))
 
 
 class ClusteringTester(object):
@@ -1,10 +1,43 @@
 __author__ = 'Patrick Liu and Olga Botvinnik'
+import cPickle as pickle
+from multiprocessing import Pool
+import os
 import pandas as pd
 import string
 import glob
 import numpy as np
 import sys
 
+# Numeric fields of STAR's Log.final.out, in file order. Newer STAR versions
+# add the chimeric line, older ones just leave it out.
+STAR_FIELDS = ['Mapping speed, Million of reads per hour',
+               'Number of input reads',
+               'Average input read length',
+               'Uniquely mapped reads number',
+               'Uniquely mapped reads %',
+               'Average mapped length',
+               'Number of splices: Total',
+               'Number of splices: Annotated (sjdb)',
+               'Number of splices: GT/AG',
+               'Number of splices: GC/AG',
+               'Number of splices: AT/AC',
+               'Number of splices: Non-canonical',
+               'Mismatch rate per base, %',
+               'Deletion rate per base',
+               'Deletion average length',
+               'Insertion rate per base',
+               'Insertion average length',
+               'Number of reads mapped to multiple loci',
+               '% of reads mapped to multiple loci',
+               'Number of reads mapped to too many loci',
+               '% of reads mapped to too many loci',
+               '% of reads unmapped: too many mismatches',
+               '% of reads unmapped: too short',
+               '% of reads unmapped: other',
+               'Number of chimeric reads',
+               '% of chimeric reads']
+STAR_FIELD_INDEX = dict((field, i) for i, field in enumerate(STAR_FIELDS))
+
 class Collector(object):
     def __init__(self, base_name=None):
         self.base_name = base_name
@@ -276,3 +309,112 @@ def log_final_out(glob_command, ids_function):
     #print 'percent_splicing'
     #print percent_splicing
     return pd.concat((mapping_stats, percent_splicing))
+
+
+def parse_log_final_out(filename):
+    """
+    Parse the numeric fields of one STAR Log.final.out into an array ordered
+    like STAR_FIELDS, with NaN for fields that aren't in the file
+    """
+    values = np.empty(len(STAR_FIELDS))
+    values.fill(np.nan)
+    with open(filename) as f:
+        for line in f:
+            key, sep, value = line.partition('|')
+            if not sep:
+                continue
+            i = STAR_FIELD_INDEX.get(key.strip())
+            if i is None:
+                continue
+            try:
+                values[i] = float(value.strip().rstrip('%'))
+            except ValueError:
+                pass
+    return values
+
+
+def _file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+
+def log_final_out_bulk(glob_command, ids_function, processes=1,
+                       cache_file=None):
+    """
+    Faster log_final_out for many files (e.g. single cell projects): the
+    numeric fields of every Log.final.out are parsed with a line parser in a
+    process pool into one preallocated array, and the percent splicing rows
+    are computed on the whole array at once. The started/finished dates are
+    not included.
+
+    @param glob_command: A string that will be passed to glob
+    @param ids_function: A function that gets the sample ID from the
+    filename, or a list of IDs in the same order as the globbed files
+    @param processes: Number of processes to parse files with
+    @param cache_file: Pickle file to keep parsed files in between runs.
+    Files whose modification time and size haven't changed aren't parsed
+    again.
+    """
+    filenames = glob.glob(glob_command)
+
+    if isinstance(ids_function, list):
+        ids = ids_function
+    else:
+        ids = [ids_function(filename) for filename in filenames]
+
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = pickle.load(f)
+        if cache.get('fields') != STAR_FIELDS:
+            cache = {}
+    parsed = cache.get('files', {})
+
+    signatures = [_file_signature(filename) for filename in filenames]
+    todo = [filename for filename, signature in zip(filenames, signatures)
+            if filename not in parsed or parsed[filename][0] != signature]
+    if len(todo) > 0:
+        if processes > 1:
+            pool = Pool(processes)
+            try:
+                new_values = pool.map(parse_log_final_out, todo,
+                                      chunksize=max(1, len(todo) //
+                                                    (4 * processes)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            new_values = [parse_log_final_out(filename) for filename in todo]
+        for filename, values in zip(todo, new_values):
+            parsed[filename] = (_file_signature(filename), values)
+        if cache_file is not None:
+            with open(cache_file, 'w') as f:
+                pickle.dump({'fields': STAR_FIELDS, 'files': parsed}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+    stats = np.empty((len(STAR_FIELDS), len(filenames)))
+    for j, filename in enumerate(filenames):
+        stats[:, j] = parsed[filename][1]
+
+    mapping_stats = pd.DataFrame(stats, index=STAR_FIELDS,
+                                 columns=make_unique(ids))
+    mapping_stats = mapping_stats.dropna(how='all')
+    mapping_stats = fix_duplicate_columns(mapping_stats)
+
+    # Turn all the number of splicing events into percentages for statistical
+    # testing
+    number_splicing_event_names = ['Number of splices: Annotated (sjdb)',
+                                   'Number of splices: GT/AG',
+                                   'Number of splices: GC/AG',
+                                   'Number of splices: AT/AC',
+                                   'Number of splices: Non-canonical']
+    percent_splicing_event_names = [x.replace('Number of', '%')
+                                    for x in number_splicing_event_names]
+    values = mapping_stats.loc[number_splicing_event_names].values.astype(
+        float)
+    total_splicing_events = mapping_stats.loc[
+        'Number of splices: Total'].replace(0, np.nan).values.astype(float)
+    percent_splicing = pd.DataFrame(100.0 * values / total_splicing_events,
+                                    index=percent_splicing_event_names,
+                                    columns=mapping_stats.columns)
+    return pd.concat((mapping_stats, percent_splicing))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+__author__ = 'Patrick Liu, Olga Botvinnik, Michael Lovci '
+
+import os
+import sys
+
+from _Submitter import Submitter
+
+
+class PipelineStep(object):
+    """One job of a Pipeline: its commands, the steps it depends on and
+    the files it reads and writes
+    """
+
+    def __init__(self, name, commands, depends_on=(), inputs=(), outputs=(),
+                 **submitter_kwargs):
+        self.name = name
+        self.commands = commands
+        self.depends_on = list(depends_on)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.submitter_kwargs = submitter_kwargs
+
+    @property
+    def up_to_date(self):
+        """True if every output exists and is newer than every input. Steps
+        without outputs are never up to date.
+        """
+        if not self.outputs:
+            return False
+        if not all(os.path.exists(x) for x in self.outputs + self.inputs):
+            return False
+        oldest_output = min(os.path.getmtime(x) for x in self.outputs)
+        newest_input = max([os.path.getmtime(x) for x in self.inputs] or [0])
+        return oldest_output >= newest_input
+
+
+class Pipeline(object):
+    """
+    Submit a set of dependent jobs to the scheduler in one go
+
+    Each step becomes one Submitter job. Steps are submitted in topological
+    order and each one is held by the scheduler until the steps it depends
+    on finish without errors (PBS "-W depend=afterok/afterokarray",
+    SGE "-hold_jid", or waiting on the LocalJob for queue_type="LOCAL").
+    Steps whose outputs are all newer than their inputs are skipped, unless
+    a step they depend on is being re-run.
+
+    How to use:
+
+        pipeline = Pipeline(queue_type='PBS', walltime='2:00:00')
+        pipeline.add_step('psi', psi_commands, array=True,
+                          inputs=bams, outputs=psi_files)
+        pipeline.add_step('summarize', summary_commands,
+                          depends_on=['psi'], inputs=psi_files,
+                          outputs=summary_files)
+        job_ids = pipeline.submit()
+    """
+
+    def __init__(self, **submitter_kwargs):
+        """
+        Parameters
+        ----------
+        submitter_kwargs :
+            Default keyword arguments for every step's Submitter, e.g.
+            queue_type, walltime, ppn. Steps can override them.
+        """
+        self.submitter_kwargs = submitter_kwargs
+        self.steps = []
+        self._steps = {}
+
+    def add_step(self, name, commands, depends_on=(), inputs=(), outputs=(),
+                 **submitter_kwargs):
+        """
+        Add a job to the pipeline
+
+        Parameters
+        ----------
+        name : str
+            Unique name of the step, also the default job name
+        commands : list of strings
+            Commands of the job, see Submitter
+        depends_on : list of str
+            Names of steps that have to finish without errors first
+        inputs : list of str
+            Files the step reads
+        outputs : list of str
+            Files the step writes. If they are all newer than the inputs,
+            the step is skipped.
+        submitter_kwargs :
+            Extra Submitter keyword arguments for this step (array,
+            walltime, ...)
+
+        Returns
+        -------
+        step : PipelineStep
+
+        Raises
+        ------
+        ValueError : if a step with this name was already added
+        """
+        if name in self._steps:
+            raise ValueError('Step {} was already added'.format(name))
+        step = PipelineStep(name, commands, depends_on, inputs, outputs,
+                            **submitter_kwargs)
+        self.steps.append(step)
+        self._steps[name] = step
+        return step
+
+    def ordered_steps(self):
+        """Steps in topological order, ties kept in the order they were added
+
+        Raises
+        ------
+        ValueError : if a step depends on an unknown step or there is a cycle
+        """
+        for step in self.steps:
+            for dependency in step.depends_on:
+                if dependency not in self._steps:
+                    raise ValueError('Step {} depends on unknown step {}'
+                                     .format(step.name, dependency))
+        ordered = []
+        done = set()
+        remaining = list(self.steps)
+        while remaining:
+            ready = [step for step in remaining
+                     if all(x in done for x in step.depends_on)]
+            if not ready:
+                raise ValueError('Dependency cycle between steps: {}'.format(
+                    ', '.join(step.name for step in remaining)))
+            for step in ready:
+                ordered.append(step)
+                done.add(step.name)
+            remaining = [step for step in remaining if step.name not in done]
+        return ordered
+
+    def submitter(self, step):
+        """Submitter for a single step, without dependencies"""
+        kwargs = dict(self.submitter_kwargs)
+        kwargs.update(step.submitter_kwargs)
+        kwargs.setdefault('job_name', step.name)
+        return Submitter(step.commands, **kwargs)
+
+    def submit(self, submit=True):
+        """
+        Write (and submit) every step that is not up to date
+
+        Parameters
+        ----------
+        submit : bool
+            Whether or not to submit the jobs, or only write their scripts
+
+        Returns
+        -------
+        job_ids : dict
+            Step name to job ID (or LocalJob, or list of IDs for arrays split
+            into several jobs). Skipped steps are not included.
+        """
+        job_ids = {}
+        arrays = {}
+        for step in self.ordered_steps():
+            rerun_dependency = any(x in job_ids for x in step.depends_on)
+            if step.up_to_date and not rerun_dependency:
+                sys.stderr.write('skipping {}, outputs are up to date\n'
+                                 .format(step.name))
+                continue
+
+            sub = self.submitter(step)
+            for dependency in step.depends_on:
+                if dependency not in job_ids:
+                    continue
+                wait_IDs = job_ids[dependency]
+                if not isinstance(wait_IDs, list):
+                    wait_IDs = [wait_IDs]
+                for wait_ID in wait_IDs:
+                    # job() returns 0 when nothing was submitted
+                    if wait_ID:
+                        sub.add_wait(wait_ID, array=arrays[dependency])
+            job_ids[step.name] = sub.job(submit=submit)
+            arrays[step.name] = bool(sub.array)
+        return job_ids
@@ -20,6 +20,9 @@ __author__ = 'Patrick Liu, Olga Botvinnik, Michael Lovci '
 
 
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import heapq
+import os
 import re
 import math
 import subprocess
@@ -33,6 +36,134 @@ HOSTNAME = subprocess.Popen('hostname', stdout=subprocess.PIPE).communicate()[
 MAX_ARRAY_JOBS = 500
 
 
+def walltime_seconds(walltime):
+    """Seconds in a walltime string of the format hours:minutes:seconds"""
+    seconds = 0
+    for field in walltime.split(':'):
+        seconds = seconds * 60 + int(field)
+    return seconds
+
+
+def file_size_costs(filenames):
+    """Sizes of the input files of a list of commands, to use as their
+    costs when packing. Missing files cost 0.
+    """
+    return [os.path.getsize(f) if os.path.exists(f) else 0
+            for f in filenames]
+
+
+def pack_commands(commands, n_bins, costs=None):
+    """Split commands into n_bins groups with about equal total cost
+
+    Longest-processing-time-first: the most expensive remaining command
+    goes to the group with the smallest total so far.
+
+    Parameters
+    ----------
+    commands : list of strings
+    n_bins : int
+        Number of groups. Empty groups are dropped.
+    costs : list of numbers
+        Estimated cost of each command, e.g. input file size or seconds.
+        Default 1 for all.
+
+    Returns
+    -------
+    bins : list of lists of strings
+        Commands of each group, in their original order
+    """
+    if costs is None:
+        costs = [1] * len(commands)
+    if len(costs) != len(commands):
+        raise ValueError('Need one cost per command, got {} costs for {} '
+                         'commands'.format(len(costs), len(commands)))
+    n_bins = max(1, min(n_bins, len(commands)))
+    heap = [(0, i) for i in range(n_bins)]
+    members = [[] for i in range(n_bins)]
+    for index in sorted(range(len(commands)), key=lambda i: -costs[i]):
+        load, i = heapq.heappop(heap)
+        members[i].append(index)
+        heapq.heappush(heap, (load + costs[index], i))
+    return [[commands[index] for index in sorted(indices)]
+            for indices in members if indices]
+
+
+class LocalJob(object):
+    """
+    Handle on a job run by Submitter on this machine (queue_type='LOCAL')
+
+    Every task runs the written sh file with bash, with $PBS_ARRAYID and
+    $SGE_TASK_ID set to the task number, so array jobs behave the same as on
+    the cluster. At most max_running tasks run at once. Tasks start once
+    every LocalJob in wait_for has succeeded; if one failed they are skipped
+    and get a returncode of None.
+    """
+
+    def __init__(self, sh_filename, job_name, number_jobs, array,
+                 out_filename, err_filename, max_running=None, wait_for=()):
+        self.sh_filename = sh_filename
+        self.wait_for = list(wait_for)
+        self.job_name = job_name
+        self.job_id = 'local.{}.{}'.format(os.getpid(), job_name)
+        self.array = array
+        self.out_filename = out_filename
+        self.err_filename = err_filename
+        self.tasks = range(1, number_jobs + 1)
+        self.max_running = len(self.tasks) if max_running is None \
+            else max_running
+        self._pool = ThreadPool(max(1, min(self.max_running,
+                                           len(self.tasks))))
+        self._result = self._pool.map_async(self._run_task, self.tasks)
+        self._pool.close()
+
+    def task_filenames(self, task_id):
+        """stdout and stderr files of a task. Array tasks get "-<task_id>"
+        appended, like PBS does for array jobs with -o/-e
+        """
+        if self.array:
+            return ('{}-{}'.format(self.out_filename, task_id),
+                    '{}-{}'.format(self.err_filename, task_id))
+        return self.out_filename, self.err_filename
+
+    def _run_task(self, task_id):
+        # Same as afterok: tasks of a job whose dependencies failed never run
+        if not all(job.successful() for job in self.wait_for):
+            return None
+        env = dict(os.environ)
+        env['PBS_ARRAYID'] = str(task_id)
+        env['SGE_TASK_ID'] = str(task_id)
+        env['PBS_O_WORKDIR'] = os.getcwd()
+        env['PBS_JOBID'] = self.job_id
+        env['JOB_ID'] = self.job_id
+        out_filename, err_filename = self.task_filenames(task_id)
+        with open(out_filename, 'w') as out, open(err_filename, 'w') as err:
+            return subprocess.call(['bash', self.sh_filename], stdout=out,
+                                   stderr=err, env=env)
+
+    def ready(self):
+        """Whether all tasks have finished"""
+        return self._result.ready()
+
+    def wait(self):
+        """Block until all tasks have finished
+
+        Returns
+        -------
+        returncodes : list of int
+            Exit status of each task, in task order
+        """
+        returncodes = self._result.get()
+        self._pool.join()
+        return returncodes
+
+    def successful(self):
+        """Whether every task exited with status 0. Waits for the job."""
+        return all(code == 0 for code in self.wait())
+
+    def __str__(self):
+        return self.job_id
+
+
 class Submitter(object):
     """
     Class that will customize and submit shell scripts
@@ -47,7 +178,9 @@ class Submitter(object):
                  array=None, nodes=1, ppn=1,
                  walltime='0:30:00', queue='home', account='yeo-group',
                  out_filename=None, err_filename=None,
-                 max_running=None, write_and_submit=False):
+                 max_running=None, write_and_submit=False,
+                 wait_for=None, wait_for_array=None,
+                 pack=False, costs=None, packed_tasks=None):
         """Constructor method, will initialize class attributes to passed
         keyword arguments and values.
 
@@ -63,7 +196,9 @@ class Submitter(object):
         job_name : str
             Name of the job for the queue list
         queue_type : str
-            Type of the submission queue, either "PBS" (tscc) or "SGE" (oolite)
+            Type of the submission queue, either "PBS" (tscc), "SGE" (oolite)
+            or "LOCAL" to run the commands on this machine without a
+            scheduler
         sh_filename : str
             File to write that will be submitted to the queue. By default,
             the job name + .sh
@@ -89,12 +224,30 @@ class Submitter(object):
             Where to write stderr for the job. Defaults to sh_file.err
         max_running : int
             Maximum number of jobs running at once for an array job. 20 is
-            reasonable.
+            reasonable. With queue_type="LOCAL" this is the number of tasks
+            run in parallel, default all of them.
         write_and_submit : bool
             Whether or not to also write and submit the script. Just
             instantiating this object does NOT submit any job. Need to do
             Submitter.job() afterwards. This is a convenience method for when
             submitting an array job with more than 500 commands.
+        wait_for : list
+            Job IDs this job waits on, they must finish without errors
+            before it starts. See add_wait.
+        wait_for_array : list
+            Array job IDs this job waits on. See add_wait.
+        pack : bool
+            Pack the commands into a few array tasks instead of one task per
+            command. Each task runs its share of the commands, up to ppn at a
+            time. Use for many short commands, so the scheduler overhead is
+            paid per task rather than per command.
+        costs : list of numbers
+            With pack=True, estimated cost of each command (e.g. input file
+            size from file_size_costs, or seconds) used to balance the tasks.
+            If packed_tasks is not given, costs are taken as seconds and the
+            number of tasks is chosen so each fits in walltime.
+        packed_tasks : int
+            With pack=True, the number of array tasks to pack commands into.
 
 
         Returns
@@ -136,6 +289,15 @@ class Submitter(object):
             else err_filename
         self.account = account
         self.max_running = max_running
+        self.pack = pack
+        self.costs = costs
+        self.packed_tasks = packed_tasks
+        self.wait_for = []
+        self.wait_for_array = []
+        for wait_ID in wait_for or []:
+            self.add_wait(wait_ID)
+        for wait_ID in wait_for_array or []:
+            self.add_wait(wait_ID, array=True)
 
         if write_and_submit:
             self.job(submit=True)
@@ -184,20 +346,85 @@ class Submitter(object):
 
     @property
     def array_job_identifier(self):
-        if self.queue_type == 'PBS':
+        if self.queue_type in ('PBS', 'LOCAL'):
             return "$PBS_ARRAYID"
         elif self.queue_type == 'SGE':
             return "$SGE_TASK_ID"
 
-    def add_wait(self, wait_ID):
+    @property
+    def number_packed_tasks(self):
+        """Number of array tasks to pack the commands into"""
+        if self.packed_tasks is not None:
+            return self.packed_tasks
+        if self.costs is None:
+            raise ValueError('Packing needs either packed_tasks or costs')
+        # Costs are seconds, fill each task's walltime on all its processors
+        capacity = walltime_seconds(self.walltime) * self.ppn
+        return int(math.ceil(sum(self.costs) / float(capacity)))
+
+    def packed_commands(self):
+        """Write one file of commands per packed task and return the array
+        commands that run each file, ppn commands at a time. A task fails if
+        any of its commands fail.
+        """
+        bins = pack_commands(self.commands, self.number_packed_tasks,
+                             self.costs)
+        commands = []
+        for i, commands_bin in enumerate(bins):
+            bin_filename = '{}.pack{}.txt'.format(self.sh_filename, i + 1)
+            with open(bin_filename, 'w') as f:
+                for command in commands_bin:
+                    f.write(str(command) + '\n')
+            commands.append("xargs -d '\\n' -P {} -I CMD bash -c CMD < {}"
+                            .format(self.ppn, bin_filename))
+        sys.stderr.write("packed %d commands into %d tasks.\n" % (
+            len(self.commands), len(commands)))
+        return commands
+
+    def add_wait(self, wait_ID, array=False):
         """
         Add passed job ID to list of jobs for this job submission to
         wait for. Can be called multiple times.
+
+        Parameters
+        ----------
+        wait_ID : str or LocalJob
+            Job to wait for. For queue_type="LOCAL" this is the LocalJob
+            returned by job(submit=True).
+        array : bool
+            Whether wait_ID is an array job, in which case this job waits
+            for all of its tasks (PBS "afterokarray"). SGE's -hold_jid
+            covers both.
         """
-        if 'wait_for' not in self.data:
-            self.data['wait_for'] = []
+        if isinstance(wait_ID, LocalJob):
+            self.wait_for.append(wait_ID)
+        elif array:
+            self.wait_for_array.append(str(wait_ID))
+        else:
+            self.wait_for.append(str(wait_ID))
 
-        self.data['wait_for'].append(str(wait_ID))
+    @property
+    def dependency_lines(self):
+        """Scheduler directives for the jobs added with add_wait"""
+        lines = []
+        wait_for = [str(x) for x in self.wait_for
+                    if not isinstance(x, LocalJob)]
+        if self.queue_type == 'PBS':
+            # One -W depend line, later ones would replace earlier ones.
+            # job() returns the number of the array job, Torque wants
+            # arrayid[] (all tasks) or arrayid[count], see the top of the file
+            depend = ['afterokarray:{}'.format(
+                array_id if '[' in array_id else array_id + '[]')
+                      for array_id in self.wait_for_array]
+            if wait_for:
+                depend.insert(0, 'afterok:{}'.format(':'.join(wait_for)))
+            if depend:
+                lines.append('-W depend={}'.format(','.join(depend)))
+        elif self.queue_type == 'SGE':
+            hold = wait_for + self.wait_for_array
+            if hold:
+                lines.append('-hold_jid {}'.format(','.join(hold)))
+        return lines
 
     def add_resource(self, kw, value):
         """
@@ -222,19 +449,37 @@ class Submitter(object):
 
         Returns
         -------
-        job_id : int
-            Identifier of the job in the queue
+        job_id : int or LocalJob
+            Identifier of the job in the queue. With queue_type="LOCAL",
+            a LocalJob handle to wait on.
 
         Raises
         ------
 
         """
+        if self.pack:
+            sub = Submitter(self.packed_commands(), self.job_name,
+                            queue_type=self.queue_type,
+                            sh_filename=self.sh_filename, array=True,
+                            nodes=self.nodes, ppn=self.ppn,
+                            walltime=self.walltime, queue=self.queue,
+                            account=self.account,
+                            out_filename=self.out_filename,
+                            err_filename=self.err_filename,
+                            max_running=self.max_running,
+                            wait_for=self.wait_for,
+                            wait_for_array=self.wait_for_array)
+            sub.additional_resources = self.additional_resources
+            return sub.job(submit=submit)
+
         # PBS/TSCC does not allow array jobs with more than 500 commands
-        if len(self.commands) > MAX_ARRAY_JOBS and self.array:
+        if len(self.commands) > MAX_ARRAY_JOBS and self.array \
+                and self.queue_type != 'LOCAL':
             commands = self.commands
             name = self.job_name
             commands_list = [commands[i:(i + MAX_ARRAY_JOBS)]
                              for i in xrange(0, len(commands), MAX_ARRAY_JOBS)]
+            job_ids = []
             for i, commands in enumerate(commands_list):
                 job_name = '{}{}'.format(name, i + 1)
                 sh_filename = '{}{}.sh'.format(self.sh_filename.rstrip('.sh'),
@@ -244,20 +489,26 @@ class Submitter(object):
                                 walltime=self.walltime, ppn=self.ppn,
                                 nodes=self.nodes, queue=self.queue,
                                 queue_type=self.queue_type,
-                                write_and_submit=True)
+                                wait_for=self.wait_for,
+                                wait_for_array=self.wait_for_array)
+                job_ids.append(sub.job(submit=submit))
                 # sub.write_sh(**kwargs)
-            return
+            return job_ids
 
         # sys.stderr.write(self.sh_filename)
         sh_file = open(self.sh_filename, 'w')
         sh_file.write("#!/bin/bash\n")
 
-        sh_file.write("%s -N %s\n" % (self.queue_param_prefix, self.job_name))
-        sh_file.write("%s -o %s\n" % (self.queue_param_prefix,
-                                      self.out_filename))
-        sh_file.write("%s -e %s\n" % (self.queue_param_prefix,
-                                      self.err_filename))
-        sh_file.write("%s -V\n" % self.queue_param_prefix)
+        if self.queue_type == 'LOCAL':
+            self._write_local(sh_file)
+        else:
+            sh_file.write("%s -N %s\n" % (self.queue_param_prefix,
+                                          self.job_name))
+            sh_file.write("%s -o %s\n" % (self.queue_param_prefix,
+                                          self.out_filename))
+            sh_file.write("%s -e %s\n" % (self.queue_param_prefix,
+                                          self.err_filename))
+            sh_file.write("%s -V\n" % self.queue_param_prefix)
 
         if self.queue_type == 'SGE':
             self._write_sge(sh_file)
@@ -278,7 +529,15 @@ class Submitter(object):
         sh_file.write('\n')
 
         sh_file.close()
-        if submit:
+        if submit and self.queue_type == 'LOCAL':
+            job = LocalJob(self.sh_filename, self.job_name, self.number_jobs,
+                           self.array, self.out_filename, self.err_filename,
+                           max_running=self.max_running,
+                           wait_for=[x for x in self.wait_for
+                                     if isinstance(x, LocalJob)])
+            sys.stderr.write("job ID: %s\n" % job.job_id)
+            return job
+        elif submit:
             p = subprocess.Popen(["qsub", self.sh_filename],
                                  stdout=PIPE)
             output = p.communicate()[0].strip()
@@ -309,6 +568,7 @@ class Submitter(object):
         #                  self.queue_param_prefix)
 
         self._write_additional_resources(sh_file)
+        self._write_dependencies(sh_file)
 
         if self.array:
             if self.max_running is not None:
@@ -325,6 +585,14 @@ class Submitter(object):
         sh_file.write("cd $PBS_O_WORKDIR\n")
         # self.array_job_identifier = "$PBS_ARRAYID"
 
+    def _write_local(self, sh_file):
+        """Local (no scheduler) header, just moves to the submission
+        directory like PBS does
+        """
+        sh_file.write("# %s: run locally by gscripts.qtools\n" %
+                      self.job_name)
+        sh_file.write("cd $PBS_O_WORKDIR\n")
+
     def _write_sge(self, sh_file):
         """SGE-queue (oolit) specific header formatting
         """
@@ -332,6 +600,11 @@ class Submitter(object):
         sh_file.write("%s -S /bin/bash\n" % self.queue_param_prefix)
         sh_file.write("%s -cwd\n" % self.queue_param_prefix)
         self._write_additional_resources(sh_file)
+        self._write_dependencies(sh_file)
+
+    def _write_dependencies(self, sh_file):
+        for line in self.dependency_lines:
+            sh_file.write("%s %s\n" % (self.queue_param_prefix, line))
 
 
     def _write_additional_resources(self, sh_file):
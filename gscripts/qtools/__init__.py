@@ -1,3 +1,4 @@
 __author__ = 'olga'
 
-from _Submitter import *
\ No newline at end of file
+from _Submitter import *
+from _Pipeline import *
@@ -1,64 +1,158 @@
 #This script requieres at least a BED-4 (a unique name) to run properly
 #need to figure out how to handle arbitray bed files...
-#This is actually to slow to run efficently 
+#Reads are projected by a single sweep of the sorted reads over a sorted exon index (see TranscriptProjector)
 import sys
-import pybedtools
-
-
-def convert_to_mRNA(feature):
-    pass
-
-def makeStarts(feature):
-    feature.end = feature.start + 1
-    return feature
-
-def makeEnds(feature):
-    feature.start = feature.end - 1
-    return feature
-
-def convert_to_mRNA(feature):
-    feature.chrom = feature[10]
-        
-    if feature.strand == "+":
-        #start of exon location in mRNA + distance from exon start in genomic rna
-        start = int(feature[11]) + (int(feature.start) - int(feature[7]))
-        end   = int(feature[11]) + (int(feature.end) - int(feature[7]))
-        
-    else: #strand = -
-        
-        start = int(feature[11]) + (int(feature[8]) - int(feature.end))
-        end   = int(feature[11]) + (int(feature[8]) - int(feature.start))
-        
-    feature.start = start
-    feature.end   = end
-    return feature
+from collections import defaultdict
+from optparse import OptionParser
+
+
+def read_exons(exon_file):
+
+    """
+
+    reads the transcript exon index: chrom, start, end, strand, transcript, mRNA position of
+    the exon's 5' end (the layout ensMapper.sh expects)
+
+    returns dict chrom : list of (start, end, strand, transcript, mRNA offset) sorted by start
+
+    """
+
+    exons = defaultdict(list)
+    for line in open(exon_file):
+        line = line.split()
+        if len(line) < 6 or line[0].startswith(("#", "track", "browser")):
+            continue
+        exons[line[0]].append((int(line[1]), int(line[2]), line[3], line[4], int(line[5])))
+    for chrom_exons in exons.values():
+        chrom_exons.sort()
+    return dict(exons)
+
+def mRNA_position(exon, position):
+
+    """
+
+    mRNA coordinate of a genomic position inside an exon
+
+    """
+
+    start, end, strand, transcript, offset = exon
+    if strand == "+":
+        return offset + position - start
+    return offset + end - 1 - position
+
+class TranscriptProjector(object):
+
+    """
+
+    Projects reads onto mRNA coordinates of every transcript that has exons under both
+    the first and the last base of the read
+
+    Reads have to be sorted by chrom (any order, but each chrom in one block) and start.
+    The sweep keeps a window of the exons overlapping the current read, plus a lookahead up
+    to its last base, so no exon a later read could land on is passed over.  Reads out of
+    order raise ValueError instead of being silently dropped.
+
+    """
+
+    def __init__(self, exons):
+
+        """
+
+        exons - dict from read_exons
+
+        """
+
+        self.exons = exons
+        self.n_reads = 0
+        self.n_projected = 0
+        self.n_records = 0
+
+    def project(self, reads, unplaced=None):
+
+        """
+
+        reads - iterable of bed lines (chrom, start, end[, name, score, strand])
+        unplaced - file to write reads that are not on any transcript to
+
+        yields (transcript, mRNA start, mRNA end, name, score, strand) records, a read on
+        several isoforms gives one record per isoform
+
+        """
+
+        finished_chroms = set()
+        chrom = None
+        for line in reads:
+            fields = line.split()
+            if len(fields) < 3 or fields[0].startswith(("#", "track", "browser")):
+                continue
+            read_start, read_end = int(fields[1]), int(fields[2])
+
+            if fields[0] != chrom:
+                if fields[0] in finished_chroms:
+                    raise ValueError("reads are not sorted, %s seen again at line %d" %
+                                     (fields[0], self.n_reads + 1))
+                if chrom is not None:
+                    finished_chroms.add(chrom)
+                chrom = fields[0]
+                chrom_exons = self.exons.get(chrom, [])
+                next_exon = 0
+                active = []
+                previous_start = read_start
+            if read_start < previous_start:
+                raise ValueError("reads are not sorted, %s:%d after %s:%d" %
+                                 (chrom, read_start, chrom, previous_start))
+            previous_start = read_start
+            self.n_reads += 1
+
+            #lookahead: every exon starting before the last base of the read
+            last_base = read_end - 1
+            while next_exon < len(chrom_exons) and chrom_exons[next_exon][0] <= last_base:
+                active.append(chrom_exons[next_exon])
+                next_exon += 1
+            #later reads start at or after this one, exons ending before it are done
+            active = [exon for exon in active if exon[1] > read_start]
+
+            first = dict((exon[3], exon) for exon in active if exon[0] <= read_start)
+            last = dict((exon[3], exon) for exon in active if exon[0] <= last_base < exon[1])
+            transcripts = sorted(set(first) & set(last))
+
+            if len(transcripts) == 0:
+                if unplaced is not None:
+                    unplaced.write(line if line.endswith("\n") else line + "\n")
+                continue
+            self.n_projected += 1
+
+            name = fields[3] if len(fields) > 3 else str(self.n_reads)
+            score = fields[4] if len(fields) > 4 else "0"
+            strand = fields[5] if len(fields) > 5 else "."
+            for transcript in transcripts:
+                five_prime = mRNA_position(first[transcript], read_start)
+                three_prime = mRNA_position(last[transcript], last_base)
+                self.n_records += 1
+                yield (transcript, min(five_prime, three_prime), max(five_prime, three_prime) + 1,
+                       name, score, strand)
 
 
 #########################################
 #          MAIN                         #
 #########################################
-reads = pybedtools.BedTool(sys.argv[1])
-exons  = pybedtools.BedTool(sys.argv[2])
-
-
+if __name__ == "__main__":
+    usage = "python ensMapper.py reads.bed exons.bed > reads.mRNA.bed"
+    description = "projects sorted reads onto mRNA coordinates of the transcripts in a sorted exon index"
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("--unplaced", dest="unplaced", default=None, help="write reads that are not on any transcript here", metavar="FILE")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("give a reads bed file and an exon index")
 
-starts = reads.each(makeStarts).intersect(exons, wo=True).each(convert_to_mRNA)[:]
-ends   = reads.each(makeEnds).intersect(exons, wo=True).each(convert_to_mRNA)[:]
-while True:
-    
+    projector = TranscriptProjector(read_exons(args[1]))
+    unplaced = open(options.unplaced, 'w') if options.unplaced is not None else None
     try:
-        start = starts.next()
-        end   = ends.next()
-    except:
-        break
-
-    #this still doesn't take into account getting out of sync, so I may loose a lot of reads, I'll take that hit for now, fix later
-    if start.name == end.name:
-        start.end = end.end
-        if start.strand == "-":
-            tmp = start.end
-            start.end = start.start
-            start.start = tmp
-        print start,
-
-    
+        out = sys.stdout
+        for record in projector.project(open(args[0]), unplaced):
+            out.write("%s\t%d\t%d\t%s\t%s\t%s\n" % record)
+    finally:
+        if unplaced is not None:
+            unplaced.close()
+    sys.stderr.write("%d reads, %d on transcripts, %d records\n" %
+                     (projector.n_reads, projector.n_projected, projector.n_records))
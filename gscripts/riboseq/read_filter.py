@@ -1,16 +1,23 @@
 #!/usr/bin/python
 
 import argparse
+from array import array
+from collections import defaultdict
+from multiprocessing import Pool
 import os
+
+import numpy as np
 import pysam
 
+from gscripts.riboseq.riboseq_coverage import OFFSET, aligned_position, read_length, read_offsets
+
 def get_match_length(almnt):
     """
     Gets length of perfect matches from cigar string
     """
     if almnt.cigar is None:
         return 0
-    
+
     return sum(length for cigar, length in almnt.cigar if cigar == 0)
 
 def get_rpf(bam, out_file, min_length=28, max_length=30):
@@ -30,12 +37,204 @@ def get_rpf(bam, out_file, min_length=28, max_length=30):
                 if min_length <= get_match_length(almnt) <= max_length:
                     bam_writer.write(almnt)
 
+def read_transcripts(bed12):
+
+    """
+
+    reads transcript models from a bed12 file
+
+    returns dict chrom : list of (name, strand, blocks), blocks are (start, end) in genome order
+
+    """
+
+    transcripts = defaultdict(list)
+    with open(bed12) as bed_handle:
+        for line in bed_handle:
+            if line.startswith(("#", "track", "browser")) or line.strip() == "":
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            chrom, start, name, strand = fields[0], int(fields[1]), fields[3], fields[5]
+            sizes = [int(size) for size in fields[10].strip(",").split(",")]
+            starts = [int(block_start) for block_start in fields[11].strip(",").split(",")]
+            blocks = [(start + block_start, start + block_start + size)
+                      for block_start, size in zip(starts, sizes)]
+            transcripts[chrom].append((name, strand, blocks))
+    return transcripts
+
+def transcript_coverage(p_sites, transcripts):
+
+    """
+
+    P-site counts along each transcript, 5' to 3'
+
+    p_sites - dict strand : array of P-site positions on one chromosome
+    transcripts - list of (name, strand, blocks) on that chromosome
+
+    returns dict name : int32 array of transcript length.  Every transcript containing a
+    position gets its count, overlapping isoforms share reads
+
+    """
+
+    pileups = {}
+    for strand, positions in p_sites.items():
+        pileups[strand] = np.unique(positions, return_counts=True)
+
+    coverage = {}
+    for name, strand, blocks in transcripts:
+        sizes = [end - start for start, end in blocks]
+        counts = np.zeros(sum(sizes), dtype=np.int32)
+        coverage[name] = counts
+        if strand not in pileups:
+            continue
+        positions, position_counts = pileups[strand]
+        offset = 0
+        for (start, end), size in zip(blocks, sizes):
+            first, last = np.searchsorted(positions, [start, end])
+            counts[offset + positions[first:last] - start] += position_counts[first:last]
+            offset += size
+        if strand == "-":
+            coverage[name] = counts[::-1].copy()
+    return coverage
+
+def _filter_chrom(args):
+
+    """
+
+    worker: filters the reads of one chromosome into their own bam, tallies their match lengths
+    and P-sites (of the kept reads) and maps the P-sites onto the chromosome's transcripts
+
+    """
+
+    (bam, chrom, part_file, min_length, max_length, offsets, default_offset, threads,
+     transcripts) = args
+    histogram = defaultdict(int)
+    p_sites = {"+": array('l'), "-": array('l')}
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as sorted_bam:
+        with pysam.AlignmentFile(part_file, 'wb', template=sorted_bam, threads=threads) as bam_writer:
+            for almnt in sorted_bam.fetch(chrom):
+                if almnt.is_unmapped or almnt.cigartuples is None:
+                    continue
+                #M bases, counted in C
+                length = almnt.get_cigar_stats()[0][0]
+                histogram[length] += 1
+                if not min_length <= length <= max_length:
+                    continue
+                bam_writer.write(almnt)
+                if not transcripts:
+                    continue
+                #offsets are keyed like riboseq_coverage.p_sites keys them, not by M bases
+                blocks = almnt.get_blocks()
+                offset = offsets.get(read_length(blocks), default_offset)
+                if offset is not None:
+                    p_sites["-" if almnt.is_reverse else "+"].append(
+                        aligned_position(blocks, offset, almnt.is_reverse))
+
+    coverage = {}
+    if transcripts:
+        coverage = transcript_coverage(dict((strand, np.frombuffer(positions, dtype=np.int_))
+                                            for strand, positions in p_sites.items()
+                                            if len(positions) > 0),
+                                       transcripts)
+    return dict(histogram), coverage
+
+def fused_filter(bam, out_file, min_length=28, max_length=30, transcripts=None, offsets=None,
+                 default_offset=OFFSET, processes=1, threads=1):
+
+    """
+
+    get_rpf, a read length histogram and P-site coverage per transcript in one pass over an
+    indexed, coordinate sorted bam
+
+    transcripts - bed12 of transcript models to count P-sites on, None to skip coverage
+    offsets - dict read length : P-site offset, other lengths get default_offset (see
+    riboseq_coverage.read_length, reads are filtered on M bases but offsets keyed by aligned bases)
+    processes - chromosomes filtered in parallel, each into its own bam, joined in header order
+    threads - BGZF compression / decompression threads per worker
+
+    returns (histogram, coverage), histogram is an array of read counts by match length (of all
+    mapped reads, before filtering), coverage a dict transcript name : P-site counts 5' to 3'
+
+    """
+
+    if offsets is None:
+        offsets = {}
+    models = read_transcripts(transcripts) if transcripts is not None else {}
+    with pysam.AlignmentFile(bam, 'rb') as sorted_bam:
+        chroms = list(sorted_bam.references)
+    part_files = ["%s.%d.tmp.bam" % (out_file, tid) for tid in range(len(chroms))]
+    jobs = [(bam, chrom, part_file, min_length, max_length, offsets, default_offset, threads,
+             models.get(chrom, []))
+            for chrom, part_file in zip(chroms, part_files)]
+
+    try:
+        if processes > 1:
+            pool = Pool(processes)
+            try:
+                results = pool.map(_filter_chrom, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_filter_chrom, jobs)
+        if len(part_files) > 0:
+            pysam.cat("-o", out_file, *part_files)
+    finally:
+        for part_file in part_files:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+    lengths = [length for chrom_histogram, chrom_coverage in results for length in chrom_histogram]
+    histogram = np.zeros(max(lengths) + 1 if lengths else 0, dtype=np.int64)
+    coverage = {}
+    for chrom_histogram, chrom_coverage in results:
+        for length, count in chrom_histogram.items():
+            histogram[length] += count
+        coverage.update(chrom_coverage)
+    return histogram, coverage
+
+def write_histogram(histogram, out):
+    with open(out, 'w') as out_handle:
+        for length in np.flatnonzero(histogram):
+            out_handle.write("%d\t%d\n" % (length, histogram[length]))
+
+def write_transcript_coverage(coverage, out):
+
+    """
+
+    saves transcript coverage as one flat npz: names, offsets into counts (one more than names)
+    and counts
+
+    """
+
+    names = sorted(coverage)
+    lengths = [len(coverage[name]) for name in names]
+    np.savez_compressed(out, names=np.array(names),
+                        offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                        counts=np.concatenate([np.zeros(0, dtype=np.int32)] +
+                                              [coverage[name] for name in names]))
 
-parser = argparse.ArgumentParser(description="filters bam files to only have reads of a specific length, important for cleaning up low quality riboseq data")
-parser.add_argument("--bam", help="bam file to adjust", required=True)
-parser.add_argument("--out", help="output file", required=True)
-parser.add_argument("--min_length", help="length of read to keep", required=False, default=28, type=int)
-parser.add_argument("--max_length", help="length of read to keep", required=False, default=30, type=int)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="filters bam files to only have reads of a specific length, important for cleaning up low quality riboseq data")
+    parser.add_argument("--bam", help="bam file to adjust", required=True)
+    parser.add_argument("--out", help="output file", required=True)
+    parser.add_argument("--min_length", help="length of read to keep", required=False, default=28, type=int)
+    parser.add_argument("--max_length", help="length of read to keep", required=False, default=30, type=int)
+    parser.add_argument("--histogram", help="fused mode: write a read length histogram here", required=False, default=None)
+    parser.add_argument("--transcripts", help="fused mode: bed12 of transcripts to count P-sites on", required=False, default=None)
+    parser.add_argument("--coverage", help="fused mode: npz to write P-site coverage per transcript to (needs --transcripts)", required=False, default=None)
+    parser.add_argument("--offsets", help="tab separated read length, P-site offset file", required=False, default=None)
+    parser.add_argument("--processes", help="fused mode: chromosomes to filter in parallel", required=False, default=1, type=int)
+    parser.add_argument("--threads", help="fused mode: BGZF threads per process", required=False, default=1, type=int)
 
-args = parser.parse_args()
-get_rpf(args.bam, args.out, args.min_length, args.max_length)
+    args = parser.parse_args()
+    if args.histogram is None and args.transcripts is None:
+        get_rpf(args.bam, args.out, args.min_length, args.max_length)
+    else:
+        offsets = read_offsets(args.offsets) if args.offsets is not None else None
+        histogram, coverage = fused_filter(args.bam, args.out, args.min_length, args.max_length,
+                                           args.transcripts, offsets, processes=args.processes,
+                                           threads=args.threads)
+        if args.histogram is not None:
+            write_histogram(histogram, args.histogram)
+        if args.coverage is not None:
+            write_transcript_coverage(coverage, args.coverage)
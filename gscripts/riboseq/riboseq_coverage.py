@@ -1,33 +1,280 @@
 #!/usr/bin/python
 
 import argparse
-import os
-import subprocess
+from array import array
+from collections import defaultdict
+import gzip
+import heapq
+import io
+import zipfile
 
-import pybedtools
+import numpy as np
+import pysam
 
 
 OFFSET = 14
 
-def five_prime(interval):
+def read_offsets(offset_file):
 
-    #There could be an off by one bug here, need to think about it a bit
-    if interval.strand == "+":
-        interval.start = interval.start + OFFSET
-        interval.end = interval.start + 1
-    else:
-        interval.end = interval.end - OFFSET 
-        interval.start = interval.end - 1
+    """
+
+    reads a tab separated read length, P-site offset file into a dict
+
+    """
+
+    offsets = {}
+    with open(offset_file) as offset_handle:
+        for line in offset_handle:
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            length, offset = line.split()[:2]
+            offsets[int(length)] = int(offset)
+    return offsets
+
+def write_offsets(offsets, offset_file):
+    with open(offset_file, 'w') as offset_handle:
+        for length in sorted(offsets):
+            offset_handle.write("%d\t%d\n" % (length, offsets[length]))
+
+def read_length(blocks):
+
+    """
+
+    aligned (M, =, X) bases of a read given its aligned blocks, the read length offset
+    files are keyed by.  aligned_position walks the same bases
+
+    """
+
+    return sum(end - start for start, end in blocks)
+
+def aligned_position(blocks, offset, reverse=False):
+
+    """
+
+    genomic position offset nucleotides into a read from its 5' end, skipping introns
+
+    blocks - aligned blocks of the read, (start, end) in genome order
+    reverse - read is on the - strand, its 5' end is the end of the last block
+
+    offsets past the read are clamped to its 3' end
+
+    """
+
+    if reverse:
+        for start, end in reversed(blocks):
+            if offset < end - start:
+                return end - 1 - offset
+            offset -= end - start
+        return blocks[0][0]
+    for start, end in blocks:
+        if offset < end - start:
+            return start + offset
+        offset -= end - start
+    return blocks[-1][1] - 1
+
+class StartCodonMetagene(object):
+
+    """
+
+    Distance from read 5' ends to the first nucleotide of nearby start codons, by read length
+    The most common distance of each length is its P-site offset (the AUG sits in the P-site
+    of initiating ribosomes)
+
+    """
+
+    def __init__(self, start_codons, window=30):
+
+        """
+
+        start_codons - bed file (optionally gzipped) of start codons, the first nucleotide is
+        start on + and end - 1 on - (works for codons and for the 0 length sites of region_helpers)
+        window - longest offset to look for
+
+        """
+
+        self.window = window
+        positions = defaultdict(list)
+        opener = gzip.open if start_codons.endswith(".gz") else open
+        with opener(start_codons) as start_codon_handle:
+            for line in start_codon_handle:
+                fields = line.split()
+                if len(fields) < 6 or line.startswith(("#", "track", "browser")):
+                    continue
+                chrom, start, end, strand = fields[0], int(fields[1]), int(fields[2]), fields[5]
+                positions[(chrom, strand)].append(start if strand == "+" else end - 1)
+        self.positions = dict((key, np.unique(value)) for key, value in positions.items())
+        self.counts = defaultdict(lambda: np.zeros(window, dtype=np.int64))
+
+    def add(self, chrom, strand, five_prime, length):
+        codons = self.positions.get((chrom, strand))
+        if codons is None:
+            return
+        if strand == "+":
+            nearby = codons[np.searchsorted(codons, five_prime):
+                            np.searchsorted(codons, five_prime + self.window)]
+            distances = nearby - five_prime
+        else:
+            nearby = codons[np.searchsorted(codons, five_prime - self.window, side='right'):
+                            np.searchsorted(codons, five_prime, side='right')]
+            distances = five_prime - nearby
+        if len(distances) > 0:
+            np.add.at(self.counts[length], distances, 1)
+
+    def offsets(self, min_reads=100):
+
+        """
+
+        most common offset of every read length with at least min_reads reads around start codons
 
-    return interval
+        """
 
-parser = argparse.ArgumentParser(description="Adjusts bam files (or bed files) to correct position for riboseq, outputs bed file of corrected positions")
-parser.add_argument("--bam", help="bam file to adjust", required=True)
-parser.add_argument("--out", help="output file (bed format)", required=True)
-args = parser.parse_args()
+        return dict((length, int(np.argmax(counts))) for length, counts in self.counts.items()
+                    if counts.sum() >= min_reads)
+
+def p_sites(bam, offsets=None, default_offset=OFFSET, metagene=None):
+
+    """
+
+    P-sites of every mapped read of a coordinate sorted bam, in a single pass
+
+    offsets - dict read length (see read_length) : P-site offset from the 5' end, lengths not in
+    it get default_offset (None skips them)
+    metagene - StartCodonMetagene to fill with the read 5' ends as they go by
+
+    yields (chrom, position, read name, mapq, strand), sorted by chrom (bam header order) and position.
+    P-sites are never upstream of their read's start, so a site can be written out as soon as
+    the reads have moved past it, the reorder buffer only holds the sites of overlapping reads
+
+    """
+
+    if offsets is None:
+        offsets = {}
+    bam = pysam.AlignmentFile(bam, "rb")
+    buffered = []
+    n_read = 0
+    current_tid = None
+    for read in bam:
+        if read.is_unmapped:
+            continue
+        if read.reference_id != current_tid:
+            while buffered:
+                yield heapq.heappop(buffered)[2:]
+            current_tid = read.reference_id
+            chrom = bam.references[current_tid]
+        while buffered and buffered[0][0] < read.reference_start:
+            yield heapq.heappop(buffered)[2:]
+
+        blocks = read.get_blocks()
+        length = read_length(blocks)
+        strand = "-" if read.is_reverse else "+"
+        if metagene is not None:
+            five_prime = blocks[-1][1] - 1 if read.is_reverse else blocks[0][0]
+            metagene.add(chrom, strand, five_prime, length)
+
+        offset = offsets.get(length, default_offset)
+        if offset is None:
+            continue
+        position = aligned_position(blocks, offset, read.is_reverse)
+        #the counter keeps reads at the same position in bam order
+        heapq.heappush(buffered, (position, n_read, chrom, position, read.query_name,
+                                  read.mapping_quality, strand))
+        n_read += 1
+    while buffered:
+        yield heapq.heappop(buffered)[2:]
+    bam.close()
+
+def write_bed(sites, out):
+
+    """
+
+    writes P-sites as 1 nt bed6 intervals, returns the number written
+
+    """
+
+    n_sites = 0
+    with open(out, 'w') as out_handle:
+        for chrom, position, name, score, strand in sites:
+            out_handle.write("%s\t%d\t%d\t%s\t%d\t%s\n" % (chrom, position, position + 1,
+                                                           name, score, strand))
+            n_sites += 1
+    return n_sites
+
+def _pileups(chrom, positions):
+    for strand in sorted(positions):
+        yield (chrom, strand) + tuple(np.unique(np.frombuffer(positions[strand], dtype=np.int_),
+                                                return_counts=True))
+
+def coverage(sites):
+
+    """
+
+    per strand P-site counts along every chromosome, kept sparse
+
+    sites - P-sites sorted by chrom, like p_sites yields
+    yields (chrom, strand, positions, counts) as soon as a chromosome's sites are all read,
+    positions are the sorted covered positions and counts the number of P-sites on each
+
+    """
+
+    chrom = None
+    positions = {}
+    for site_chrom, position, name, score, strand in sites:
+        if site_chrom != chrom:
+            for pileup in _pileups(chrom, positions):
+                yield pileup
+            chrom = site_chrom
+            positions = defaultdict(lambda: array('l'))
+        positions[strand].append(position)
+    for pileup in _pileups(chrom, positions):
+        yield pileup
+
+def write_coverage(chroms, out):
+
+    """
+
+    saves sparse coverage to a compressed npz, one chromosome at a time
+    chroms - (chrom, strand, positions, counts) like coverage yields
+
+    arrays are named chrom + strand + _positions / _counts (chr1+_positions, chr1+_counts),
+    returns the number of covered positions written
+
+    """
+
+    n_positions = 0
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as out_zip:
+        for chrom, strand, positions, counts in chroms:
+            for suffix, values in (("_positions", positions), ("_counts", counts)):
+                buf = io.BytesIO()
+                np.lib.format.write_array(buf, np.asarray(values))
+                out_zip.writestr(chrom + strand + suffix + ".npy", buf.getvalue())
+            n_positions += len(positions)
+    return n_positions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adjusts bam files to the P-site of each read for riboseq, outputs bed file (or coverage arrays) of corrected positions")
+    parser.add_argument("--bam", help="bam file to adjust, coordinate sorted", required=True)
+    parser.add_argument("--out", help="output file (bed format, or npz of sparse per strand coverage with --coverage)", required=True)
+    parser.add_argument("--coverage", help="write per strand covered positions and counts instead of a bed file", action="store_true", default=False)
+    parser.add_argument("--offsets", help="tab separated read length, P-site offset file, other lengths get --default_offset", default=None)
+    parser.add_argument("--default_offset", help="P-site offset of read lengths not in --offsets", type=int, default=OFFSET)
+    parser.add_argument("--start_codons", help="bed file of start codons to estimate per length offsets from", default=None)
+    parser.add_argument("--offsets_out", help="where to write the estimated offsets (needs --start_codons)", default=None)
+    parser.add_argument("--window", help="longest offset to look for around start codons", type=int, default=30)
+    parser.add_argument("--min_reads", help="reads around start codons needed to estimate a length's offset", type=int, default=100)
+    args = parser.parse_args()
+
+    offsets = read_offsets(args.offsets) if args.offsets is not None else None
+    metagene = StartCodonMetagene(args.start_codons, args.window) if args.start_codons is not None else None
+    sites = p_sites(args.bam, offsets, args.default_offset, metagene)
+    if args.coverage:
+        write_coverage(coverage(sites), args.out)
+    else:
+        write_bed(sites, args.out)
 
-pybedtools.BedTool(args.bam).bam_to_bed(stream=True).each(five_prime).saveas(args.out + "tmp") 
-#bedtools sort runs into memory issues, can't use it. 
-p = subprocess.Popen("sort -k 1,1 -k 2,2n %s > %s" % (args.out + "tmp", args.out), shell=True)
-p.wait()
-os.remove(args.out + "tmp")
\ No newline at end of file
+    if metagene is not None:
+        estimated = metagene.offsets(args.min_reads)
+        if args.offsets_out is not None:
+            write_offsets(estimated, args.offsets_out)
+        else:
+            for length in sorted(estimated):
+                print "%d\t%d" % (length, estimated[length])
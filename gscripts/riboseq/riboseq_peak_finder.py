@@ -1,28 +1,212 @@
 #takes in a vector, outputs any location where the peaks are 25 fold higher than the median of the vector
 #Eventually want to modify this to accept a) bed formatted files b) gene body files that let me limit searches
-#arg1 = vector
+#arg1 = vector (text, a flat .npz coverage store from read_filter or a memory mapped .npy store)
 #arg2 = gene body information
+import argparse
+from multiprocessing import Pool
 import sys
 
-#get gene bodies 
-geneBodies = {}
-for line in open(sys.argv[2]):
-    line = line.strip().split()
-    geneBodies[line[0]] = map(int, line[1:])
-    
-for line in open(sys.argv[1]):
-    line = line.strip().split()
-    name = line[0]
-    if name in geneBodies:
-        vector = map(int, line[1:])
-        geneBody = vector[geneBodies[name][0]:geneBodies[name][1]]
-        #geneBody.sort()
-        median = geneBody[len(geneBody) /2]
-        if median == 0: 
-            median = 1
-        for location, value in enumerate(vector):
-            
-            if (value / median) >= 25:
-                print name + "\t" + str(location) + "\t" + str(location + 1)
-                #print geneBody[-1] / median         
-            
+import numpy as np
+
+#scales a MAD to the standard deviation of normally distributed data
+MAD_SCALE = 1.4826
+
+_coverage = None
+
+def read_gene_bodies(gene_body_file):
+
+    """
+
+    reads name, gene body start, gene body end lines into a dict name : (start, end)
+
+    """
+
+    gene_bodies = {}
+    for line in open(gene_body_file):
+        line = line.strip().split()
+        if len(line) < 3:
+            continue
+        gene_bodies[line[0]] = (int(line[1]), int(line[2]))
+    return gene_bodies
+
+def read_vectors(vector_file):
+
+    """
+
+    reads text coverage vectors (name followed by one count per position) into a flat store:
+    names, offsets into counts (one more than names) and counts
+
+    """
+
+    names = []
+    vectors = []
+    for line in open(vector_file):
+        line = line.split()
+        if len(line) == 0:
+            continue
+        names.append(line[0])
+        vectors.append(np.array(line[1:], dtype=np.int64))
+    offsets = np.concatenate([[0], np.cumsum([len(vector) for vector in vectors])]).astype(np.int64)
+    counts = np.concatenate([np.zeros(0, dtype=np.int64)] + vectors)
+    return np.array(names, dtype=object), offsets, counts
+
+def write_coverage_store(names, offsets, counts, filename):
+
+    """
+
+    writes a flat coverage store that load_coverage can memory map: counts go to filename
+    (a .npy), names and offsets to filename.index.npz
+
+    """
+
+    np.save(filename, counts)
+    np.savez(filename + ".index.npz", names=np.array(names).astype(str), offsets=offsets)
+
+def load_coverage(filename):
+
+    """
+
+    loads coverage as a flat store (names, offsets, counts)
+
+    .npz - names, offsets and counts arrays, like read_filter.write_transcript_coverage
+    .npy - counts memory mapped, names and offsets from filename.index.npz (see write_coverage_store)
+    anything else - text vectors, see read_vectors
+
+    """
+
+    if filename.endswith(".npz"):
+        with np.load(filename) as store:
+            return store['names'].astype(object), store['offsets'], store['counts']
+    if filename.endswith(".npy"):
+        with np.load(filename + ".index.npz") as index:
+            names, offsets = index['names'].astype(object), index['offsets']
+        return names, offsets, np.load(filename, mmap_mode='r')
+    return read_vectors(filename)
+
+def body_statistics(vector, body):
+
+    """
+
+    median and median absolute deviation of the gene body (start, end) of a coverage vector
+
+    """
+
+    gene_body = np.asarray(vector[body[0]:body[1]], dtype=np.float64)
+    median = np.median(gene_body)
+    return median, np.median(np.abs(gene_body - median))
+
+def call_peaks(vector, median, mad, fold=25, mad_cutoff=None, min_count=1):
+
+    """
+
+    positions of a coverage vector enriched over its gene body
+
+    fold - counts have to be at least fold times the median (a median of 0 counts as 1)
+    mad_cutoff - if given, counts also have to be this many scaled MADs above the median
+    (a MAD of 0 counts as 1)
+    min_count - least number of reads at a peak
+
+    """
+
+    vector = np.asarray(vector)
+    enriched = (vector >= fold * max(median, 1)) & (vector >= min_count)
+    if mad_cutoff is not None:
+        scale = MAD_SCALE * mad if mad > 0 else 1
+        enriched &= (vector - median) >= mad_cutoff * scale
+    return np.flatnonzero(enriched)
+
+def _init_worker(coverage):
+    global _coverage
+    _coverage = coverage
+
+def _find_chunk(args):
+
+    """
+
+    worker: calls peaks on a block of transcripts of the shared coverage store
+
+    returns list of (name, positions, counts, median, mad)
+
+    """
+
+    transcripts, gene_bodies, fold, mad_cutoff, min_count = args
+    names, offsets, counts = _coverage
+    peaks = []
+    for transcript, body in zip(transcripts, gene_bodies):
+        vector = counts[offsets[transcript]:offsets[transcript + 1]]
+        if body[1] <= body[0] or body[0] >= len(vector):
+            continue
+        median, mad = body_statistics(vector, body)
+        positions = call_peaks(vector, median, mad, fold, mad_cutoff, min_count)
+        peaks.append((names[transcript], positions, np.asarray(vector[positions]), median, mad))
+    return peaks
+
+def find_peaks(coverage, gene_bodies, fold=25, mad_cutoff=None, min_count=1, processes=1,
+               chunk_size=1000):
+
+    """
+
+    Calls enriched positions on every transcript with a gene body
+
+    coverage - flat store (names, offsets, counts), see load_coverage
+    gene_bodies - dict name : (start, end), see read_gene_bodies
+    processes - number of worker processes, transcripts are handled in blocks of chunk_size
+
+    yields (name, positions, counts, median, mad) per transcript, in store order
+
+    """
+
+    names = coverage[0]
+    transcripts = [transcript for transcript, name in enumerate(names) if name in gene_bodies]
+    jobs = [(transcripts[first:first + chunk_size],
+             [gene_bodies[names[transcript]] for transcript in transcripts[first:first + chunk_size]],
+             fold, mad_cutoff, min_count)
+            for first in range(0, len(transcripts), chunk_size)]
+
+    if processes > 1 and len(jobs) > 1:
+        #workers are forked, so they share the (possibly memory mapped) store
+        pool = Pool(processes, initializer=_init_worker, initargs=(coverage,))
+        try:
+            for peaks in pool.imap(_find_chunk, jobs):
+                for peak in peaks:
+                    yield peak
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(coverage)
+        for job in jobs:
+            for peak in _find_chunk(job):
+                yield peak
+
+def write_bed(peaks, out):
+
+    """
+
+    writes peaks as bed6 in transcript coordinates, the score is the number of reads
+
+    """
+
+    for name, positions, counts, median, mad in peaks:
+        for position, count in zip(positions, counts):
+            out.write("%s\t%d\t%d\t%s\t%d\t+\n" % (name, position, position + 1, name, count))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="calls riboseq peaks, positions with many more reads than their gene body, outputs bed in transcript coordinates")
+    parser.add_argument("vector", help="coverage vectors: text (name then counts), .npz store or memory mapped .npy store")
+    parser.add_argument("gene_bodies", help="name, gene body start, gene body end")
+    parser.add_argument("--fold", help="fold over the gene body median to call a peak", type=float, default=25)
+    parser.add_argument("--mad_cutoff", help="also require this many scaled MADs over the gene body median", type=float, default=None)
+    parser.add_argument("--min_count", help="least number of reads at a peak", type=int, default=1)
+    parser.add_argument("--processes", help="number of worker processes", type=int, default=1)
+    parser.add_argument("--chunk_size", help="transcripts per worker task", type=int, default=1000)
+    parser.add_argument("--out", help="output bed, default stdout", default=None)
+    args = parser.parse_args()
+
+    peaks = find_peaks(load_coverage(args.vector), read_gene_bodies(args.gene_bodies), args.fold,
+                       args.mad_cutoff, args.min_count, args.processes, args.chunk_size)
+    if args.out is None:
+        write_bed(peaks, sys.stdout)
+    else:
+        with open(args.out, 'w') as out:
+            write_bed(peaks, out)
@@ -11,14 +11,186 @@ Created on Jan 21, 2014
 
 from collections import defaultdict
 from itertools import izip
+from multiprocessing import Pool
 import os
 
 from Bio import SeqIO
 import gffutils
+import numpy as np
 import pybedtools
 
 import clipper
 import clipper.src.CLIP_analysis as CLIP_analysis
+from gscripts.general.gffutils_helpers import annotation_maps
+
+#one row per uORF, start_codon and stop_codon are the (1 based) gff starts of the codons
+UORF_DTYPE = [('transcript', object), ('name', object), ('chrom', object), ('strand', 'S1'), 
+              ('frame', np.int8), ('start_codon', np.int64), ('stop_codon', np.int64), 
+              ('codons', np.int64)]
+
+A, C, G, T = [ord(base) for base in "ACGT"]
+
+def stitch_transcripts(five_prime_utr_dict):
+    
+    """
+    
+    joins the spliced 5' UTR of every transcript into one sequence 
+    
+    five_prime_utr_dict: transcript id : [(pybedtools.interval, bio.SeqRecord)] in 5' to 3' order
+    
+    returns dict with the transcript ids (sorted), their offsets into the joined sequence 
+    (one more than transcripts), the joined sequence and per exon arrays: offset, chrom, start, end, 
+    strand and name
+    
+    """
+    
+    transcripts = sorted(five_prime_utr_dict.keys())
+    tx_offsets = [0]
+    sequence = []
+    exons = defaultdict(list)
+    offset = 0
+    for transcript in transcripts:
+        for interval, record in five_prime_utr_dict[transcript]:
+            exon = str(record.seq).upper()
+            exons['offset'].append(offset)
+            exons['chrom'].append(interval.chrom)
+            exons['start'].append(interval.start)
+            exons['end'].append(interval.end)
+            exons['strand'].append(interval.strand)
+            exons['name'].append(interval.name)
+            sequence.append(exon)
+            offset += len(exon)
+        tx_offsets.append(offset)
+        
+    stitched = {'transcripts' : np.array(transcripts, dtype=object), 
+                'tx_offsets' : np.array(tx_offsets, dtype=np.int64), 
+                'sequence' : "".join(sequence)}
+    for field in ['offset', 'start', 'end']:
+        stitched['exon_' + field] = np.array(exons[field], dtype=np.int64)
+    for field in ['chrom', 'strand', 'name']:
+        stitched['exon_' + field] = np.array(exons[field], dtype=object)
+    return stitched
+
+def _scan_transcripts(args):
+    
+    """
+    
+    finds uORFs in a block of joined transcripts, in every frame the first ATG after a 
+    stop (or the start of the transcript) is paired with the next in frame stop codon
+    
+    returns transcript index, frame, ATG offset, stop offset and length in codons of each uORF, 
+    offsets are relative to the start of the transcript
+    
+    """
+    
+    sequence, tx_offsets, uorf_length = args
+    n_bases = len(sequence)
+    empty = np.zeros(0, dtype=np.int64)
+    if n_bases < 3:
+        return empty, empty, empty, empty, empty
+    
+    bases = np.fromstring(sequence, dtype=np.uint8)
+    first, second, third = bases[:-2], bases[1:-1], bases[2:]
+    tx_lengths = np.diff(tx_offsets)
+    transcript = np.repeat(np.arange(len(tx_lengths)), tx_lengths)[:-2]
+    local = np.arange(n_bases - 2) - tx_offsets[transcript]
+    
+    #codons have to fit inside their transcript
+    fits = local + 3 <= tx_lengths[transcript]
+    is_start = fits & (first == A) & (second == T) & (third == G)
+    is_stop = fits & (first == T) & (((second == A) & ((third == A) | (third == G))) | 
+                                      ((second == G) & (third == A)))
+    
+    #one stream of codons per transcript and frame, keys sort by stream then position
+    stream_size = tx_lengths.max() + 1
+    keys = (transcript * 3 + local % 3) * stream_size + local
+    start_keys = np.sort(keys[is_start])
+    stop_keys = np.sort(keys[is_stop])
+    if len(start_keys) == 0 or len(stop_keys) == 0:
+        return empty, empty, empty, empty, empty
+    stream = stop_keys // stream_size
+    
+    #the ATG opening the uORF a stop closes is the first one after the previous stop
+    previous = stream * stream_size - 1
+    same_stream = stream[1:] == stream[:-1]
+    previous[1:][same_stream] = stop_keys[:-1][same_stream]
+    opener = np.searchsorted(start_keys, previous, side='right')
+    found = opener < len(start_keys)
+    atg_keys = start_keys[np.minimum(opener, len(start_keys) - 1)]
+    found &= atg_keys < stop_keys
+    
+    atg = atg_keys[found] % stream_size
+    stop = stop_keys[found] % stream_size
+    stream = stream[found]
+    codons = (stop - atg) // 3
+    keep = codons > uorf_length
+    return (stream[keep] // 3, stream[keep] % 3, atg[keep], stop[keep], codons[keep])
+
+def scan_uorfs(five_prime_utr_dict, uorf_length=30, processes=1, chunk_size=2000):
+    
+    """
+    
+    Finds uORFs in all three frames of every transcript's spliced 5' UTR
+    
+    five_prime_utr_dict: transcript id : [(pybedtools.interval, bio.SeqRecord)] in 5' to 3' order, 
+    as returned by UORF_detector._get_five_prime_utr_sequences
+    uorf_length: int, uORFs have to be longer than this many codons 
+    processes: number of worker processes, transcripts are scanned in blocks of chunk_size 
+    
+    returns structured array (UORF_DTYPE) sorted by transcript, frame and position
+    
+    """
+    
+    stitched = stitch_transcripts(five_prime_utr_dict)
+    tx_offsets = stitched['tx_offsets']
+    bounds = range(0, len(tx_offsets) - 1, chunk_size) + [len(tx_offsets) - 1]
+    jobs = [(stitched['sequence'][tx_offsets[first]:tx_offsets[last]], 
+             tx_offsets[first:last + 1] - tx_offsets[first], uorf_length) 
+            for first, last in zip(bounds[:-1], bounds[1:])]
+    
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_scan_transcripts, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_scan_transcripts, jobs)
+    
+    results = [(result[0] + first,) + tuple(result[1:]) for first, result in zip(bounds, results)]
+    transcript, frame, atg, stop, codons = [np.concatenate([np.zeros(0, dtype=np.int64)] + 
+                                                           [result[field] for result in results]) 
+                                            for field in range(5)]
+    order = np.lexsort((atg, frame, transcript))
+    transcript, frame, atg, stop, codons = [values[order] for values in (transcript, frame, atg, 
+                                                                         stop, codons)]
+    
+    #back to the genome, through the exon each codon starts in
+    def exon_of(offset):
+        return np.searchsorted(stitched['exon_offset'], tx_offsets[transcript] + offset, 
+                               side='right') - 1
+    
+    def genomic(offset):
+        exon = exon_of(offset)
+        exon_offset = tx_offsets[transcript] + offset - stitched['exon_offset'][exon]
+        return np.where(stitched['exon_strand'][exon] == "+", 
+                        stitched['exon_start'][exon] + exon_offset, 
+                        stitched['exon_end'][exon] - exon_offset - 2)
+    
+    exon = exon_of(atg)
+    start_codon = genomic(atg)
+    stop_codon = genomic(stop)
+    uorfs = np.zeros(len(transcript), dtype=UORF_DTYPE)
+    uorfs['transcript'] = stitched['transcripts'][transcript]
+    uorfs['name'] = stitched['exon_name'][exon]
+    uorfs['chrom'] = stitched['exon_chrom'][exon]
+    uorfs['strand'] = stitched['exon_strand'][exon].astype(str)
+    uorfs['frame'] = frame
+    uorfs['start_codon'] = start_codon
+    uorfs['stop_codon'] = stop_codon
+    uorfs['codons'] = codons
+    return uorfs
 
 class UORF_detector:
 
@@ -31,86 +203,34 @@ class UORF_detector:
     
         return pybedtools.BedTool(uorfs)
         
-    def _get_uorf_start_stop(self, five_prime_utr_dict, uorf_length=30):
+    def _get_uorf_start_stop(self, five_prime_utr_dict, uorf_length=30, processes=1):
         """
         
         five_prime_utr_dict: transcript id : (pybedtools.interval, bio.SeqRecord)
         uorf_length: int minimun uorf length to call uorf
+        processes: number of processes to scan transcripts with, see scan_uorfs
         
         return pybedtools object of uorf starts and stops
         """
-        uorf_annotations = ""
-    #We are going to ingonre AGT spanning introns and not count them as potental uORFs, this will loose us some 
-    #potental uORFs but make it much easier to code
-        for five_prine_utr in five_prime_utr_dict.values():
-            for reading_frame in range(3):
-                in_first_exon = True
-                in_uORF = False
-                offset = ""
-                offset_size = 0
-                total_codons = 0
-                for interval, sequence in five_prine_utr:
-                    if in_first_exon:
-                        exon = sequence.seq[reading_frame:]
-                    else:
-                        exon = sequence.seq
-                    
-                    for interval_codons, amino_acid in enumerate((offset + exon).translate()):
-                        
-                        total_codons += 1
-                        #Reading frame only matters in the first exon, after that everything is inframe
-                        if interval.strand == "+":
-                            start_of_codon = (interval.start + (interval_codons * 3) + 1) - offset_size
-                        else:
-                            start_of_codon = (interval.end - ((interval_codons + 1) * 3) + 1) + offset_size
-                            reading_frame = reading_frame * -1
-                        if in_first_exon:
-                            start_of_codon = start_of_codon + reading_frame 
-                                
-                        end_of_codon = start_of_codon + 2
-                        
-                        if amino_acid == "M" and not in_uORF:
-                            start_annotation = "\t".join([interval.chrom, 
-                                    "protein_coding", 
-                                    "uORF_start", 
-                                    str(start_of_codon), 
-                                    str(end_of_codon), 
-                                    ".", 
-                                    interval.strand, 
-                                    ".", 
-                                    "ID=uORF_start:%s;Parent=%s" % (interval.name, 
-                                        interval.name)])
-                            uorf_start = total_codons
-                            in_uORF = True
-                        if amino_acid == "*" and in_uORF:
-                            in_uORF = False
-                            stop_annotation = "\t".join([interval.chrom, 
-                                    "protein_coding", 
-                                    "uORF_end", 
-                                    str(start_of_codon), 
-                                    str(end_of_codon), ".", 
-                                    interval.strand, 
-                                    ".", 
-                                    "ID=uORF_end:%s;Parent=%s" % (interval.name, 
-                                        interval.name)])
-                            if total_codons - uorf_start > uorf_length:
-                                uorf_annotations += start_annotation + "\n"
-                                uorf_annotations += stop_annotation  + "\n"
-                    
-                    in_first_exon = False
-                    offset_size = len(exon) % 3
-                    if offset_size == 0:
-                        offset = ""
-                    else:
-                        offset = exon[offset_size * -1:]
-        
-        uorf_annotations = pybedtools.BedTool(uorf_annotations, from_string=True)
-        return uorf_annotations
+        
+        uorf_annotations = []
+        for uorf in scan_uorfs(five_prime_utr_dict, uorf_length, processes):
+            for feature, codon in [("uORF_start", uorf['start_codon']), ("uORF_end", uorf['stop_codon'])]:
+                uorf_annotations.append(pybedtools.create_interval_from_list([uorf['chrom'], 
+                                "protein_coding", 
+                                feature, 
+                                str(codon), 
+                                str(codon + 2), 
+                                ".", 
+                                uorf['strand'], 
+                                ".", 
+                                "ID=%s:%s;Parent=%s" % (feature, uorf['name'], uorf['name'])]))
+        
+        return pybedtools.BedTool(uorf_annotations).saveas()
     
     #create transcript, gene mapping dict
     def _create_transcript_map(self, db):
-        return { transcript.attributes['transcript_id'] : transcript.attributes['gene_id'] 
-                            for transcript in db.features_of_type('transcript')}
+        return annotation_maps(db)['transcript_gene']
      
     def _get_five_prime_utr_sequences(self, UTR5, fa_file):
         """
@@ -125,11 +245,9 @@ class UORF_detector:
         """
                                                
         filtered_UTR5 = UTR5.filter(lambda x: len(x) >0).saveas()
-        filtered_UTR5.sequence(fi=fa_file, 
-                               s=True, 
-                               fo="five_prime_utr.fasta")
         
-        sequences = SeqIO.parse(open("five_prime_utr.fasta"), 'fasta')
+        #sequences go to a pybedtools temp file, not the working directory
+        sequences = SeqIO.parse(open(filtered_UTR5.sequence(fi=fa_file, s=True).seqfn), 'fasta')
         five_prime_utr_dict = defaultdict(list)
         
         for five_prime_utr, sequence in zip(filtered_UTR5, sequences):
@@ -0,0 +1,215 @@
+"""
+Local batch executor for PETcofold scoring of RNApairs
+
+Links are grouped by chromosome and sorted by position so alignments can be tiled
+from the indexed maf files through conservation.maf_handler with its block cache
+hot, then PETcofold runs in a pool of worker processes fed through a bounded queue.
+Scores go into a local sqlite file instead of the remote RNAlinkDB mongo collection,
+so re-runs skip links that have already been scored.
+"""
+
+from subprocess import Popen, PIPE
+from multiprocessing import Process, Queue
+from Queue import Empty
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from conserved_structure import RNApair, parsePETcofold, base
+
+PETcofold_cmd = base + "/yeolab/Software/PETcofold/PETcofold/bin/PETcofold_3_1_2.pl"
+PET_FIELDS = ["qStruc", "tStruc", "qCoStruc", "tCoStruc",
+              "PETcofoldScore", "PETcofoldReliability", "PETcofoldDelReliability"]
+
+
+class CofoldCache(object):
+    """sqlite store of PETcofold results keyed by (link name, species list, tree)"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.con = sqlite3.connect(filename)
+        self.con.execute("CREATE TABLE IF NOT EXISTS cofold ("
+                         "name TEXT, species TEXT, tree TEXT, score REAL, "
+                         "reliability REAL, del_reliability REAL, record TEXT, "
+                         "PRIMARY KEY (name, species, tree))")
+        self.con.commit()
+
+    def done(self, species, tree):
+        """names of links already scored with this species list and tree"""
+        return set(name for (name,) in
+                   self.con.execute("SELECT name FROM cofold WHERE species=? AND tree=?", (species, tree)))
+
+    def put(self, record, species, tree):
+        score = record["PETcofoldScore"]
+        if score == "error":
+            values = (None, None, None)
+        else:
+            values = (score, record["PETcofoldReliability"], record["PETcofoldDelReliability"])
+        self.con.execute("INSERT OR REPLACE INTO cofold VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (record["name"], species, tree) + values + (json.dumps(record),))
+
+    def get(self, name, species, tree):
+        row = self.con.execute("SELECT record FROM cofold WHERE name=? AND species=? AND tree=?",
+                               (name, species, tree)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+def check_species(getter, speciesList):
+    """every species has to be in the alignment, PETcofold would score gap-only rows otherwise"""
+    missing = [sp for sp in speciesList if sp not in getter.sources]
+    if len(missing) > 0:
+        raise ValueError("species not in the maf alignment: %s" % (", ".join(missing)))
+
+
+def maf_alignment(getter, chrom, start, stop, strand, speciesList):
+    """tile a maf alignment for one region, returns {species: aligned sequence}"""
+    check_species(getter, speciesList)
+    aln = getter.tile_interval(chrom, start, stop, strand)
+    rows = dict(zip(getter.sources, [component.text for component in aln.components]))
+    return dict((sp, rows[sp]) for sp in speciesList)
+
+
+def fetch_alignments(pairs, getter, speciesList):
+    """
+    fill qMultiz/tMultiz on each RNApair from the indexed maf files, the same fields multiZ sets
+    pairs are visited in genome order so neighbouring links share cached maf blocks
+    """
+    for pair in sorted(pairs, key=lambda p: (p.chromosome, min(p.qStart, p.tStart))):
+        pair.qMultiz = maf_alignment(getter, pair.chromosome, pair.qStart, pair.qStop, pair.strand, speciesList)
+        pair.tMultiz = maf_alignment(getter, pair.chromosome, pair.tStart, pair.tStop, pair.strand, speciesList)
+        pair.speciesList = speciesList
+    return pairs
+
+
+def _PETcofold(name, qMultiz, tMultiz, speciesList, tree):
+    """run PETcofold on one pair of alignments, returns the parsed result or None on error"""
+    tmpdir = tempfile.mkdtemp(prefix="PETcofold_")
+    try:
+        qFile = os.path.join(tmpdir, "q.fa")
+        tFile = os.path.join(tmpdir, "t.fa")
+        with open(qFile, 'w') as qF, open(tFile, 'w') as tF:
+            for sp in speciesList:
+                qF.write(">" + sp + "\n" + qMultiz[sp] + "\n")
+                tF.write(">" + sp + "\n" + tMultiz[sp] + "\n")
+        with open(os.devnull, 'w') as err:
+            proc = Popen(["perl", PETcofold_cmd, "-fasta", qFile, "-fasta", tFile, "-settree", tree],
+                         stdout=PIPE, stderr=err, cwd=tmpdir)
+            foldResult = proc.communicate()[0]
+    finally:
+        shutil.rmtree(tmpdir)
+    if foldResult == "":
+        return None
+    return parsePETcofold(foldResult)
+
+
+def _cofold_worker(tasks, results, speciesList, tree):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        name, qMultiz, tMultiz = task
+        try:
+            parsed = _PETcofold(name, qMultiz, tMultiz, speciesList, tree)
+        except Exception:
+            parsed = None
+        results.put((name, parsed))
+
+
+def _apply_result(pair, parsed):
+    if parsed is None:
+        for field in PET_FIELDS:
+            setattr(pair, field, "error")
+    else:
+        for field, value in zip(PET_FIELDS, parsed):
+            setattr(pair, field, value)
+
+
+def PETcofold_batch(links, getter, speciesList, tree, cache_file, processes=4, queue_size=None,
+                    group_size=500):
+    """
+    score every link in links (bed12 intervals or lines) with PETcofold
+
+    getter: a conservation.maf_handler.MafRangeGetter on the alignment the tree was made for
+            (hg19MafRangeGetter on the 46-way maf files for the hg19_46 trees)
+    speciesList: species (maf source names) to align
+    tree: newick tree file for PETcofold
+    cache_file: sqlite file results are stored in, links already in it are skipped
+    processes: number of PETcofold workers
+    queue_size: max alignments waiting for a worker, default 2 * processes
+    group_size: number of links to align at a time
+
+    returns the number of links scored in this run
+    """
+    check_species(getter, speciesList)
+    if queue_size is None:
+        queue_size = 2 * processes
+    species = "-".join(speciesList)
+    cache = CofoldCache(cache_file)
+    done = cache.done(species, tree)
+
+    tasks = Queue(maxsize=queue_size)
+    results = Queue()
+    workers = [Process(target=_cofold_worker, args=(tasks, results, speciesList, tree))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    pending = {}
+    n_scored = [0]
+
+    def collect(block):
+        while len(pending) > 0:
+            try:
+                name, parsed = results.get(block)
+            except Empty:
+                return
+            pair = pending.pop(name)
+            _apply_result(pair, parsed)
+            record = dict(pair.__dict__)
+            record.pop("qMultiz", None)
+            record.pop("tMultiz", None)
+            cache.put(record, species, tree)
+            n_scored[0] += 1
+            if n_scored[0] % 100 == 0:
+                cache.commit()
+
+    def submit(group):
+        for pair in fetch_alignments(group, getter, speciesList):
+            tasks.put((pair.name, pair.qMultiz, pair.tMultiz))
+            pending[pair.name] = pair
+            collect(False)
+
+    try:
+        group = list()
+        for link in links:
+            pair = RNApair(link)
+            if pair.name in done or pair.name in pending:
+                continue
+            group.append(pair)
+            if len(group) == group_size:
+                submit(group)
+                group = list()
+        submit(group)
+        for worker in workers:
+            tasks.put(None)
+        collect(True)
+    except:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+        cache.close()
+    return n_scored[0]
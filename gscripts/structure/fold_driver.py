@@ -0,0 +1,123 @@
+"""
+Local driver for folding every event in a structure_tmp/ directory on one node
+
+Replaces the one-qsub-script-per-gene array and the .lock file protocol of
+structure.fold_a_dir: events (the .pickle files written by parse_event_detail) are
+handed out one at a time to a pool of workers, so a worker that finishes early just
+takes the next event.  Each finished event is written to outdir/<event>.RNAlinks.bed,
+appended to one merged bed file and recorded in a checkpoint file, so a killed run
+picks up where it stopped.
+"""
+
+from multiprocessing import Pool
+from optparse import OptionParser
+import glob
+import os
+import sys
+
+import structure
+
+_runner = None
+
+
+def list_events(dbdir):
+    """event names with a pickle from parse_event_detail in dbdir"""
+    return sorted(os.path.basename(picklefile).replace(".pickle", "")
+                  for picklefile in glob.glob(os.path.join(dbdir, "*.pickle")))
+
+
+def read_checkpoint(checkpoint):
+    if not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint) as f:
+        return set(line.strip() for line in f if line.strip() != "")
+
+
+def _init_worker(hybrid_cache):
+    global _runner
+    #pool workers are daemonic and can't start a pool of their own, so RNAhybrid runs in the worker
+    _runner = structure.default_runner(cache_file=hybrid_cache, processes=1)
+
+
+def _fold_event(args):
+    """worker: fold one event, returns (event, bed lines, error)"""
+    event, dbdir, mfe_cutoff, species = args
+    try:
+        links = structure.run_fold(os.path.join(dbdir, event + ".pickle"), mfe_cutoff=mfe_cutoff,
+                                   species=species, runner=_runner, raise_errors=True)
+        lines = [line for line in links.split("\n") if line != ""] if links else []
+        return event, lines, None
+    except Exception:
+        return event, None, str(sys.exc_info()[1])
+
+
+def fold_events(dbdir="structure_tmp/", outdir="beds/", merged="all.RNAlinks.bed", mfe_cutoff=-40,
+                species="hg19", processes=8, events=None, hybrid_cache=None):
+    """
+    fold events from dbdir in parallel, skipping events already in the checkpoint
+
+    merged: name of the merged bed12 inside outdir, finished events are appended as they come in
+    events: event names to run, default every pickle in dbdir
+    returns the list of events that raised errors
+    """
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+    checkpoint = os.path.join(outdir, merged + ".done")
+    finished = read_checkpoint(checkpoint)
+    if events is None:
+        events = list_events(dbdir)
+    todo = [event for event in events if event not in finished]
+    print "%d events, %d already done, %d to fold" % (len(events), len(events) - len(todo), len(todo))
+
+    failed = list()
+    pool = Pool(processes, initializer=_init_worker, initargs=(hybrid_cache,))
+    try:
+        with open(os.path.join(outdir, merged), 'a') as mergedF, open(checkpoint, 'a') as doneF:
+            jobs = ((event, dbdir, mfe_cutoff, species) for event in todo)
+            for n, (event, lines, error) in enumerate(pool.imap_unordered(_fold_event, jobs, chunksize=1)):
+                if error is not None:
+                    print "problem with %s: %s" % (event, error)
+                    failed.append(event)
+                    continue
+                with open(os.path.join(outdir, event + ".RNAlinks.bed"), 'w') as eventF:
+                    eventF.write("track name='%s.RNAlinks' itemRgb=On\n" % (event))
+                    for line in lines:
+                        eventF.write(line + "\n")
+                for line in lines:
+                    mergedF.write(line + "\n")
+                mergedF.flush()
+                #only mark the event done once its links are safely in the merged file
+                doneF.write(event + "\n")
+                doneF.flush()
+                if (n + 1) % 100 == 0:
+                    print "folded %d of %d events" % (n + 1, len(todo))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed
+
+
+if __name__ == "__main__":
+
+    usage = "python fold_driver.py --dbdir structure_tmp/ --outdir beds/ --processes 16"
+    description = "fold all events from parse_event_detail on this node, resuming from the last checkpoint"
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("--dbdir", dest="dbdir", default="structure_tmp/", help="directory of event pickles.  default:%default")
+    parser.add_option("--outdir", dest="outdir", default="beds/", help="output directory.  default:%default")
+    parser.add_option("--merged", dest="merged", default="all.RNAlinks.bed", help="merged bed12 name inside outdir.  default:%default")
+    parser.add_option("--mfe_cutoff", dest="mfe_cutoff", type="int", default=-20)
+    parser.add_option("--species", dest="species", default="hg19")
+    parser.add_option("--processes", dest="processes", type="int", default=8, help="number of workers.  default:%default")
+    parser.add_option("--event", dest="events", default=None, action="append", help="only fold these events")
+    parser.add_option("--hybrid_cache", dest="hybrid_cache", default=None, help="sqlite file to cache RNAhybrid hits between runs", metavar="FILE")
+
+    (options, args) = parser.parse_args()
+    failed = fold_events(dbdir=options.dbdir, outdir=options.outdir, merged=options.merged,
+                         mfe_cutoff=options.mfe_cutoff, species=options.species,
+                         processes=options.processes, events=options.events,
+                         hybrid_cache=options.hybrid_cache)
+    if len(failed) > 0:
+        print "%d events failed, re-run to retry them" % (len(failed))
@@ -0,0 +1,214 @@
+"""
+Batch RNAhybrid runner for structure.matched_positions
+
+Window pairs are de-duplicated by sequence hash, grouped so that each RNAhybrid
+invocation folds one target window against many query windows, spread across a
+process pool and parsed in python (a port of parseRNAhybrid.pl).  Hits are kept in
+an on-disk sqlite cache keyed by (query, target, params) so re-running an event set
+only folds the windows that haven't been seen before.
+"""
+
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+from multiprocessing import Pool
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+
+
+def _merge_pairing(matched, unmatched):
+    """fill gaps ("-") in the paired line with the unpaired bases at the same column"""
+    merged = list(matched)
+    for i in range(min(len(merged), len(unmatched))):
+        if merged[i] == "-":
+            merged[i] = unmatched[i]
+    return "".join(merged)
+
+
+def parse_RNAhybrid(output):
+    """
+    parse default (non-compact) RNAhybrid output, same scheme as parseRNAhybrid.pl
+    returns a list of [target, target_length, position, query, query_length, mfe, pvalue, target_seq, query_seq]
+    upper-case = match; lower-case = non-pair; dash=gap
+    """
+    lines = output.split("\n")
+    results = list()
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith("target:"):
+            i += 1
+            continue
+        record = lines[i:i + 13]
+        if len(record) < 13:
+            break
+        target = record[0].split(": ", 1)[1]
+        target_length = record[1].split(": ", 1)[1].strip()
+        query = record[2].split(": ", 1)[1].strip()
+        query_length = record[3].split(": ", 1)[1].strip()
+        mfe = record[5].split()[1]
+        pvalue = record[6].split(": ", 1)[1].strip()
+        position = record[8].split()[1]
+
+        target_unmatched = re.sub(r"(target 5' )|( 3')", "", record[9]).lower()
+        target_matched = re.sub(r"(^          )|(   $)", "", record[10])
+        target_seq = _merge_pairing(re.sub(r"\s", "-", target_matched),
+                                    re.sub(r"\s", "-", target_unmatched))
+
+        query_matched = re.sub(r"(^          )|(   $)", "", record[11])
+        query_unmatched = re.sub(r"(miRNA  3' )|( 5')", "", record[12]).lower()
+        query_seq = _merge_pairing(re.sub(r"\s", "-", query_matched),
+                                   re.sub(r"\s", "-", query_unmatched))[::-1]
+
+        results.append([target, target_length, position, query, query_length, mfe, pvalue,
+                        target_seq, query_seq])
+        i += 13
+    return results
+
+
+def _hit_key(query, target, params):
+    return hashlib.sha1("%s|%s|%s" % (query, target, params)).hexdigest()
+
+
+def _run_target_batch(args):
+    """
+    worker: fold one target window against a list of (key, query) windows in a single RNAhybrid call
+    returns {key: hits}
+    """
+    RNAhybrid_cmd, chi, theta, mfe_cutoff, target, queries = args
+    tmpdir = tempfile.mkdtemp(prefix="RNAhybrid_")
+    try:
+        target_file = os.path.join(tmpdir, "target.fa")
+        query_file = os.path.join(tmpdir, "query.fa")
+        with open(target_file, 'w') as out:
+            out.write(">target\n%s\n" % (target))
+        with open(query_file, 'w') as out:
+            for n, (key, query) in enumerate(queries):
+                out.write(">q%d\n%s\n" % (n, query))
+        rh = Popen([RNAhybrid_cmd, "-d", (str(chi) + "," + str(theta)),
+                    "-n", "70", "-m", "10000", "-e", str(mfe_cutoff),
+                    "-t", target_file, "-q", query_file], stdout=PIPE)
+        output = rh.communicate()[0]
+        if rh.returncode != 0:
+            raise RuntimeError("RNAhybrid exited with status %d" % (rh.returncode))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    hits = dict((key, []) for key, query in queries)
+    names = dict(("q%d" % (n), key) for n, (key, query) in enumerate(queries))
+    for hit in parse_RNAhybrid(output):
+        hits[names[hit[3]]].append(hit)
+    return hits
+
+
+class HitCache(object):
+    """sqlite-backed store of RNAhybrid hits, keyed by sha1(query|target|params)"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        #several fold_driver workers may share one cache file
+        self.con = sqlite3.connect(filename, timeout=600)
+        self.con.execute("CREATE TABLE IF NOT EXISTS hits (key TEXT PRIMARY KEY, hits TEXT)")
+        self.con.commit()
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = "SELECT key, hits FROM hits WHERE key IN (%s)" % (",".join("?" * len(chunk)))
+            for key, hits in self.con.execute(query, chunk):
+                found[key] = json.loads(hits)
+        return found
+
+    def put_many(self, hits):
+        self.con.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?)",
+                             [(key, json.dumps(value)) for key, value in hits.items()])
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+
+class RNAhybridRunner(object):
+    """
+    fold many (query, target) window pairs at once
+
+    RNAhybrid_cmd: path to the RNAhybrid binary
+    cache_file: sqlite file for persistent hits, None to keep hits in memory only
+    processes: number of worker processes, 1 runs in this process
+    queries_per_call: max number of query windows folded against a target in one RNAhybrid call
+    memory_size: without a cache_file, the number of most recently used pairs kept in memory
+    """
+
+    def __init__(self, RNAhybrid_cmd="RNAhybrid", cache_file=None, processes=1, chi=-20.0, theta=10.0,
+                 queries_per_call=50, memory_size=100000):
+        self.RNAhybrid_cmd = RNAhybrid_cmd
+        self.processes = processes
+        self.queries_per_call = queries_per_call
+        self.chi = chi
+        self.theta = theta
+        self.cache = HitCache(cache_file) if cache_file is not None else None
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+
+    def _params(self, mfe_cutoff):
+        return "%s,%s,%s" % (self.chi, self.theta, mfe_cutoff)
+
+    def hits(self, pairs, mfe_cutoff=-40):
+        """
+        pairs: list of (query, target) sequences
+        returns a list of parsed hit lists, one per pair, in the same order
+        """
+        params = self._params(mfe_cutoff)
+        keys = [_hit_key(query, target, params) for query, target in pairs]
+
+        found = dict((key, self._memory[key]) for key in keys if key in self._memory)
+        if self.cache is not None:
+            found.update(self.cache.get_many(set(keys) - set(found)))
+
+        by_target = {}
+        seen = set(found)
+        for key, (query, target) in zip(keys, pairs):
+            if key in seen:
+                continue
+            seen.add(key)
+            by_target.setdefault(target, []).append((key, query))
+
+        jobs = list()
+        for target, queries in by_target.items():
+            for i in range(0, len(queries), self.queries_per_call):
+                jobs.append((self.RNAhybrid_cmd, self.chi, self.theta, mfe_cutoff, target,
+                             queries[i:i + self.queries_per_call]))
+        if len(jobs) > 0:
+            if self.processes > 1 and len(jobs) > 1:
+                pool = Pool(self.processes)
+                try:
+                    batches = pool.map(_run_target_batch, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                batches = map(_run_target_batch, jobs)
+            new_hits = {}
+            for batch in batches:
+                new_hits.update(batch)
+            if self.cache is not None:
+                self.cache.put_many(new_hits)
+            found.update(new_hits)
+        if self.cache is None:
+            #least recently used pairs are dropped past memory_size
+            for key in keys:
+                self._memory.pop(key, None)
+                self._memory[key] = found[key]
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+        return [found[key] for key in keys]
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
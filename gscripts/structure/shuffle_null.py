@@ -0,0 +1,149 @@
+"""
+null model for RNA bridges: draw many shuffles of every link at once
+
+Same model as shuffle_bridges.py, each foot of a link is moved to a uniformly random
+position inside the intron region (event_detail.BED entry) it came from, keeping its
+length.  Links and region bounds are held as numpy arrays so N replicates are drawn in
+a single vectorized call, then written as one BED12 per replicate and/or a compressed
+.npz of start positions for empirical p-values.
+"""
+
+from optparse import OptionParser
+import numpy as np
+import pybedtools
+
+from conserved_structure import RNApair
+
+
+class BridgeNullModel(object):
+
+    def __init__(self, events, links):
+        """
+        events: event_detail.BED (file or BedTool), regions labeled region%wholeLoc%gene|exon%type
+        links: RNAlinks bed12 (file or BedTool)
+        """
+        bounds = {}
+        for line in pybedtools.BedTool(events):
+            region = line.name.split("%")[0]
+            exon = "_".join(line.name.split("%")[2].split("|"))
+            bounds[(exon, region)] = (line.start, line.stop)
+
+        chroms, strands, colors, names = [], [], [], []
+        q, t, qEvent, tEvent = [], [], [], []
+        for line in pybedtools.BedTool(links):
+            pair = RNApair(line)
+            exon = pair.name.split("%")[0]
+            qBounds = bounds[(exon, pair.qType)]
+            tBounds = bounds[(exon, pair.tType)]
+            if qBounds[1] < qBounds[0] or tBounds[1] < tBounds[0]:
+                raise ValueError("one of the events is less than zero")
+            chroms.append(pair.chromosome)
+            strands.append(pair.strand)
+            colors.append(pair.color)
+            names.append(pair.name)
+            q.append((pair.qStart, pair.qStop))
+            t.append((pair.tStart, pair.tStop))
+            qEvent.append(qBounds)
+            tEvent.append(tBounds)
+
+        self.chroms = np.array(chroms, dtype=object)
+        self.strands = np.array(strands, dtype=object)
+        self.colors = np.array(colors, dtype=object)
+        self.names = np.array(names, dtype=object)
+        q = np.array(q, dtype=np.int64).reshape(-1, 2)
+        t = np.array(t, dtype=np.int64).reshape(-1, 2)
+        qEvent = np.array(qEvent, dtype=np.int64).reshape(-1, 2)
+        tEvent = np.array(tEvent, dtype=np.int64).reshape(-1, 2)
+
+        self.qLen = q[:, 1] - q[:, 0]
+        self.tLen = t[:, 1] - t[:, 0]
+        self.qEventStart = qEvent[:, 0]
+        self.tEventStart = tEvent[:, 0]
+        # number of possible start offsets minus one, negative if the foot is bigger than its region
+        self.qSpan = (qEvent[:, 1] - qEvent[:, 0]) - self.qLen
+        self.tSpan = (tEvent[:, 1] - tEvent[:, 0]) - self.tLen
+        #sometimes the length of the foot is more than the size of the region, those links are ignored
+        self.valid = (self.qSpan >= 0) & (self.tSpan >= 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def shuffle(self, n, seed=None):
+        """
+        draw n shuffles of every link
+        returns (qStarts, tStarts), int64 arrays of shape (n, links)
+        """
+        rng = np.random.RandomState(seed)
+        nLinks = len(self)
+        qSpan = np.maximum(self.qSpan, 0)
+        tSpan = np.maximum(self.tSpan, 0)
+        qStarts = self.qEventStart + (rng.random_sample((n, nLinks)) * (qSpan + 1)).astype(np.int64)
+        tStarts = self.tEventStart + (rng.random_sample((n, nLinks)) * (tSpan + 1)).astype(np.int64)
+        return qStarts, tStarts
+
+    def kept(self, qStarts, tStarts):
+        """links that can be written as bed12, valid and with non-overlapping feet (see bed12FromMatchedPair)"""
+        qStops = qStarts + self.qLen
+        tStops = tStarts + self.tLen
+        overlapping = (qStarts <= tStops) & (qStops >= tStarts)
+        return self.valid & ~overlapping
+
+    def bed12_lines(self, qStart, tStart):
+        """bed12 lines for one replicate, same layout as structure.bed12FromMatchedPair"""
+        a, b = qStart, qStart + self.qLen
+        x, y = tStart, tStart + self.tLen
+        qFirst = b < x
+        start = np.where(qFirst, a, x)
+        stop = np.where(qFirst, y, b)
+        block1len = np.where(qFirst, b - a, y - x)
+        block2len = np.where(qFirst, y - x, b - a)
+        block2Start = np.where(qFirst, x - a, a - x)
+
+        keep = np.flatnonzero(self.kept(qStart, tStart))
+        for i in keep:
+            yield "\t".join(map(str, [self.chroms[i], start[i], stop[i], self.names[i], 1, self.strands[i],
+                                      start[i], stop[i], self.colors[i], 2,
+                                      "%d,%d" % (block1len[i], block2len[i]),
+                                      "0,%d" % (block2Start[i])]))
+
+    def write_bed12(self, qStarts, tStarts, prefix):
+        """one bed12 file per replicate: prefix.<replicate>.bed"""
+        filenames = list()
+        for replicate in range(len(qStarts)):
+            filename = "%s.%d.bed" % (prefix, replicate + 1)
+            with open(filename, 'w') as out:
+                for line in self.bed12_lines(qStarts[replicate], tStarts[replicate]):
+                    out.write(line + "\n")
+            filenames.append(filename)
+        return filenames
+
+    def save(self, qStarts, tStarts, filename):
+        """all replicates as a compressed array file"""
+        np.savez_compressed(filename, qStarts=qStarts, tStarts=tStarts,
+                            qLen=self.qLen, tLen=self.tLen, kept=self.kept(qStarts, tStarts),
+                            chroms=self.chroms.astype(str), strands=self.strands.astype(str),
+                            names=self.names.astype(str))
+
+
+if __name__ == "__main__":
+
+    usage = "python shuffle_null.py --events event_detail.BED --links RNAlinks.bed --replicates 1000 --npz null.npz"
+    description = "draw many random placements of RNA bridges within their intron regions"
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("--events", dest="events", help="event_detail.BED with the intron regions links were found in")
+    parser.add_option("--links", dest="links", help="RNA links, special bed12 format")
+    parser.add_option("--replicates", dest="replicates", type="int", default=1000, help="number of shuffles.  default:%default")
+    parser.add_option("--seed", dest="seed", type="int", default=None, help="random seed")
+    parser.add_option("--bed_prefix", dest="bed_prefix", default=None, help="write one bed12 per replicate as PREFIX.<n>.bed", metavar="PREFIX")
+    parser.add_option("--npz", dest="npz", default=None, help="write all replicates to this compressed array file", metavar="FILE")
+
+    (options, args) = parser.parse_args()
+    if options.bed_prefix is None and options.npz is None:
+        parser.error("give --bed_prefix and/or --npz")
+
+    model = BridgeNullModel(options.events, options.links)
+    qStarts, tStarts = model.shuffle(options.replicates, seed=options.seed)
+    if options.npz is not None:
+        model.save(qStarts, tStarts, options.npz)
+    if options.bed_prefix is not None:
+        model.write_bed12(qStarts, tStarts, options.bed_prefix)
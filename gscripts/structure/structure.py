@@ -5,6 +5,7 @@ import pybedtools
 import os,sys
 import pickle
 from seqTools import fetchseq, chop
+from hybrid_batch import RNAhybridRunner
 #from CLIP_analysis import get_phastcons
 host = Popen(["hostname"], stdout=PIPE).communicate()[0].strip()
 if "optiputer" in host or "compute" in host:
@@ -25,6 +26,11 @@ def counter():
 ctr = counter()
 
 
+def default_runner(cache_file=None, processes=1):
+    """RNAhybrid batch runner using the lab's RNAhybrid install"""
+    return RNAhybridRunner(base + "/yeolab/Software/RNAhybrid/bin/RNAhybrid",
+                           cache_file=cache_file, processes=processes)
+
 
 def RNAhybrid_hits(query, target, mfe_cutoff=-40, chi=-20.0, theta=10.0):
     """
@@ -145,67 +151,69 @@ def bed12FromMatchedPair(a,b, x,y, chr="chrZ", strand = "+", color="255,0,0", sc
     bedline = "\t".join(map(str, [chr, start, stop, name, score, strand,  start, stop, color, "2", ",".join(map(str, [block1len, block2len])), ",".join(map(str,[block1Start, block2Start]))]))
     return bedline
     
-def matched_positions(query, target, querychunks=70, queryOverlap=.6, targetchunks=10000, targetOverlap=.1, mfe_cutoff=-40, species="hg19", quiet =False):
+def matched_positions(query, target, querychunks=70, queryOverlap=.6, targetchunks=10000, targetOverlap=.1, mfe_cutoff=-40, species="hg19", quiet =False, runner=None):
     """
     Run RNAhybrid using a genome range for query and target, step
     along each in (query/target)chunks-sized overlapping windows, target and query are
     bedtools intervals returned positions are 0-based from the start of
     target
+    runner is an RNAhybridRunner, all window pairs are folded in one batch through it
     """
 
     if not quiet == True:
         print "Pairing %s with %s" %(str(query), str(target))
 
+    if runner is None:
+        runner = default_runner()
 
     qSeq = fetchseq(species, query.chrom.replace("chr", ""),
                     query.start, query.stop, query.strand)
     tSeq = fetchseq(species, target.chrom.replace("chr", ""),
                     target.start, target.stop, target.strand)
 
-    tChop = chop(tSeq, chunkSize=targetchunks, chunkOverlap=targetOverlap)
+    tChop = list(chop(tSeq, chunkSize=targetchunks, chunkOverlap=targetOverlap))
+    qChop = list(chop(qSeq, chunkSize=querychunks, chunkOverlap=queryOverlap))
+    windows = [(i, T, j, Q) for i, T in tChop for j, Q in qChop]
+    allHits = runner.hits([(Q, T) for i, T, j, Q in windows], mfe_cutoff=mfe_cutoff)
     matches = list()
 
+    for (i, T, j, Q), hits in zip(windows, allHits):
+        for hit in hits:
+            tname, tlen, tpos, qname, qlen, mfe, pval, tseq, qseq = hit
+            tMatchLen = len(tseq.replace("-", ""))                
+            if target.strand == "+":
+                Tgenome_start = target.start +  i+int(tpos) + 1
+                Tgenome_stop = Tgenome_start + tMatchLen + 1
+                Qgenome_start = query.start + j
+                Qgenome_stop = Qgenome_start + len(Q)
+            else:
+                Tgenome_stop = target.stop - i - int(tpos) + 1
+                Tgenome_start = Tgenome_stop - tMatchLen + 1
+                Qgenome_stop = query.stop - j
+                Qgenome_start = Qgenome_stop - len(Q)
+                
+            if Qgenome_start< Tgenome_start:
+                color= "255,0,0"
+            else:
+                color="0,0,255"
 
-    for i, T in tChop:
-        qChop = chop(qSeq, chunkSize=querychunks, chunkOverlap=queryOverlap)
-        for j, Q in qChop:
-            #print str(i) + "\t" + str(j)
-            #print T + "\t" + Q
-            hits = RNAhybrid_hits(Q, T, mfe_cutoff=mfe_cutoff)
-            for hit in hits:
-                tname, tlen, tpos, qname, qlen, mfe, pval, tseq, qseq = hit
-                tMatchLen = len(tseq.replace("-", ""))                
-                if target.strand == "+":
-                    Tgenome_start = target.start +  i+int(tpos) + 1
-                    Tgenome_stop = Tgenome_start + tMatchLen + 1
-                    Qgenome_start = query.start + j
-                    Qgenome_stop = Qgenome_start + len(Q)
-                else:
-                    Tgenome_stop = target.stop - i - int(tpos) + 1
-                    Tgenome_start = Tgenome_stop - tMatchLen + 1
-                    Qgenome_stop = query.stop - j
-                    Qgenome_start = Qgenome_stop - len(Q)
-                    
-                if Qgenome_start< Tgenome_start:
-                    color= "255,0,0"
-                else:
-                    color="0,0,255"
-
-                bedline = bed12FromMatchedPair(Qgenome_start, Qgenome_stop,
-                                               Tgenome_start, Tgenome_stop,
-                                               chr=target.chrom, strand=target.strand,
-                                               color=color, score=-float(mfe))
-                if bedline is not None:
-                    matches.append(bedline)
+            bedline = bed12FromMatchedPair(Qgenome_start, Qgenome_stop,
+                                           Tgenome_start, Tgenome_stop,
+                                           chr=target.chrom, strand=target.strand,
+                                           color=color, score=-float(mfe))
+            if bedline is not None:
+                matches.append(bedline)
 
     if quiet is not True:
         print "Found %s structural matches" %(str(len(matches)))
     return matches
 
 
-def run_fold(picklefile, dir=None, eventName=None, outfile=None, mfe_cutoff=-40, species = "hg19"):
+def run_fold(picklefile, dir=None, eventName=None, outfile=None, mfe_cutoff=-40, species = "hg19", runner=None,
+             raise_errors=False):
     """
     given a picklefile (output from parse_event_detail), pair regions
+    raise_errors: re-raise folding errors instead of printing them and returning the links found so far
     """
     if eventName ==None:#if a colloquial name is not given, get it from the filename
         eventNameF = picklefile.replace(".pickle", "").split("/")[-1] 
@@ -233,30 +241,34 @@ def run_fold(picklefile, dir=None, eventName=None, outfile=None, mfe_cutoff=-40,
     #print "mfe_cutoff = %f" %(mfe_cutoff)
     
     try:
-        matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "diProx_diDist_" + str(ctr.next()))) for i in matched_positions(diProx, diDist, mfe_cutoff=mfe_cutoff, species=species)])
+        matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "diProx_diDist_" + str(ctr.next()))) for i in matched_positions(diProx, diDist, mfe_cutoff=mfe_cutoff, species=species, runner=runner)])
     except:
+        if raise_errors:
+            raise
         print "error. Exception raised was: %s" %(str(sys.exc_info()))
 
     try:
-        matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "uiProx_uiDist_" + str(ctr.next()))) for i in matched_positions(uiProx, uiDist, mfe_cutoff=mfe_cutoff, species=species)])
-    except:        
+        matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "uiProx_uiDist_" + str(ctr.next()))) for i in matched_positions(uiProx, uiDist, mfe_cutoff=mfe_cutoff, species=species, runner=runner)])
+    except:
+        if raise_errors:
+            raise
         print "error. Exception raised was: %s" %(str(sys.exc_info()))
 
     #other types of pairs:
     #try:
-    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "diProx_uiDist_" + str(ctr.next()))) for i in matched_positions(diProx, uiDist, mfe_cutoff=mfe_cutoff, species=species)])
+    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "diProx_uiDist_" + str(ctr.next()))) for i in matched_positions(diProx, uiDist, mfe_cutoff=mfe_cutoff, species=species, runner=runner)])
     #except:
     #    print "error. Exception raised was: %s" %(str(sys.exc_info()))
     #try:
-    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "diProx_uiProx_" + str(ctr.next()))) for i in matched_positions(diProx, uiProx, mfe_cutoff=mfe_cutoff, species=species)])
+    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "diProx_uiProx_" + str(ctr.next()))) for i in matched_positions(diProx, uiProx, mfe_cutoff=mfe_cutoff, species=species, runner=runner)])
     #except:
     #    print "error. Exception raised was: %s" %(str(sys.exc_info()))
     #try:
-    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "uiProx_diDist_" + str(ctr.next()))) for i in matched_positions(uiProx, diDist, mfe_cutoff=mfe_cutoff, species=species)])
+    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "uiProx_diDist_" + str(ctr.next()))) for i in matched_positions(uiProx, diDist, mfe_cutoff=mfe_cutoff, species=species, runner=runner)])
     #except:
     #    print "error. Exception raised was: %s" %(str(sys.exc_info()))
     #try:
-    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "uiProx_diProx_" + str(ctr.next()))) for i in matched_positions(uiProx, diProx, mfe_cutoff=mfe_cutoff, species=species)])
+    #    matches.extend([i.replace("bedline", (eventName + "%" + "%s" %(info['type']) + "%" + "uiProx_diProx_" + str(ctr.next()))) for i in matched_positions(uiProx, diProx, mfe_cutoff=mfe_cutoff, species=species, runner=runner)])
     #except:
     #    print "error. Exception raised was: %s" %(str(sys.exc_info()))
 
@@ -267,7 +279,7 @@ def run_fold(picklefile, dir=None, eventName=None, outfile=None, mfe_cutoff=-40,
         return all
 
       
-def fold_a_dir(eventName, dir="structure_tmp/", outdir = "beds", rewrite=False, mfe_cutoff=-40, species="hg19"):
+def fold_a_dir(eventName, dir="structure_tmp/", outdir = "beds", rewrite=False, mfe_cutoff=-40, species="hg19", runner=None):
 
     #print "trying %s" %(eventName)
     from pybedtools import BedTool as BT
@@ -326,7 +338,7 @@ def fold_a_dir(eventName, dir="structure_tmp/", outdir = "beds", rewrite=False,
         #print file
         try:
             outfile = os.path.join(outdir, "%s" %(file.split("/")[-1].replace(".pickle", ".RNAlinks.bed")))
-            tool = run_fold(file, outfile=outfile,mfe_cutoff=mfe_cutoff, species=species)
+            tool = run_fold(file, outfile=outfile,mfe_cutoff=mfe_cutoff, species=species, runner=runner)
             out.append(tool)
         except:
             print "problem with %s" %(file)
@@ -439,8 +451,10 @@ def main(options):
         print "Creating output directory %s" %(options.outdir)
         os.mkdir(options.outdir)
     if options.serial is True:
+        runner = default_runner(cache_file=options.hybrid_cache, processes=options.hybrid_processes)
+        getter = None
         for gene in genelist:
-            geneLinks = fold_a_dir(gene, rewrite=options.rewrite, mfe_cutoff=options.mfe_cutoff, dir=options.dbdir, species=options.species, outdir=options.outdir)
+            geneLinks = fold_a_dir(gene, rewrite=options.rewrite, mfe_cutoff=options.mfe_cutoff, dir=options.dbdir, species=options.species, outdir=options.outdir, runner=runner)
             if geneLinks == None or len(geneLinks) == 0:
                 print "There were no links found for %s" %(gene)
                 continue
@@ -467,6 +481,18 @@ def main(options):
                             raise Exception
                     
                     print "There are %d Links overlapping conserved regionsin gene %s" %(len(conservedOverlappers), gene)
+                    if options.PET_cache is not None:
+                        #score locally, results go to a sqlite file instead of mongo
+                        import cofold_batch
+                        from gscripts.conservation import maf_handler
+                        if getter is None:
+                            #has to be the alignment the PET tree was made for (hg19_46, like the multiZ path)
+                            getter = maf_handler.hg19MafRangeGetter(options.PET_maf_dir, options.PET_maf_tree)
+                        links = [link for link in geneLinks if link.name in conservedOverlappers]
+                        nScored = cofold_batch.PETcofold_batch(links, getter, speciesList.split("-"), tree,
+                                                               options.PET_cache, processes=options.PET_processes)
+                        print "Scored %d links for %s, results are in %s" %(nScored, gene, options.PET_cache)
+                        continue
                     for link in geneLinks:
                         if not link.name in conservedOverlappers:
                             continue
@@ -517,8 +543,16 @@ if __name__ == "__main__":
     parser.add_option("--wait_to_exit", dest="wait",    default=False, action ="store_true")
     parser.add_option("--array", dest="array", default=False, action="store_true")
     parser.add_option("--PETscore", dest="PET", default=False, action="store_true")
+    parser.add_option("--PET_cache", dest="PET_cache", default=None, help="score PET links locally from the maf files into this sqlite file instead of the mongo database", metavar="FILE")
+    parser.add_option("--PET_maf_dir", dest="PET_maf_dir", default=None, help="directory of the chrN.maf.bz2 files of the 46-way alignment, relative to the conservation directory or absolute. Needed with --PET_cache", metavar="DIR")
+    parser.add_option("--PET_maf_tree", dest="PET_maf_tree", default=None, help="newick tree of the --PET_maf_dir alignment, e.g. hg19_46way/46way.corrected.nh. Needed with --PET_cache", metavar="FILE")
+    parser.add_option("--PET_processes", dest="PET_processes", default=4, type="int", help="number of PETcofold workers with --PET_cache.  default:%default", metavar="NP")
+    parser.add_option("--hybrid_cache", dest="hybrid_cache", default=None, help="sqlite file to cache RNAhybrid hits between runs. Only used with --serial", metavar="FILE")
+    parser.add_option("--hybrid_processes", dest="hybrid_processes", default=1, type="int", help="number of RNAhybrid processes per gene. Only used with --serial.  default:%default", metavar="NP")
 
     (options,args) = parser.parse_args()
+    if options.PET_cache is not None and (options.PET_maf_dir is None or options.PET_maf_tree is None):
+        parser.error("--PET_cache needs --PET_maf_dir and --PET_maf_tree")
 
     #this should be handled better:
     options.proxCons = "/nas3/lovci/projects/conservation/hg19/mammal_cons/ultra_proxintron.filtered_normsk.BED.sorted"
@@ -535,7 +569,9 @@ if __name__ == "__main__":
             options.distCons = "/nas3/lovci/projects/conservation/mm9/ultra_distintron.filtered_normsk.BED.sorted"
         print "Do you want to use \n%s\nfor proximal conserved regions and \n%s\nfor distal conserved regions?" %(options.proxCons, options.distCons)
         userAnswer = sys.stdin.readline()
-        if "y" in userAnswer:
+        if "y" in userAnswer and options.PET_cache is not None:
+            print "I'll get started then. Your PET results will be placed in %s" %(options.PET_cache)
+        elif "y" in userAnswer:
             print "Great, one more question."
             print "Do you want to use port 8585 and the database RNAlinkDB.ConsLinks?"
             userAnswer = sys.stdin.readline()
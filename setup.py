@@ -78,12 +78,12 @@ setup(
 
 
     install_requires=['setuptools',
-                      'pysam >= 0.6',
-                      'numpy >= 1.5.1 ',
+                      'pysam >= 0.14',
+                      'numpy >= 1.9',
                       'scipy >= 0.11.0',
                       'matplotlib >= 1.1.0',
                       'pybedtools >= 0.5',
-                      'scikit-learn >= 0.13.0',
+                      'scikit-learn >= 0.18',
                       'matplotlib_venn',
                       'clipper', 
                       #'HTSeq',
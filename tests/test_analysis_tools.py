@@ -0,0 +1,51 @@
+'''
+
+Tests for the blockwise PCA of analysis_tools
+
+'''
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from gscripts.general.analysis_tools import PCA, _row_chunks
+
+class Test(unittest.TestCase):
+
+    def test_row_chunks(self):
+        X = np.arange(1005 * 2).reshape(1005, 2)
+        self.assertEqual([1000, 5], [len(chunk) for chunk in _row_chunks(X, 1000)])
+        #a tail shorter than min_batch_size goes into the block before it
+        self.assertEqual([1005], [len(chunk) for chunk in _row_chunks(X, 1000, 10)])
+        self.assertEqual([400, 400, 205], [len(chunk) for chunk in _row_chunks(X, 400, 10)])
+        self.assertEqual([1005], [len(chunk) for chunk in _row_chunks(X, 2000, 10)])
+        np.testing.assert_array_equal(X, np.vstack(list(_row_chunks(pd.DataFrame(X), 400, 300))))
+
+    def test_incremental_short_tail(self):
+
+        """
+
+        Tests the incremental backend on a row count that leaves a last batch with fewer
+        rows than n_components
+
+        """
+
+        rng = np.random.RandomState(0)
+        X = pd.DataFrame(rng.normal(size=(1005, 20)))
+        pca = PCA(backend='incremental', n_components=10)
+        pca_space = pca.fit_transform(X)
+        self.assertEqual((1005, 10), pca_space.shape)
+        self.assertEqual(list(X.index), list(pca_space.index))
+        self.assertEqual("pc_10", pca.components_.index[-1])
+
+    def test_truncated_svd_args(self):
+        pca = PCA(backend='randomized', n_components=3, random_state=0, whiten=False,
+                  iterated_power=7, copy=True)
+        self.assertEqual({'n_components' : 3, 'random_state' : 0, 'n_iter' : 7},
+                         pca._truncated_svd_args())
+        self.assertEqual({'n_components' : 2}, PCA(backend='randomized')._truncated_svd_args())
+        self.assertRaises(ValueError, PCA(backend='randomized', whiten=True)._truncated_svd_args)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+'''
+
+Tests for projecting reads onto transcripts
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gscripts.riboseq.ensMapper import read_exons, TranscriptProjector
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        exon_file = os.path.join(self.out_dir, "exons.bed")
+        with open(exon_file, 'w') as out:
+            out.write("chr1\t100\t110\t+\tplus\t0\n")
+            out.write("chr1\t120\t140\t+\tplus\t10\n")
+            out.write("chr1\t100\t110\t-\tminus\t20\n")
+            out.write("chr1\t120\t140\t-\tminus\t0\n")
+        self.exons = read_exons(exon_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_project(self):
+        
+        """
+        
+        Tests reads on both isoforms, across an exon junction and reads off transcripts
+        
+        """
+        
+        reads = ["chr1\t95\t105\toff\t0\t+", 
+                 "chr1\t102\t108\tboth\t0\t+", 
+                 "chr1\t105\t125\tjunction\t0\t+", 
+                 "chr1\t130\t132\tlate\t0\t-", 
+                 "chr2\t1\t10\tnowhere\t0\t+"]
+        projector = TranscriptProjector(self.exons)
+        records = list(projector.project(reads))
+        self.assertEqual([("minus", 22, 28, "both", "0", "+"), 
+                          ("plus", 2, 8, "both", "0", "+"), 
+                          ("minus", 15, 25, "junction", "0", "+"), 
+                          ("plus", 5, 15, "junction", "0", "+"), 
+                          ("minus", 8, 10, "late", "0", "-"), 
+                          ("plus", 20, 22, "late", "0", "-")], records)
+        self.assertEqual(5, projector.n_reads)
+        self.assertEqual(3, projector.n_projected)
+
+    def test_unsorted(self):
+        projector = TranscriptProjector(self.exons)
+        self.assertRaises(ValueError, list, projector.project(["chr1\t120\t125", "chr1\t100\t105"]))
+
+if __name__ == "__main__":
+    unittest.main()
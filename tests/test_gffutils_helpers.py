@@ -0,0 +1,60 @@
+'''
+
+Tests for the bulk gffutils readers
+
+'''
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from gscripts.general.gffutils_helpers import annotation_maps, feature_table
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "annotation.db")
+        con = sqlite3.connect(self.db)
+        con.execute("CREATE TABLE features (id text, seqid text, source text, featuretype text, "
+                    "start int, end int, score text, strand text, frame text, attributes text, "
+                    "extra text, bin int)")
+        features = [("G1", "gene", {"gene_id" : ["G1"], "gene_name" : ["Foo"], "gene_type" : ["protein_coding"]}),
+                    ("G2", "gene", {"gene_id" : ["G2"], "havana_gene_name" : ["Bar"]}),
+                    ("T1", "transcript", {"transcript_id" : ["T1"], "gene_id" : ["G1"]})]
+        for feature_id, featuretype, attributes in features:
+            con.execute("INSERT INTO features VALUES (?, 'chr1', 'test', ?, 10, 100, '.', '+', '.', ?, '[]', 1)",
+                        (feature_id, featuretype, json.dumps(attributes)))
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_feature_table(self):
+        genes = feature_table(self.db, "gene", ["gene_id", "gene_name"])
+        self.assertEqual(["G1", "G2"], list(genes['gene_id']))
+        self.assertEqual("Foo", genes['gene_name'][0])
+        self.assertTrue(genes['gene_name'].isnull()[1])
+        self.assertEqual([100, 100], list(genes['end']))
+
+    def test_annotation_maps(self):
+        
+        """
+        
+        Tests the maps and that they are memoized beside the db
+        
+        """
+        
+        maps = annotation_maps(self.db)
+        self.assertEqual({"G1" : "Foo"}, maps['gene_name'])
+        self.assertEqual({"G1" : "protein_coding"}, maps['gene_type'])
+        self.assertEqual({"T1" : "G1"}, maps['transcript_gene'])
+        self.assertTrue(os.path.exists(self.db + ".maps.pickle"))
+        self.assertEqual(maps, annotation_maps(self.db))
+
+if __name__ == "__main__":
+    unittest.main()
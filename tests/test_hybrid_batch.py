@@ -0,0 +1,88 @@
+'''
+
+Tests for the batched RNAhybrid runner
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gscripts.structure.hybrid_batch import parse_RNAhybrid, RNAhybridRunner
+
+#default (non-compact) RNAhybrid output of one target against two queries,
+#matched lines keep their trailing spaces
+RNAHYBRID_OUTPUT = ("\n"
+                    "target: target\n"
+                    "length: 60\n"
+                    "miRNA : q0\n"
+                    "length: 22\n"
+                    "\n"
+                    "mfe: -25.3 kcal/mol\n"
+                    "p-value: 0.012345\n"
+                    "\n"
+                    "position  12\n"
+                    "target 5' U    AC  A 3'\n"
+                    "           GCUG  CA    \n"
+                    "           CGAC  GU    \n"
+                    "miRNA  3'      A   C 5'\n"
+                    "\n"
+                    "\n"
+                    "target: target\n"
+                    "length: 60\n"
+                    "miRNA : q1\n"
+                    "length: 20\n"
+                    "\n"
+                    "mfe: -31.2 kcal/mol\n"
+                    "p-value: 0.001000\n"
+                    "\n"
+                    "position  40\n"
+                    "target 5' A      G 3'\n"
+                    "           CCGGAU    \n"
+                    "           GGCCUA    \n"
+                    "miRNA  3' U      C 5'\n"
+                    "\n")
+
+class Test(unittest.TestCase):
+
+    def test_parse_RNAhybrid(self):
+        hits = parse_RNAhybrid(RNAHYBRID_OUTPUT)
+        self.assertEqual([["target", "60", "12", "q0", "22", "-25.3", "0.012345",
+                           "uGCUGacCAa", "cUG-aCAGC-"],
+                          ["target", "60", "40", "q1", "20", "-31.2", "0.001000",
+                           "aCCGGAUg", "cAUCCGGu"]], hits)
+        self.assertEqual([], parse_RNAhybrid(""))
+
+    def test_hits(self):
+
+        """
+
+        Tests that hits come back per pair through one batched call and that the in
+        memory hits are bounded by memory_size
+
+        """
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(out_dir, "output.txt")
+            with open(output, 'w') as out:
+                out.write(RNAHYBRID_OUTPUT)
+            #stands in for RNAhybrid, both queries are folded against the same target
+            RNAhybrid = os.path.join(out_dir, "RNAhybrid")
+            with open(RNAhybrid, 'w') as out:
+                out.write("#!/bin/bash\ncat %s\n" % (output))
+            os.chmod(RNAhybrid, 0755)
+
+            runner = RNAhybridRunner(RNAhybrid, memory_size=1)
+            hits = runner.hits([("ACGUACGUACGUACGUACGUAC", "GCUGACCAGA"),
+                                ("UUCCGGAUCGAUCGAUCGAU", "GCUGACCAGA")])
+            self.assertEqual(["12", "40"], [pair_hits[0][2] for pair_hits in hits])
+            self.assertEqual(["-25.3", "-31.2"], [pair_hits[0][5] for pair_hits in hits])
+            self.assertEqual(1, len(runner._memory))
+            runner.close()
+        finally:
+            shutil.rmtree(out_dir)
+
+if __name__ == "__main__":
+    unittest.main()
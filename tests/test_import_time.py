@@ -0,0 +1,59 @@
+"""
+Importing the analysis and plotting modules must not load the plotting and
+machine learning libraries, those are only imported when a function that
+needs them is called. Each module is imported in a fresh interpreter.
+"""
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = ['matplotlib', 'pylab', 'seaborn', 'prettyplotlib',
+                 'brewer2mpl', 'sklearn', 'statsmodels', 'scipy']
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import {module}
+print time.time() - start
+print " ".join(sorted(set(name.split(".")[0] for name in sys.modules
+                          if sys.modules[name] is not None)))
+'''
+
+
+def import_in_subprocess(module):
+    """seconds it took to import module, and the top level packages that
+    were loaded
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)])
+    seconds, loaded = output.strip().split('\n')
+    return float(seconds), set(loaded.split())
+
+
+class Test(unittest.TestCase):
+    max_seconds = 5
+
+    def check_import(self, module):
+        seconds, loaded = import_in_subprocess(module)
+        self.assertEqual(loaded.intersection(HEAVY_MODULES), set())
+        self.assertLess(seconds, self.max_seconds)
+
+    def test_dataviz(self):
+        self.check_import('gscripts.general.dataviz')
+
+    def test_analysis_tools(self):
+        self.check_import('gscripts.general.analysis_tools')
+
+    def test_GO(self):
+        self.check_import('gscripts.GO.GO')
+
+    def test_lazy_import(self):
+        from gscripts import lazy_import
+
+        loaded = []
+        json = lazy_import('json', on_load=loaded.append)
+        self.assertEqual(loaded, [])
+        self.assertEqual(json.dumps([1]), '[1]')
+        self.assertEqual(len(loaded), 1)
+        json.dumps([2])
+        self.assertEqual(len(loaded), 1)
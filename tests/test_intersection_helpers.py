@@ -0,0 +1,136 @@
+'''
+
+Tests for the in process overlap counting and shuffling of intersection_helpers
+
+'''
+
+import unittest
+
+import numpy as np
+import pybedtools
+
+from gscripts.general.intersection_helpers import IntervalArrays, get_all_overlaps, ShuffleNullModel
+
+def brute_force_count(a, b, stranded=False):
+    """ number of intervals in a overlapping at least one interval in b, pairwise """
+    return sum(any(x.chrom == y.chrom and x.start < y.end and y.start < x.end and
+                   (not stranded or x.strand == y.strand) for y in b) for x in a)
+
+def bedtool(intervals):
+    return pybedtools.BedTool("\n".join("%s %d %d x 0 %s" % interval for interval in intervals),
+                              from_string=True)
+
+class Test(unittest.TestCase):
+
+    def test_count_overlapping(self):
+
+        """
+
+        Tests touching (half open, no overlap), nested and long intervals hiding shorter ones
+        against brute force, stranded and not
+
+        """
+
+        a = bedtool([("chr1", 10, 20, "+"), ("chr1", 20, 30, "+"), ("chr1", 35, 40, "-"),
+                     ("chr1", 100, 200, "+"), ("chr1", 300, 310, "+"), ("chr2", 10, 20, "+")])
+        b = bedtool([("chr1", 0, 10, "+"), ("chr1", 30, 35, "+"), ("chr1", 36, 37, "+"),
+                     ("chr1", 120, 130, "-"), ("chr1", 50, 1000, "-"), ("chr1", 305, 306, "+")])
+        for stranded in (False, True):
+            arrays_a = IntervalArrays(a, stranded)
+            arrays_b = IntervalArrays(b, stranded)
+            self.assertEqual(brute_force_count(a, b, stranded), arrays_a.count_overlapping(arrays_b))
+            self.assertEqual(brute_force_count(b, a, stranded), arrays_b.count_overlapping(arrays_a))
+        #10-20 and 20-30 only touch 0-10 and 30-35, 35-40 holds 36-37, 50-1000 holds 100-200
+        #and 300-310 (stranded, only 300-310 and 305-306 are on the same strand)
+        self.assertEqual(3, IntervalArrays(a).count_overlapping(IntervalArrays(b)))
+        self.assertEqual(1, IntervalArrays(a, True).count_overlapping(IntervalArrays(b, True)))
+
+        overlaps = IntervalArrays(b).overlaps(np.array(["chr1", "chr1", "chr1", "chr3"], dtype=object),
+                                              np.array([10, 29, 1000, 0]), np.array([30, 31, 1001, 100]))
+        self.assertEqual([False, True, False, False], list(overlaps))
+
+    def test_get_all_overlaps_random(self):
+        rng = np.random.RandomState(0)
+        def random_set(n):
+            starts = rng.randint(0, 2000, n)
+            return bedtool(zip(rng.choice(["chr1", "chr2"], n), starts, starts + rng.randint(1, 200, n),
+                               rng.choice(["+", "-"], n)))
+        set1 = {"a" : random_set(50), "b" : random_set(5)}
+        set2 = {"c" : random_set(30), "d" : random_set(100), "e" : bedtool([("chr3", 0, 10, "+")])}
+        for stranded in (False, True):
+            set1_by_set2, set2_by_set1 = get_all_overlaps(set1, set2, engine="numpy", stranded=stranded)
+            for name1 in set1:
+                for name2 in set2:
+                    self.assertEqual(brute_force_count(set1[name1], set2[name2], stranded),
+                                     set1_by_set2.loc[name2, name1])
+                    self.assertEqual(brute_force_count(set2[name2], set1[name1], stranded),
+                                     set2_by_set1.loc[name2, name1])
+
+    def test_empty_include_regions(self):
+        regions = pybedtools.BedTool("chr1 100 200 foo 0 +", from_string=True)
+        self.assertRaises(ValueError, ShuffleNullModel, [regions, []])
+
+    def test_shuffle(self):
+
+        """
+
+        Tests that shuffled intervals keep their lengths and land inside the regions of the
+        class they were assigned to, intervals outside every class are left out
+
+        """
+
+        prox = pybedtools.BedTool("chr1 100 200 foo 0 +\nchr2 1000 1500 foo 0 +", from_string=True)
+        dist = pybedtools.BedTool("chr1 5000 6000 bar 0 +", from_string=True)
+        intervals = pybedtools.BedTool("""chr1 150 160 a 0 +
+chr1 190 260 b 0 +
+chr1 5100 5130 c 0 +
+chr3 10 20 d 0 +""", from_string=True)
+
+        model = ShuffleNullModel([prox, dist], seed=0)
+        codes, starts, ends = model.shuffle(intervals, 200)
+        self.assertEqual((200, 3), codes.shape)
+        for lengths in ends - starts:
+            self.assertEqual([10, 70, 30], list(lengths))
+
+        classes = [[("chr1", 100, 200), ("chr2", 1000, 1500)], [("chr1", 5000, 6000)]]
+        for column, regions in zip(range(3), [classes[0], classes[0], classes[1]]):
+            for code, start, end in zip(codes[:, column], starts[:, column], ends[:, column]):
+                self.assertTrue(any(model.chroms[code] == chrom and region_start <= start and end <= region_end
+                                    for chrom, region_start, region_end in regions))
+        #both prox regions get used
+        self.assertEqual(set(["chr1", "chr2"]), set(model.chroms[code] for code in codes[:, 0]))
+
+    def test_count_overlaps(self):
+
+        """
+
+        Tests overlap counts on fixed intervals (touching intervals don't overlap, unknown
+        chromosomes are ignored) and that replicates don't see each other's intervals
+
+        """
+
+        regions = pybedtools.BedTool("chr1 0 1000 foo 0 +\nchr2 0 1000 foo 0 +", from_string=True)
+        model = ShuffleNullModel([regions], seed=0)
+
+        query = model.fixed(pybedtools.BedTool("""chr1 10 20 a 0 +
+chr1 30 40 b 0 +
+chr1 100 110 c 0 +
+chr2 10 20 d 0 +
+chr9 10 20 e 0 +""", from_string=True))
+        target = model.fixed(pybedtools.BedTool("""chr1 15 16 a 0 +
+chr1 40 50 b 0 +
+chr1 105 200 c 0 +
+chr9 10 20 e 0 +""", from_string=True))
+        self.assertEqual([2], list(model.count_overlaps(query, target)))
+        self.assertEqual([2], list(model.count_overlaps(target, query)))
+
+        #two replicates on chr1
+        query = (np.zeros((2, 2), dtype=np.int64), np.array([[10, 100], [500, 600]]),
+                 np.array([[20, 110], [510, 610]]))
+        self.assertEqual([2, 0], list(model.count_overlaps(query, target)))
+        target = (np.zeros((2, 1), dtype=np.int64), np.array([[500], [600]]), np.array([[510], [605]]))
+        self.assertEqual([0, 1], list(model.count_overlaps(query, target)))
+        self.assertEqual([0, 1], list(model.count_overlaps(query, target, chunk_size=1)))
+
+if __name__ == "__main__":
+    unittest.main()
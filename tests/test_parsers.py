@@ -0,0 +1,56 @@
+import os
+import shutil
+import unittest
+
+from gscripts.general import parsers
+
+
+class Test(unittest.TestCase):
+    out_dir = 'test_output'
+
+    def setUp(self):
+        os.mkdir(self.out_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_count_bed_lines(self):
+        bed = os.path.join(self.out_dir, 'test.peaks.bed')
+        with open(bed, 'w') as f:
+            f.write('track name=peaks\n')
+            f.write('chr1\t10\t20\tpeak1\t0\t+\n')
+            f.write('chr1\t30\t40\tpeak2\t0\t+')
+        self.assertEqual(parsers.count_bed_lines(bed), 2)
+
+    def test_metrics_store(self):
+        """Files are only parsed again when they change, and parsed results
+        survive between stores
+        """
+        nrf = os.path.join(self.out_dir, 'sample.NRF.metrics')
+        with open(nrf, 'w') as f:
+            f.write('TotalReads NRF\n100 0.5\n')
+        store_file = os.path.join(self.out_dir, 'metrics.pickle')
+        calls = []
+
+        def parse_nrf_file(nrf_file):
+            calls.append(nrf_file)
+            return parsers.parse_nrf_file(nrf_file)
+
+        store = parsers.MetricsStore(store_file)
+        self.assertEqual(store.parse(nrf, parse_nrf_file),
+                         {'TotalReads': 100.0, 'NRF': 0.5})
+        store.save()
+
+        store = parsers.MetricsStore(store_file)
+        store.parse(nrf, parse_nrf_file)
+        self.assertEqual(len(calls), 1)
+
+        with open(nrf, 'w') as f:
+            f.write('TotalReads NRF\n200 0.25\n')
+        self.assertEqual(store.parse(nrf, parse_nrf_file),
+                         {'TotalReads': 200.0, 'NRF': 0.25})
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
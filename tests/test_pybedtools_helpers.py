@@ -10,7 +10,7 @@ import unittest
 
 import pybedtools
 
-from gscripts.general.pybedtools_helpers import closest_by_feature, convert_to_mRNA_position
+from gscripts.general.pybedtools_helpers import closest_by_feature, convert_to_mRNA_position, closest_by_name, TranscriptIndex
 
 class Test(unittest.TestCase):
 
@@ -187,6 +187,51 @@ class Test(unittest.TestCase):
         self.assertEqual(convert_to_mRNA_position(tool, location_dict).chrom, "none")
         
         pybedtools.BedTool("chr1    x     y    ")
+    def test_closest_by_name(self):
+        
+        """
+        
+        Tests vectorized closest feature, ties go to the feature listed first
+        
+        """
+        
+        closest, distances = closest_by_name(["bar", "bar", "foo", "foo", "baz"],
+                                             ["chr1"] * 5,
+                                             [299, 301, 89, 100, 10],
+                                             ["-", "-", "+", "+", "+"],
+                                             ["bar", "bar", "foo", "foo"],
+                                             ["chr1"] * 4,
+                                             [310, 300, 111, 90],
+                                             ["-", "-", "+", "+"])
+        
+        self.assertListEqual([1, 1, 3, 3, -1], list(closest))
+        self.assertListEqual([1, -1, -1, 10], list(distances[:4]))
+        
+        self.assertRaises(ValueError, closest_by_name, ["foo"], ["chr1"], [100], ["+"],
+                          ["foo"], ["chr1"], [90], ["-"])
+        
+    def test_transcript_index(self):
+        
+        """
+        
+        Makes sure TranscriptIndex maps like convert_to_mRNA_position on both strands
+        
+        """
+        
+        gene_model = {"ENSMUSG1" : [pybedtools.create_interval_from_list("ENSMUSG1 0 50 ENSMUSG1 0 +".split()),
+                                    pybedtools.create_interval_from_list("ENSMUSG1 100 150 ENSMUSG1 0 +".split())],
+                      "ENSMUSG2" : [pybedtools.create_interval_from_list("ENSMUSG2 100 150 ENSMUSG2 0 -".split()),
+                                    pybedtools.create_interval_from_list("ENSMUSG2 0 50 ENSMUSG2 0 -".split())]}
+        index = TranscriptIndex(gene_model)
+        
+        starts, ends, found = index.to_mRNA(["ENSMUSG1", "ENSMUSG2", "ENSMUSG1", "ENSMUSG3"],
+                                            [125, 25, 75, 10],
+                                            [127, 27, 77, 12],
+                                            ["+", "-", "+", "+"])
+        self.assertListEqual([True, True, False, False], list(found))
+        self.assertListEqual([75, 73], list(starts[:2]))
+        self.assertListEqual([77, 75], list(ends[:2]))
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
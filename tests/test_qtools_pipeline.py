@@ -0,0 +1,118 @@
+__author__ = 'olga'
+
+import os
+import shutil
+import time
+import unittest
+
+from gscripts.qtools import Pipeline
+
+
+class Test(unittest.TestCase):
+    out_dir = 'test_output'
+
+    def setUp(self):
+        os.mkdir(self.out_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def sh(self, name):
+        return '{}/{}.sh'.format(self.out_dir, name)
+
+    def test_ordered_steps(self):
+        pipeline = Pipeline(queue_type='PBS')
+        pipeline.add_step('summarize', ['echo summarize'],
+                          depends_on=['psi'])
+        pipeline.add_step('psi', ['echo psi'], depends_on=['index'])
+        pipeline.add_step('index', ['echo index'])
+        self.assertEqual([step.name for step in pipeline.ordered_steps()],
+                         ['index', 'psi', 'summarize'])
+
+    def test_cycle(self):
+        pipeline = Pipeline(queue_type='PBS')
+        pipeline.add_step('a', ['echo a'], depends_on=['b'])
+        pipeline.add_step('b', ['echo b'], depends_on=['a'])
+        self.assertRaises(ValueError, pipeline.ordered_steps)
+
+    def test_unknown_dependency(self):
+        pipeline = Pipeline(queue_type='PBS')
+        pipeline.add_step('a', ['echo a'], depends_on=['b'])
+        self.assertRaises(ValueError, pipeline.ordered_steps)
+
+    def test_local_pipeline(self):
+        """Dependent steps run after the steps they wait on, up to date
+        steps are skipped
+        """
+        first = '{}/first.txt'.format(self.out_dir)
+        second = '{}/second.txt'.format(self.out_dir)
+        pipeline = Pipeline(queue_type='LOCAL')
+        pipeline.add_step('first', ['sleep 1', 'echo first > ' + first],
+                          outputs=[first], sh_filename=self.sh('first'))
+        pipeline.add_step('second', ['cat {} > {}'.format(first, second)],
+                          depends_on=['first'], inputs=[first],
+                          outputs=[second], sh_filename=self.sh('second'))
+        jobs = pipeline.submit()
+        self.assertEqual(jobs['second'].wait(), [0])
+        with open(second) as f:
+            self.assertEqual(f.read(), 'first\n')
+
+        # Nothing changed, so nothing runs
+        self.assertEqual(pipeline.submit(), {})
+
+        # Touching the input of the second step only re-runs the second step
+        time.sleep(1)
+        os.utime(first, None)
+        jobs = pipeline.submit()
+        self.assertEqual(list(jobs.keys()), ['second'])
+        jobs['second'].wait()
+
+    def test_pbs_array_dependency(self):
+        """A step after an array step waits on all of its tasks, with the
+        array id in the form Torque expects
+        """
+        # stands in for qsub, prints the ids Torque gives array and
+        # single jobs
+        qsub = '{}/qsub'.format(self.out_dir)
+        with open(qsub, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    'if grep -q "^cmd\\[" "$1"; then\n'
+                    '    echo "12345[].tscc-mgr.local"\n'
+                    'else\n'
+                    '    echo "12346.tscc-mgr.local"\n'
+                    'fi\n')
+        os.chmod(qsub, 0755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = os.path.abspath(self.out_dir) + os.pathsep + path
+        try:
+            pipeline = Pipeline(queue_type='PBS')
+            pipeline.add_step('psi', ['echo a', 'echo b'], array=True,
+                              sh_filename=self.sh('psi'))
+            pipeline.add_step('merge', ['echo merge'], depends_on=['psi'],
+                              sh_filename=self.sh('merge'))
+            pipeline.add_step('summarize', ['echo summarize'],
+                              depends_on=['merge'],
+                              sh_filename=self.sh('summarize'))
+            jobs = pipeline.submit()
+        finally:
+            os.environ['PATH'] = path
+        self.assertEqual(jobs, {'psi': '12345', 'merge': '12346',
+                                'summarize': '12346'})
+        with open(self.sh('merge')) as f:
+            lines = [line.strip() for line in f]
+        self.assertIn('#PBS -W depend=afterokarray:12345[]', lines)
+        with open(self.sh('summarize')) as f:
+            lines = [line.strip() for line in f]
+        self.assertIn('#PBS -W depend=afterok:12346', lines)
+
+    def test_failed_dependency(self):
+        pipeline = Pipeline(queue_type='LOCAL')
+        pipeline.add_step('fail', ['exit 1'], sh_filename=self.sh('fail'))
+        pipeline.add_step('after', ['echo after'], depends_on=['fail'],
+                          sh_filename=self.sh('after'))
+        jobs = pipeline.submit()
+        self.assertEqual(jobs['after'].wait(), [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,7 +5,7 @@ Created on Aug 1, 2013
 '''
 import unittest
 
-from gscripts.qtools import Submitter
+from gscripts.qtools import Submitter, pack_commands
 import subprocess
 from subprocess import PIPE
 import os
@@ -111,6 +111,97 @@ echo testing
             subprocess.Popen(["qdel", job_id],
                              stdout=PIPE)
 
+    def test_local(self):
+        """Test running a job on this machine without a scheduler
+        """
+        job_name = 'test_qtools_submitter_local'
+        submit_sh = '{}/{}.sh'.format(self.out_dir, job_name)
+        sub = Submitter(queue_type='LOCAL', sh_filename=submit_sh,
+                        commands=self.commands, job_name=job_name)
+        job = sub.job(submit=True)
+        self.assertEqual(job.wait(), [0])
+        with open(submit_sh + '.out') as f:
+            self.assertEqual(f.readlines()[-1], 'testing\n')
+
+    def test_local_array(self):
+        """Test array semantics and max_running for local jobs
+        """
+        job_name = 'test_qtools_submitter_local_array'
+        submit_sh = '{}/{}.sh'.format(self.out_dir, job_name)
+        commands = ['echo task $PBS_ARRAYID', 'echo task $SGE_TASK_ID',
+                    'exit 3']
+        sub = Submitter(queue_type='LOCAL', sh_filename=submit_sh,
+                        commands=commands, job_name=job_name, array=True,
+                        max_running=2)
+        job = sub.job(submit=True)
+        self.assertEqual(job.wait(), [0, 0, 3])
+        self.assertFalse(job.successful())
+        for task_id in (1, 2):
+            with open('{}.out-{}'.format(submit_sh, task_id)) as f:
+                self.assertEqual(f.read(), 'task {}\n'.format(task_id))
+
+    def test_wait_for_pbs_header(self):
+        """Test that PBS dependencies are written into the header
+        """
+        job_name = 'test_qtools_submitter_wait_for_pbs'
+        submit_sh = '{}/{}.sh'.format(self.out_dir, job_name)
+        sub = Submitter(queue_type='PBS', sh_filename=submit_sh,
+                        commands=self.commands, job_name=job_name,
+                        queue='home-yeo', walltime='0:01:00',
+                        wait_for=['11111'])
+        sub.add_wait('22222')
+        sub.add_wait('33333', array=True)
+        sub.job(submit=False)
+        with open(submit_sh) as f:
+            lines = [line.strip() for line in f]
+        self.assertIn('#PBS -W depend=afterok:11111:22222,afterokarray:33333[]',
+                      lines)
+
+    def test_wait_for_sge_header(self):
+        """Test that SGE dependencies are written into the header
+        """
+        job_name = 'test_qtools_submitter_wait_for_sge'
+        submit_sh = '{}/{}.sh'.format(self.out_dir, job_name)
+        sub = Submitter(queue_type='SGE', sh_filename=submit_sh,
+                        commands=self.commands, job_name=job_name,
+                        wait_for_array=['33333'])
+        sub.add_wait('11111')
+        sub.job(submit=False)
+        with open(submit_sh) as f:
+            lines = [line.strip() for line in f]
+        self.assertIn('#$ -hold_jid 11111,33333', lines)
+
+    def test_pack_commands(self):
+        """Test that packing balances the cost of each group
+        """
+        commands = ['a', 'b', 'c', 'd', 'e']
+        bins = pack_commands(commands, 2, costs=[5, 4, 3, 2, 2])
+        self.assertEqual(bins, [['a', 'd', 'e'], ['b', 'c']])
+        self.assertEqual(pack_commands(commands, 10), [[x] for x in commands])
+
+    def test_local_packed(self):
+        """Test that packed commands all run, in fewer array tasks
+        """
+        job_name = 'test_qtools_submitter_local_packed'
+        submit_sh = '{}/{}.sh'.format(self.out_dir, job_name)
+        commands = ['touch {}/{}.done'.format(self.out_dir, i)
+                    for i in range(10)]
+        sub = Submitter(queue_type='LOCAL', sh_filename=submit_sh,
+                        commands=commands, job_name=job_name, ppn=2,
+                        pack=True, packed_tasks=3)
+        job = sub.job(submit=True)
+        self.assertEqual(job.wait(), [0, 0, 0])
+        for i in range(10):
+            self.assertTrue(os.path.exists(
+                '{}/{}.done'.format(self.out_dir, i)))
+
+    def test_packed_tasks_from_walltime(self):
+        sub = Submitter(queue_type='PBS', commands=['date'] * 100,
+                        job_name='packed', ppn=4, walltime='0:10:00',
+                        pack=True, costs=[60] * 100)
+        # 6000 seconds of work, 2400 seconds per task
+        self.assertEqual(sub.number_packed_tasks, 3)
+
 #     def test_wait_for_pbs(self):
 #         commands = ['date', 'echo testing PBS']
 #         job_name = 'test_qtools_submitter_wait_for_pbs'
@@ -0,0 +1,94 @@
+'''
+
+Tests for the fused riboseq read filter
+
+'''
+
+from glob import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+from gscripts.riboseq.read_filter import read_transcripts, transcript_coverage, fused_filter
+
+BAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test.bam")
+
+class Test(unittest.TestCase):
+
+    def test_transcript_coverage(self):
+        
+        """
+        
+        Tests P-sites are counted 5' to 3' along spliced transcripts on both strands
+        
+        """
+        
+        out_dir = tempfile.mkdtemp()
+        try:
+            bed12 = os.path.join(out_dir, "transcripts.bed")
+            with open(bed12, 'w') as out:
+                out.write("chr1\t100\t130\tplus\t0\t+\t100\t130\t0\t2\t10,10,\t0,20,\n")
+                out.write("chr1\t100\t130\tminus\t0\t-\t100\t130\t0\t2\t10,10,\t0,20,\n")
+            transcripts = read_transcripts(bed12)['chr1']
+        finally:
+            shutil.rmtree(out_dir)
+        self.assertEqual(("plus", "+", [(100, 110), (120, 130)]), transcripts[0])
+        
+        p_sites = {"+" : np.array([101, 101, 115, 125]), "-" : np.array([129, 100])}
+        coverage = transcript_coverage(p_sites, transcripts)
+        plus = np.zeros(20, dtype=np.int32)
+        plus[1] = 2
+        plus[15] = 1
+        minus = np.zeros(20, dtype=np.int32)
+        minus[0] = 1
+        minus[19] = 1
+        np.testing.assert_array_equal(plus, coverage['plus'])
+        np.testing.assert_array_equal(minus, coverage['minus'])
+
+    def test_fused_filter(self):
+
+        """
+
+        Tests the single pass filter on test.bam, one and several processes: the kept reads,
+        the match length histogram of all reads, the P-site coverage (13M1D21M reads get the
+        offset of length 34) and that the per chromosome part files are removed
+
+        """
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            bam = os.path.join(out_dir, "test.bam")
+            shutil.copy(BAM, bam)
+            pysam.index(bam)
+            bed12 = os.path.join(out_dir, "transcripts.bed")
+            with open(bed12, 'w') as out:
+                out.write("chr1\t0\t500\tplus\t0\t+\t0\t500\t0\t1\t500,\t0,\n")
+                out.write("chr1\t0\t500\tminus\t0\t-\t0\t500\t0\t1\t500,\t0,\n")
+
+            with pysam.AlignmentFile(bam, 'rb') as reads:
+                expected_names = [read.query_name for read in reads
+                                  if read.cigarstring not in ("17M3S", "42M", "1S48M", "47M2S")]
+            plus = np.zeros(500, dtype=np.int32)
+            plus[[18, 25, 413, 420]] = [2, 1, 3, 2]
+
+            for processes in (1, 2):
+                out_bam = os.path.join(out_dir, "filtered.%d.bam" % (processes))
+                histogram, coverage = fused_filter(bam, out_bam, min_length=30, max_length=40,
+                                                   transcripts=bed12, offsets={34 : 20},
+                                                   processes=processes)
+                with pysam.AlignmentFile(out_bam, 'rb') as reads:
+                    self.assertEqual(expected_names, [read.query_name for read in reads])
+                self.assertEqual({17 : 1, 34 : 3, 36 : 1, 37 : 2, 39 : 1, 40 : 1, 42 : 1, 47 : 1, 48 : 1},
+                                 dict((length, histogram[length]) for length in np.flatnonzero(histogram)))
+                np.testing.assert_array_equal(plus, coverage["plus"])
+                np.testing.assert_array_equal(np.zeros(500, dtype=np.int32), coverage["minus"])
+                self.assertEqual([], glob(out_bam + ".*.tmp.bam"))
+        finally:
+            shutil.rmtree(out_dir)
+
+if __name__ == "__main__":
+    unittest.main()
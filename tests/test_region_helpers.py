@@ -0,0 +1,59 @@
+'''
+
+Tests for the cached region sets of region_helpers
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gscripts.general.region_helpers import get_regions, REGION_FILES, REGION_NAMES
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        regions = {"UTR3" : ["chr1\t300\t400\tfoo:t1\t0\t+", "chr1\t250\t280\tfoo:t2\t0\t+",
+                             "chr2\t100\t150\tbar:t1\t0\t-", "chr2\t120\t180\tbar:t2\t0\t-"],
+                   "UTR5" : ["chr1\t10\t50\tfoo:t1\t0\t+", "chr1\t20\t60\tfoo:t2\t0\t+",
+                             "chr2\t400\t450\tbar:t1\t0\t-", "chr2\t380\t420\tbar:t2\t0\t-"],
+                   "CDS" : ["chr1\t60\t250\tfoo:t1\t0\t+", "chr2\t180\t380\tbar:t1\t0\t-"],
+                   "transcription_stop" : ["chr1\t400\t401\tfoo:t1\t0\t+"]}
+        for name, lines in regions.items():
+            with open(os.path.join(self.path, REGION_FILES[name]), 'w') as out:
+                out.write("\n".join(lines) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_regions(self):
+        
+        """
+        
+        Tests that derived regions match the dict based definitions and are only built once
+        
+        """
+        
+        regions = get_regions(self.path, self.cache_dir)
+        self.assertEqual(sorted(REGION_NAMES), sorted(regions.keys()))
+        
+        stop_codons = [(interval.name, interval.start) for interval in regions['stop_codons']]
+        self.assertEqual([("foo", 250), ("bar", 180)], stop_codons)
+        start_codons = [(interval.name, interval.start) for interval in regions['start_codons']]
+        self.assertEqual([("foo", 60), ("bar", 380)], start_codons)
+        starts = [(interval.name, interval.start) for interval in regions['transcription_start']]
+        self.assertEqual([("foo", 10), ("bar", 450)], starts)
+        five_prime = [interval.start for interval in regions['five_prime_sites']]
+        self.assertEqual([60, 380], five_prime)
+        self.assertEqual(10, len(regions['transcriptome']))
+        self.assertEqual(["foo", "foo"], list(regions.arrays('UTR3')['names'][:2]))
+        
+        self.assertTrue(get_regions(self.path, self.cache_dir) is regions)
+        self.assertEqual([regions.version], os.listdir(self.cache_dir))
+
+if __name__ == "__main__":
+    unittest.main()
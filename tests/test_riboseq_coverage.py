@@ -0,0 +1,105 @@
+'''
+
+Tests for riboseq P-site offsets
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from gscripts.riboseq.riboseq_coverage import aligned_position, read_length, StartCodonMetagene, \
+    p_sites, coverage, write_coverage
+
+BAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test.bam")
+
+class Test(unittest.TestCase):
+
+    def test_aligned_position(self):
+        
+        """
+        
+        Tests offsets from the 5' end on both strands, across an intron and past the read
+        
+        """
+        
+        self.assertEqual(114, aligned_position([(100, 130)], 14))
+        self.assertEqual(115, aligned_position([(100, 130)], 14, reverse=True))
+        self.assertEqual(204, aligned_position([(100, 110), (200, 220)], 14))
+        self.assertEqual(105, aligned_position([(100, 110), (200, 220)], 24, reverse=True))
+        self.assertEqual(129, aligned_position([(100, 130)], 40))
+        self.assertEqual(100, aligned_position([(100, 130)], 40, reverse=True))
+        self.assertEqual(30, read_length([(100, 110), (200, 220)]))
+
+    def test_start_codon_metagene(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            start_codons = os.path.join(out_dir, "start_codons.bed")
+            with open(start_codons, 'w') as out:
+                out.write("chr1\t1000\t1000\tfoo\t0\t+\n")
+                out.write("chr1\t2000\t2003\tbar\t0\t-\n")
+            metagene = StartCodonMetagene(start_codons, window=30)
+            for read in range(5):
+                metagene.add("chr1", "+", 988, 28)
+                metagene.add("chr1", "-", 2015, 30)
+            metagene.add("chr1", "+", 990, 28)
+            metagene.add("chr2", "+", 988, 28)
+            self.assertEqual({28 : 12, 30 : 13}, metagene.offsets(min_reads=5))
+            self.assertEqual({}, metagene.offsets(min_reads=10))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_p_sites(self):
+
+        """
+
+        Tests that P-sites come out in position order even when a later read's P-site is
+        upstream of an earlier read's (the reorder buffer), that reads at the same position
+        stay in bam order and that lengths without an offset are skipped
+
+        """
+
+        offsets = {17 : 14, 37 : 2, 36 : 30, 34 : 20}
+        sites = list(p_sites(BAM, offsets, default_offset=None))
+        self.assertEqual([("chr1", 6, "HWI-ST1001:208:C1JW0ACXX:6:1107:14601:58995", 255, "+"),
+                          ("chr1", 18, "HWI-ST1001:208:C1JW0ACXX:6:1214:7174:28546", 255, "+"),
+                          #13M1D21M, the offset skips the deletion
+                          ("chr1", 25, "HWI-ST1001:208:C1JW0ACXX:6:1206:12428:35000", 255, "+"),
+                          ("chr1", 34, "HWI-ST1001:208:C1JW0ACXX:6:2215:19457:52360", 255, "+"),
+                          #last read in the bam
+                          ("chr1", 401, "HWI-ST1001:208:C1JW0ACXX:6:2313:1827:54687", 255, "+"),
+                          ("chr1", 420, "HWI-ST1001:208:C1JW0ACXX:6:1305:18446:15542", 255, "+"),
+                          ("chr1", 420, "HWI-ST1001:208:C1JW0ACXX:6:2306:17344:63184", 255, "+")],
+                         sites)
+
+        sites = list(p_sites(BAM))
+        self.assertEqual(12, len(sites))
+        self.assertEqual(sorted(site[1] for site in sites), [site[1] for site in sites])
+
+    def test_coverage(self):
+        sites = [("chr1", 5, "a", 0, "+"), ("chr1", 5, "b", 0, "+"), ("chr1", 7, "c", 0, "-"),
+                 ("chr1", 9, "d", 0, "+"), ("chr2", 1, "e", 0, "-")]
+        pileups = list(coverage(iter(sites)))
+        self.assertEqual([("chr1", "+"), ("chr1", "-"), ("chr2", "-")],
+                         [pileup[:2] for pileup in pileups])
+        np.testing.assert_array_equal([5, 9], pileups[0][2])
+        np.testing.assert_array_equal([2, 1], pileups[0][3])
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            out = os.path.join(out_dir, "coverage.npz")
+            self.assertEqual(4, write_coverage(pileups, out))
+            with np.load(out) as store:
+                self.assertEqual(["chr1+_counts", "chr1+_positions", "chr1-_counts",
+                                  "chr1-_positions", "chr2-_counts", "chr2-_positions"],
+                                 sorted(store.keys()))
+                np.testing.assert_array_equal([7], store["chr1-_positions"])
+                np.testing.assert_array_equal([1], store["chr2-_counts"])
+        finally:
+            shutil.rmtree(out_dir)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+'''
+
+Tests for the riboseq peak finder
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from gscripts.riboseq.riboseq_peak_finder import (body_statistics, call_peaks, find_peaks,
+                                                  load_coverage, write_coverage_store)
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_body_statistics(self):
+        
+        """
+        
+        Tests the median is of the sorted gene body, not its middle position
+        
+        """
+        
+        median, mad = body_statistics(np.array([100, 5, 1, 2, 9, 3, 0]), (1, 6))
+        self.assertEqual(3, median)
+        self.assertEqual(2, mad)
+
+    def test_call_peaks(self):
+        vector = np.array([0, 2, 2, 2, 50, 60, 2, 200])
+        np.testing.assert_array_equal([4, 5, 7], call_peaks(vector, 2, 0, fold=25))
+        np.testing.assert_array_equal([5, 7], call_peaks(vector, 2, 0, fold=25, min_count=55))
+        np.testing.assert_array_equal([7], call_peaks(vector, 2, 20, fold=10, mad_cutoff=5))
+
+    def test_find_peaks(self):
+        
+        """
+        
+        Tests text and memory mapped stores give the same peaks, serially and in parallel
+        
+        """
+        
+        vector_file = os.path.join(self.out_dir, "vectors.txt")
+        with open(vector_file, 'w') as out:
+            out.write("tx1 1 1 1 1 30 1\n")
+            out.write("tx2 0 0 0 0\n")
+            out.write("tx3 2 2 2 60 2\n")
+        gene_bodies = {"tx1" : (0, 6), "tx3" : (0, 5)}
+        
+        coverage = load_coverage(vector_file)
+        peaks = [(name, list(positions), list(counts)) for name, positions, counts, median, mad 
+                 in find_peaks(coverage, gene_bodies)]
+        self.assertEqual([("tx1", [4], [30]), ("tx3", [3], [60])], peaks)
+        
+        store = os.path.join(self.out_dir, "coverage.npy")
+        write_coverage_store(coverage[0], coverage[1], coverage[2], store)
+        mapped = load_coverage(store)
+        self.assertTrue(isinstance(mapped[2], np.memmap))
+        parallel = [(name, list(positions), list(counts)) for name, positions, counts, median, mad 
+                    in find_peaks(mapped, gene_bodies, processes=2, chunk_size=1)]
+        self.assertEqual(peaks, parallel)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import unittest
+
+import numpy as np
+
+from gscripts.output_parsers import rna_star_collector
+
+LOG_FINAL_OUT = '''                                 Started job on |\tJun 24 14:29:49
+                             Started mapping on |\tJun 24 14:30:20
+                                    Finished on |\tJun 24 14:32:34
+       Mapping speed, Million of reads per hour |\t27.24
+
+                          Number of input reads |\t1013970
+                      Average input read length |\t100
+                                    UNIQUE READS:
+                   Uniquely mapped reads number |\t{unique}
+                        Uniquely mapped reads % |\t87.19%
+                          Average mapped length |\t99.31
+                       Number of splices: Total |\t{total}
+            Number of splices: Annotated (sjdb) |\t275432
+                       Number of splices: GT/AG |\t276543
+                       Number of splices: GC/AG |\t2104
+                       Number of splices: AT/AC |\t205
+               Number of splices: Non-canonical |\t512
+                      Mismatch rate per base, % |\t0.36%
+                         Deletion rate per base |\t0.01%
+                        Deletion average length |\t1.64
+                        Insertion rate per base |\t0.01%
+                       Insertion average length |\t1.41
+                             MULTI-MAPPING READS:
+        Number of reads mapped to multiple loci |\t33561
+             % of reads mapped to multiple loci |\t3.31%
+        Number of reads mapped to too many loci |\t345
+             % of reads mapped to too many loci |\t0.03%
+                                  UNMAPPED READS:
+       % of reads unmapped: too many mismatches |\t0.00%
+                 % of reads unmapped: too short |\t9.30%
+                     % of reads unmapped: other |\t0.12%
+'''
+
+
+class Test(unittest.TestCase):
+    out_dir = 'test_output'
+
+    def setUp(self):
+        os.mkdir(self.out_dir)
+        for sample, unique, total in (('A_01', 884052, 279364),
+                                      ('B_02', 800000, 0)):
+            filename = os.path.join(self.out_dir,
+                                    '{}.Log.final.out'.format(sample))
+            with open(filename, 'w') as f:
+                f.write(LOG_FINAL_OUT.format(unique=unique, total=total))
+        self.glob_command = os.path.join(self.out_dir, '*.Log.final.out')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    @staticmethod
+    def ids_function(filename):
+        return os.path.basename(filename).split('.')[0]
+
+    def test_log_final_out_bulk(self):
+        """The bulk collector gives the same numbers as log_final_out, also
+        when read back from its cache
+        """
+        cache_file = os.path.join(self.out_dir, 'star.pickle')
+        test_result = rna_star_collector.log_final_out_bulk(
+            self.glob_command, self.ids_function, processes=2,
+            cache_file=cache_file)
+        true_result = rna_star_collector.log_final_out(
+            self.glob_command, self.ids_function)
+        true_result = true_result.loc[test_result.index,
+                                      test_result.columns].astype(float)
+
+        np.testing.assert_allclose(test_result.values, true_result.values)
+        self.assertTrue(np.isnan(test_result.loc['% splices: GT/AG', 'B_02']))
+
+        cached = rna_star_collector.log_final_out_bulk(
+            self.glob_command, self.ids_function, cache_file=cache_file)
+        np.testing.assert_allclose(cached.values, test_result.values)
@@ -11,7 +11,7 @@ from Bio.SeqRecord import SeqRecord
 import pybedtools
 
 
-from gscripts.riboseq.uorf_detector import UORF_detector
+from gscripts.riboseq.uorf_detector import UORF_detector, scan_uorfs
 import tests
 
 class Test(unittest.TestCase):
@@ -297,6 +297,34 @@ class Test(unittest.TestCase):
         print test_result
         print true_result
         self.assertEqual(test_result, true_result)
+    def test_scan_uorfs(self):
+        
+        """
+        
+        Tests the structured array of uORFs, frames, lengths and parallel scanning
+        
+        """
+        
+        intervals = pybedtools.BedTool("""  chr1    1    6    ENSG1    0    +
+                                            chr1    12    18    ENSG1    0    +
+                                            chr1    1    11    ENSG2    0    -
+                                        """, from_string=True)
+        
+        test_dict = {
+                       "ENSG1" : [(intervals[0], SeqRecord(Seq("GGGATG", IUPAC.unambiguous_dna))), 
+                                  (intervals[1], SeqRecord(Seq("GGGTAG", IUPAC.unambiguous_dna)))],
+                       "ENSG2" : [(intervals[2], SeqRecord(Seq("AAATGGGGTAG", IUPAC.unambiguous_dna)))],
+                       }
+        
+        uorfs = scan_uorfs(test_dict, uorf_length=0, processes=2, chunk_size=1)
+        self.assertListEqual(["ENSG1", "ENSG2"], list(uorfs['transcript']))
+        self.assertListEqual([0, 2], list(uorfs['frame']))
+        self.assertListEqual([4, 7], list(uorfs['start_codon']))
+        self.assertListEqual([15, 1], list(uorfs['stop_codon']))
+        self.assertListEqual([2, 2], list(uorfs['codons']))
+        
+        self.assertEqual(0, len(scan_uorfs(test_dict, uorf_length=2)))
+        
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()